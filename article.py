@@ -1,34 +1,75 @@
 from datetime import datetime
-from time import mktime, strptime
-import feedparser
+from time import mktime, strptime, struct_time
 import re
-from nltk.corpus import stopwords
-from nltk.stem.snowball import SnowballStemmer
-import newspaper
-import db_manager
-from article import *
 import argparse
-import string
+from text_normalizer import tokenize, filter_tokens, strip_tags
+import metrics
+import content_cache
 
 ARTICLE_ENTRY_LENGTH = 4
-stop_words = stopwords.words('english')
-stemmer = SnowballStemmer('english')
+# Stored columns of an article, besides its article_id
+ARTICLE_FIELDS = ('title', 'description', 'link', 'published')
 
 class ArticleFormatException(Exception):
     pass
 
+def download_text(link, timeout=None, reparse=False):
+    """Download and parse the main body of an article with newspaper.
+       The page and its text are kept in the content cache, so each is only
+       downloaded once; reparse extracts the text from the cached page again.
+       Raises an exception if the page can't be downloaded or parsed, and
+       content_cache.NotCached if it isn't cached while offline."""
+    import newspaper
+    cache = content_cache.cache
+    if not reparse:
+        text = cache.get(link, 'text')
+        if text is not None:
+            return text
+    html = cache.get(link, 'html')
+    if html is None and cache.offline:
+        raise content_cache.NotCached(link)
+    config = newspaper.Config()
+    if timeout:
+        config.request_timeout = timeout
+    news_article = newspaper.Article(link, config=config)
+    if html is None:
+        with metrics.timer('article_download_seconds'):
+            news_article.download()
+        if news_article.html:
+            cache.put(link, 'html', news_article.html)
+    else:
+        news_article.download(input_html=html)
+    news_article.parse()
+    cache.put(link, 'text', news_article.text)
+    return news_article.text
+
 class Article:
+    """ A news article. Slotted so that streaming millions of them stays cheap.
+
+        Articles loaded with only some of their fields (see
+        db_manager.iter_articles) fetch the rest from the db on first access."""
+
+    __slots__ = ARTICLE_FIELDS + ('article_id', '_text', '_filtered_text')
 
     def __init__(self, raw_data):
         if len(raw_data) != ARTICLE_ENTRY_LENGTH:
             raise ArticleFormatException("Wrong number of entries for article. Expected {0} but got {1}".format(ARTICLE_ENTRY_LENGTH, len(raw_data)))
-        self.title         = self.__strip_tags(raw_data[0])
-        self.description   = self.__strip_tags(raw_data[1])
+        self.title         = strip_tags(raw_data[0])
+        self.description   = strip_tags(raw_data[1])
         self.link          = raw_data[2]
         self.published     = raw_data[3]
+        self.article_id    = None
         self._text          = None
         self._filtered_text = None
 
+    def __getattr__(self, name):
+        # Only called for slots that were never set, i.e. fields left out of a projected load
+        if name not in ARTICLE_FIELDS or self.article_id is None:
+            raise AttributeError(name)
+        import db_manager
+        db_manager.load_article_fields(self)
+        return object.__getattribute__(self, name)
+
     @classmethod
     def from_feedparser(cls, item):
         """ Gets an article object from a feedparser stream
@@ -44,14 +85,27 @@ class Article:
         """Gets article object from an SQL row entry"""
         #published = strptime(entry[-1], '%Y-%m-%d %H:%M:%S')
         
-        return cls((entry[1],entry[2],entry[3],entry[-1]))
+        a = cls((entry[1],entry[2],entry[3],entry[-1]))
+        a.article_id = entry[0]
+        return a
+
+    @classmethod
+    def from_fields(cls, article_id, fields, values):
+        """Article with only the given stored fields set; the others load lazily"""
+        a = cls.__new__(cls)
+        a.article_id = article_id
+        a._text = None
+        a._filtered_text = None
+        for field, value in zip(fields, values):
+            setattr(a, field, value)
+        return a
 
     def sql_entry(self):
-        return (self.title, self.description, self.link, self.published)
+        published = self.published
+        if isinstance(published, struct_time):
+            published = self.__iso_formatted(published)
+        return (self.title, self.description, self.link, published)
 
-    # Strip formatting from raw RSS entry
-    def __strip_tags(self, str):
-        return re.sub('<[^<]+?>', '', str)
     # Get ISO-formatted date string for db entry
     def __iso_formatted(self, date):
         return datetime.fromtimestamp(mktime(date))
@@ -62,20 +116,18 @@ class Article:
         if self._text:
             return self._text
         try:
-            news_article = newspaper.Article(self.link)
-            news_article.download()
-            news_article.parse()
+            raw_text = download_text(self.link)
         except:
             print('Failed to download article: ' + self.link)
+            metrics.inc('article_downloads', result='failed')
             return None
-        # filter out punctuation
-        text = ''.join([c for c in news_article.text if c not in string.punctuation])
-        self._text = [w.lower() for w in text.split()]
+        self._text = tokenize(raw_text)
         return self._text
 
     @property
     def filtered_text(self):
         """Filters out stop words and stems each word to get usable text tokens"""
+        import db_manager
         if self._filtered_text:
             return self._filtered_text
         elif db_manager.is_filtered(self):
@@ -87,7 +139,7 @@ class Article:
             print('No article text from get_article_text()')
             return None
 
-        self._filtered_text = [stemmer.stem(w) for w in self.text if w not in stop_words]
+        self._filtered_text = filter_tokens(self.text)
         return self._filtered_text
 
     @filtered_text.setter
@@ -101,6 +153,7 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--parse", action="store_true", help="Test text parser on a sample article")
 
     args = parser.parse_args()
+    import db_manager
 
     query = "SELECT * FROM articles LIMIT 1;"
     ret = db_manager.query(query)
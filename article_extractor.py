@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+from article import download_text
+import content_cache
+from text_normalizer import tokenize, filter_tokens
+import metrics
+
+DEFAULT_WORKERS = 8
+DEFAULT_PER_DOMAIN = 2
+DEFAULT_DOMAIN_DELAY = 0.5
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 1.0
+DEFAULT_BATCH_SIZE = 50
+
+# Error of articles skipped because they aren't in the content cache while offline
+NOT_CACHED = "not in the content cache"
+
+class ExtractionResult:
+    """Outcome of downloading and filtering a single article"""
+
+    def __init__(self, article, filtered_text=None, error=None):
+        self.article = article
+        self.filtered_text = filtered_text
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def missing(self):
+        """The article was skipped offline, so it is neither filtered nor failed"""
+        return self.error == NOT_CACHED
+
+class DomainLimiter:
+    """ Politeness limits per publisher domain: at most max_concurrent
+        downloads in flight and at least delay seconds between request starts."""
+
+    def __init__(self, max_concurrent=DEFAULT_PER_DOMAIN, delay=DEFAULT_DOMAIN_DELAY):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.semaphores = defaultdict(lambda: threading.Semaphore(max_concurrent))
+        self.next_start = defaultdict(float)
+
+    def acquire(self, domain):
+        with self.lock:
+            semaphore = self.semaphores[domain]
+        semaphore.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start[domain])
+            self.next_start[domain] = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, domain):
+        self.semaphores[domain].release()
+
+def download_article(article, limiter, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """ Download one article's raw text, retrying with exponential backoff.
+        Cached pages skip the domain limits. Returns (raw_text, error); never raises."""
+    cache = content_cache.cache
+    raw_text = cache.get(article.link, 'text')
+    if raw_text is not None:
+        return raw_text, None
+    if cache.offline or cache.has(article.link, 'html'):
+        try:
+            return download_text(article.link), None
+        except content_cache.NotCached:
+            return None, NOT_CACHED
+        except Exception as e:
+            return None, "parse failed: %s" % e
+    domain = urlparse(article.link).netloc
+    error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            metrics.inc('article_download_retries')
+            time.sleep(backoff * 2 ** (attempt - 1))
+        limiter.acquire(domain)
+        try:
+            raw_text = download_text(article.link, timeout=timeout)
+            metrics.inc('article_downloads', result='ok')
+            return raw_text, None
+        except Exception as e:
+            error = "download failed: %s" % e
+        finally:
+            limiter.release(domain)
+    metrics.inc('article_downloads', result='failed')
+    return None, error
+
+def filter_article(article, raw_text):
+    """Tokenize and filter downloaded text into an ExtractionResult"""
+    filtered_text = filter_tokens(tokenize(raw_text))
+    if not filtered_text:
+        return ExtractionResult(article, error="no article text")
+    return ExtractionResult(article, filtered_text=filtered_text)
+
+def extract_article(article, limiter, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """ Download and filter one article, retrying with exponential backoff.
+        Never raises; failures are reported through the result's error."""
+    raw_text, error = download_article(article, limiter, timeout, retries, backoff)
+    if error is not None:
+        return ExtractionResult(article, error=error)
+    return filter_article(article, raw_text)
+
+def extract_articles(articles, on_batch, workers=DEFAULT_WORKERS, per_domain=DEFAULT_PER_DOMAIN,
+                     domain_delay=DEFAULT_DOMAIN_DELAY, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                     backoff=DEFAULT_BACKOFF, batch_size=DEFAULT_BATCH_SIZE):
+    """ Download and filter articles on a bounded pool of worker threads.
+
+        At most 2 * workers articles are in flight at once. Results are handed to
+        on_batch(results) in lists of up to batch_size from the calling thread, so
+        database writes never happen on a worker. Returns the number of articles
+        processed and the elapsed wall time in seconds."""
+    limiter = DomainLimiter(per_domain, domain_delay)
+    articles = iter(articles)
+    pending, batch = set(), []
+    count = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for a in articles:
+                pending.add(pool.submit(extract_article, a, limiter, timeout, retries, backoff))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch.append(future.result())
+                count += 1
+            if len(batch) >= batch_size:
+                on_batch(batch)
+                batch = []
+    if batch:
+        on_batch(batch)
+    return count, time.perf_counter() - start
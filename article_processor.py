@@ -1,111 +1,222 @@
 from db_manager import *
 from text_processor import *
-from multiprocessing import Process
-import numpy
+from article import download_text
+from article_extractor import ExtractionResult, extract_articles, filter_article, DEFAULT_WORKERS
+from vectorizer import Vectorizer
+from related_index import RelatedIndex, IndexLock
+from search_index import SearchIndex
+from doc_matrix_store import update_doc_matrix
+from reduction import update_projection
+from metrics import print_progress
+import metrics
+import content_cache
 import time
 import sys
+import gzip
 import shelve
 import signal
+import argparse
 
-def print_progress(msg, i, max_val, line_num=0, show_frac=True):
-    """Print progress of some process"""
-    prcnt = (i / max_val) * 100
-    if show_frac:
-        sys.stdout.write("\n"*line_num + "\r{0}: {1:.2f}%    ({2}/{3})".format(msg, prcnt, i, max_val))
-    else:
-        sys.stdout.write("\r{0}: {1:.2f}%".format(msg, prcnt))
-    sys.stdout.flush()
-
-def process_articles(articles):
-    """Process all articles and store filtered article text"""
-    num = num_articles()
-    i = 0
-    print('Downloading and parsing articles...')
+def store_extraction_results(results):
+    """ Record a batch of extraction results in the filtered and failed tables.
+        Near-duplicates of earlier articles are recorded as such instead of
+        being filtered. Returns the articles that were filtered."""
+    filtered, failed = [], []
+    for r in results:
+        if r.missing:
+            continue
+        if r.ok:
+            r.article.filtered_text = r.filtered_text
+            filtered.append(r.article)
+        else:
+            print("\nprocess_articles(): Failed to filter article: %s (%s)" % (r.article.link, r.error))
+            failed.append(r.article)
+    filtered = record_text_duplicates(filtered)
+    add_all_to_filtered(filtered)
+    add_all_to_failed(failed)
+    return filtered
+
+def process_articles(articles, workers=DEFAULT_WORKERS, verbose=True):
+    """ Process all articles and store filtered article text. Returns the
+        filtered articles among them, with their text. verbose prints progress."""
+    articles = list(articles)
+    statuses = get_statuses(a.link for a in articles)
+    processed, unprocessed = [], []
     for a in articles:
-        i += 1
+        status = statuses.get(a.link)
         # Pass if the article has already been processed
-        if has_failed(a):
+        if status is None or status.failed or status.duplicate or status.expired:
             continue
-        if is_filtered(a):
-            a.filtered_text = get_filtered_text(a)
+        if status.filtered:
+            processed.append(a)
             continue
-        elif not a.filtered_text:
-            print("process_articles(): Failed to filter article: " + a.link)
-            add_to_failed(a)
-            continue
-        add_to_filtered(a)
-        print_progress("Articles filtered", i, num)
-    return [a for a in articles if a.filtered_text is not None]
-
-def process_idfs(articles, doc_lst=None):
-    """Process inverse document frequencies for a corpus and its unique terms."""
-    if not doc_lst:
-        doc_lst = [a.filtered_text for a in articles]
-    term_lst = unique_terms(doc_lst)
-    i = 0
-    num = len(term_lst)
-    for t in term_lst:
-        print_progress('IDFs', i, num)
-        i += 1
-        idf = inv_document_frequency(t, doc_lst)
-        add_idf(t, idf)
-
-def process_tfs(articles, doc_lst=None):
-    """Process term frequencies for each document in the corpus"""
-    if not doc_lst:
-        doc_lst = [a.filtered_text for a in articles]
-    term_lst = unique_terms(doc_lst)
-    for a in articles:
-        text = a.filtered_text
-        max_f = max_frequency(text)
-        doc_tfs = []
-        for t in term_lst:
-            tf = augmented_term_frequency(t, text, max_f)
-            doc_tfs.append(tf)
-        add_tfs(a, doc_tfs)
-
-def vectorize_articles(articles):
-    vectorized = []
-    for a in articles:
-        term_frequencies = get_tfs(a)
-        vectorized_a = term_frequencies[:]
-        if not term_frequencies:
-            continue
-        inv_doc_frequencies = get_idfs()
-        assert len(term_frequencies) == len(inv_doc_frequencies), "Article should reference all possible terms"
-        for i in range(len(vectorized_a)):
-            vectorized_a[i] *= inv_doc_frequencies[i]
-        vectorized.append(vectorized_a)
-    return vectorized
-
-def generate_doc_matrix():
-    """Generate a document matrix as a concatenation of the vectorized documents"""
-    articles = get_articles()
-    articles = process_articles(articles)
-
-    doc_lst = [a.filtered_text for a in articles]
-    # Calculate corpus inverse document frequencies in parallel with each document's term frequency calculation
-    print('\nProcessing article term frequencies and inverse doc frequencies ...')
-    idf_process = Process(target=process_idfs, args=(articles,doc_lst[:]))
-    tf_process  = Process(target=process_tfs, args=(articles,doc_lst[:]))
-
-    idf_process.start()
-    tf_process.start()
-    idf_process.join()
-    tf_process.join()
-    print('Vectorizing articles ...')
-    vectorized = vectorize_articles(articles)    
-    print('Finished vectorizing. Concatenating to matrix.')
-    return numpy.column_stack([v for v in vectorized])
-
-def print_doc_matrix_info():
-    document_matrix = generate_doc_matrix()
-    if not document_matrix:
+        unprocessed.append(a)
+    if content_cache.cache.offline:
+        unprocessed = [a for a in unprocessed if content_cache.cache.has(a.link, 'text') or content_cache.cache.has(a.link, 'html')]
+    missing = [statuses[a.link].article_id for a in processed if a._filtered_text is None]
+    if missing:
+        texts = get_filtered_texts(missing)
+        for a in processed:
+            if a._filtered_text is None:
+                a.filtered_text = texts[statuses[a.link].article_id]
+
+    num = len(unprocessed)
+    done = 0
+    def on_batch(results):
+        nonlocal done
+        processed.extend(store_extraction_results(results))
+        done += len(results)
+        if verbose:
+            print_progress("Articles filtered", done, num)
+
+    if verbose:
+        print('Downloading and parsing {0} articles with {1} workers...'.format(num, workers))
+    count, elapsed = extract_articles(unprocessed, on_batch, workers=workers)
+    if count and verbose:
+        print('\nExtracted {0} articles in {1:.2f}s ({2:.2f} articles/sec)'.format(count, elapsed, count / elapsed))
+    return processed
+
+def update_related_index(article_ids, articles, rebuild=False, corpus=None):
+    """ Bring the saved related-articles index up to date with the filtered
+        articles, adding new ones and dropping those no longer among them, or
+        index them all afresh. corpus is an optional (document frequencies,
+        number of documents) pair to weight terms by."""
+    index = RelatedIndex() if rebuild else RelatedIndex.load()
+    if corpus is not None:
+        index.vectorizer.use_corpus(*corpus)
+    removed = index.retain(article_ids)
+    added = index.add(article_ids, [a.filtered_text for a in articles])
+    index.save()
+    print('\nRelated articles index: {0} added, {1} removed, {2} total'.format(added, removed, len(index)))
+
+def update_search_index(article_ids, articles, rebuild=False, corpus=None):
+    """ Bring the saved keyword search index up to date with the filtered
+        articles, adding new ones and dropping those no longer among them, or
+        index them all afresh. corpus is as for update_related_index."""
+    index = SearchIndex() if rebuild else SearchIndex.load()
+    if corpus is not None:
+        index.vectorizer.use_corpus(*corpus)
+    removed = index.retain(article_ids)
+    added = index.add(article_ids, [a.filtered_text for a in articles],
+                      [a.published for a in articles], [a.link for a in articles])
+    index.save()
+    print('Search index: {0} added, {1} removed, {2} total'.format(added, removed, len(index)))
+
+def generate_doc_matrix(workers=DEFAULT_WORKERS, components=None, rebuild=False, window=None):
+    """ Generate a sparse (articles x terms) tf-idf matrix of the filtered articles.
+
+        The matrix is stored on disk with its vocabulary and article ids (see
+        doc_matrix_store) and only recomputed or appended to when the set of
+        filtered articles changes, or rebuilt along with the related-articles
+        and search indexes if rebuild is set. If components is given, the matrix is also
+        reduced to that many SVD components (see reduction).
+
+        Terms are weighted by the document frequencies kept in the db as
+        articles are filtered, so vectorizing needs no separate idf pass.
+
+        With a window of N days, only articles published in the last N days are
+        processed and make up the matrix, the indexes and the projection.
+        Articles that have left the window are dropped from them, so the work
+        done per run depends on the window size rather than the whole history.
+        The idfs cover every filtered article that hasn't expired; run the
+        retention job (expire) with the same window to keep them to it."""
+    start = window_start(window) if window else None
+    with metrics.profiled('extract'):
+        process_articles(iter_articles(filtered=False, start=start), workers)
+    # Only ids, links, dates and filtered text are needed from here on
+    articles = list(iter_articles(fields=('link', 'published'), filtered=True, with_text=True, start=start))
+    article_ids = [a.article_id for a in articles]
+    corpus = get_doc_frequencies(), get_num_docs()
+    # Fails if the pipeline is running, since it rewrites the same indexes
+    with IndexLock():
+        with metrics.profiled('related_index'):
+            update_related_index(article_ids, articles, rebuild, corpus)
+        with metrics.profiled('search_index'):
+            update_search_index(article_ids, articles, rebuild, corpus)
+
+    print('\nVectorizing articles ...')
+    with metrics.profiled('doc_matrix'):
+        doc_matrix = update_doc_matrix(article_ids, (a.filtered_text for a in articles), rebuild=rebuild, corpus=corpus)
+    print('Document matrix version %s stored in %s' % (doc_matrix.version, doc_matrix.path))
+    if components:
+        with metrics.profiled('reduce'):
+            projection = update_projection(doc_matrix, components, refit=rebuild)
+        print('Reduced to %s components for %s articles' % (projection.num_components, len(projection)))
+    return doc_matrix.matrix
+
+def reprocess_articles(reparse=False, batch_size=BATCH_PAGE_SIZE):
+    """ Filter every stored article again from the content cache, with the
+        current filtering rules and without any network access. reparse also
+        extracts the text from the cached pages again. Articles that aren't
+        cached keep what is stored for them. Returns the number reprocessed."""
+    cache = content_cache.cache
+    articles = list(iter_articles(fields=('link',)))
+    done = 0
+    for start in range(0, len(articles), batch_size):
+        batch = articles[start:start + batch_size]
+        statuses = get_statuses(a.link for a in batch)
+        batch = [a for a in batch if not (statuses[a.link].duplicate or statuses[a.link].expired) and
+                 (cache.has(a.link, 'html') if reparse else cache.has(a.link, 'text') or cache.has(a.link, 'html'))]
+        results = []
+        for a in batch:
+            try:
+                results.append(filter_article(a, download_text(a.link, reparse=reparse)))
+            except Exception as e:
+                results.append(ExtractionResult(a, error="parse failed: %s" % e))
+        clear_processed(a.article_id for a in batch)
+        store_extraction_results(results)
+        done += len(batch)
+        print_progress("Articles reprocessed", min(start + batch_size, len(articles)), len(articles))
+    return done
+
+def expire(days, archive_path=None):
+    """ Retention job: expire the articles published more than days days ago
+        (see db_manager.expire_articles), archiving their filtered text to
+        archive_path if given, gzipped if it ends in .gz"""
+    before = window_start(days)
+    if archive_path is None:
+        return expire_articles(before)
+    with (gzip.open(archive_path, 'at') if archive_path.endswith('.gz') else open(archive_path, 'a')) as archive:
+        return expire_articles(before, archive)
+
+def print_doc_matrix_info(workers=DEFAULT_WORKERS, components=None, rebuild=False, window=None):
+    document_matrix = generate_doc_matrix(workers, components, rebuild, window)
+    if document_matrix is None:
         print('Document matrix is null!')
         return
-    print("Doc matrix shape: %s" % document_matrix.shape)
+    print("Doc matrix shape: %s x %s (%s non-zero entries)" % (document_matrix.shape + (document_matrix.nnz,)))
     #print("Doc matrix:")
     #print(document_matrix)
 
 if __name__ == '__main__':
-    print_doc_matrix_info()
+    parser = argparse.ArgumentParser(description='Article processing program')
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="number of concurrent article download workers")
+    parser.add_argument("--rebuild-dfs", action="store_true", help="recount document frequencies from every filtered article")
+    parser.add_argument("--backfill-duplicates", action="store_true", help="fingerprint every stored article and record near-duplicates among them")
+    parser.add_argument("-k", "--components", type=int, help="also reduce the document matrix to this many SVD components")
+    parser.add_argument("--window", type=float, metavar="DAYS", help="only process and vectorize articles published in the last DAYS days")
+    parser.add_argument("--expire", type=float, metavar="DAYS", help="drop the filtered text of articles published over DAYS days ago")
+    parser.add_argument("--archive", metavar="FILE", help="with --expire, first append the expired articles to FILE as JSON lines (gzipped if it ends in .gz)")
+    parser.add_argument("--reprocess", action="store_true", help="filter every cached article again offline, then rebuild the document matrix, related and search indexes")
+    parser.add_argument("--reparse", action="store_true", help="with --reprocess, also extract the text from the cached pages again")
+    content_cache.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics.from_arguments(args)
+    content_cache.from_arguments(args)
+    if args.rebuild_dfs:
+        rebuild_doc_frequencies()
+        print("Document frequencies rebuilt for %s articles" % get_num_docs())
+    elif args.backfill_duplicates:
+        print("\n%s duplicates found" % backfill_duplicates())
+    elif args.expire is not None:
+        print("Expired %s articles" % expire(args.expire, args.archive))
+    elif args.reprocess:
+        content_cache.cache.offline = True
+        with metrics.profiled('reprocess'):
+            print("\nReprocessed %s cached articles" % reprocess_articles(args.reparse))
+        print_doc_matrix_info(args.workers, args.components, rebuild=True, window=args.window)
+    else:
+        print_doc_matrix_info(args.workers, args.components, window=args.window)
+    metrics.write_from_arguments(args)
@@ -0,0 +1 @@
+"""Benchmark suite: run from the repository root with python3 -m benchmarks.run"""
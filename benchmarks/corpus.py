@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+import numpy
+from article import Article
+
+SYLLABLES = [c + v for c in 'bdfgklmnprstvz' for v in 'aeiou']
+# Mixed into raw text so tokenizing and stop word filtering have real work to do
+STOP_WORDS = ['the', 'and', 'of', 'to', 'a', 'in', 'is', 'it', 'that', 'was', 'for', 'on']
+PUNCTUATION = [',', '.', ';', ':', '!', '?', "'s", ')']
+START_DATE = datetime(2020, 1, 1)
+
+def make_word(i):
+    """A unique pronounceable pseudo-word for every non-negative integer"""
+    syllables = []
+    while True:
+        i, digit = divmod(i, len(SYLLABLES))
+        syllables.append(SYLLABLES[digit])
+        if i == 0:
+            break
+    while len(syllables) < 2:
+        syllables.append(SYLLABLES[0])
+    return ''.join(reversed(syllables))
+
+class SyntheticCorpus:
+    """ A deterministic corpus of news articles for benchmarking.
+
+        Term ranks follow a Zipf distribution with the given exponent over a
+        vocabulary of vocab_size pseudo-words. A duplicate_rate fraction of the
+        documents repeat the text of an earlier document under a new link, as
+        syndicated stories do. The same parameters and seed always give the
+        same corpus."""
+
+    def __init__(self, num_docs=2000, vocab_size=20000, doc_length=300, zipf_exponent=1.1,
+                 duplicate_rate=0.05, num_publishers=20, seed=0):
+        self.params = {'num_docs': num_docs, 'vocab_size': vocab_size, 'doc_length': doc_length,
+                       'zipf_exponent': zipf_exponent, 'duplicate_rate': duplicate_rate,
+                       'num_publishers': num_publishers, 'seed': seed}
+        self.num_publishers = num_publishers
+        rng = numpy.random.default_rng(seed)
+        self.vocabulary = [make_word(i) for i in range(vocab_size)]
+        probabilities = numpy.arange(1, vocab_size + 1, dtype=numpy.float64) ** -zipf_exponent
+        probabilities /= probabilities.sum()
+
+        self.token_ids = []
+        self.duplicate_of = {}
+        lengths = numpy.maximum(10, rng.poisson(doc_length, num_docs))
+        for i in range(num_docs):
+            if i and rng.random() < duplicate_rate:
+                original = int(rng.integers(0, i))
+                self.duplicate_of[i] = self.duplicate_of.get(original, original)
+                self.token_ids.append(self.token_ids[original])
+            else:
+                self.token_ids.append(rng.choice(vocab_size, size=lengths[i], p=probabilities).astype(numpy.int32))
+        # Positions of stop words and punctuation in the raw text, fixed per document
+        self.noise_seeds = rng.integers(0, 2**32, num_docs)
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    @property
+    def num_tokens(self):
+        return sum(len(t) for t in self.token_ids)
+
+    def document(self, i):
+        """Filtered text of document i"""
+        return [self.vocabulary[t] for t in self.token_ids[i].tolist()]
+
+    def documents(self):
+        return [self.document(i) for i in range(len(self))]
+
+    def raw_text(self, i):
+        """Unfiltered text of document i, with capitals, stop words and punctuation mixed in"""
+        rng = numpy.random.default_rng(self.noise_seeds[i])
+        words = []
+        for j, word in enumerate(self.document(i)):
+            if rng.random() < 0.3:
+                words.append(STOP_WORDS[rng.integers(len(STOP_WORDS))])
+            if j % 12 == 0:
+                word = word.capitalize()
+            if rng.random() < 0.1:
+                word += PUNCTUATION[rng.integers(len(PUNCTUATION))]
+            words.append(word)
+        return ' '.join(words)
+
+    def publisher(self, i):
+        return i % self.num_publishers
+
+    def link(self, i, base_url='http://example.com'):
+        return '%s/p%d/articles/%d.html' % (base_url, self.publisher(i), i)
+
+    def title(self, i):
+        return ' '.join(self.document(i)[:8]).capitalize()
+
+    def description(self, i):
+        return ' '.join(self.document(i)[8:30])
+
+    def published(self, i):
+        return START_DATE + timedelta(minutes=10 * i)
+
+    def article(self, i, base_url='http://example.com'):
+        return Article((self.title(i), self.description(i), self.link(i, base_url), self.published(i)))
+
+    def articles(self, base_url='http://example.com'):
+        return [self.article(i, base_url) for i in range(len(self))]
@@ -0,0 +1,110 @@
+import time
+import threading
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from html import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """ Serves a SyntheticCorpus as RSS feeds and article pages:
+
+        /p<publisher>/feed.xml           latest articles of a publisher, with an ETag and Last-Modified
+        /p<publisher>/articles/<i>.html  the article page
+        /slow/<seconds>/<path>           any of the above after a delay
+        /error/<code>                    an error response with that status"""
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        try:
+            if parts[0] == 'error':
+                return self.send_error(int(parts[1]))
+            if parts[0] == 'slow':
+                time.sleep(float(parts[1]))
+                parts = parts[2:]
+            publisher = int(parts[0][1:])
+            if parts[1:] == ['feed.xml']:
+                return self.send_feed(publisher)
+            if len(parts) == 3 and parts[1] == 'articles' and parts[2].endswith('.html'):
+                return self.send_article(int(parts[2][:-len('.html')]))
+        except (ValueError, IndexError):
+            pass
+        self.send_error(404)
+
+    def send_body(self, body, content_type, etag=None, modified=None):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        if modified:
+            self.send_header('Last-Modified', modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_feed(self, publisher):
+        corpus = self.server.corpus
+        etag = '"p%d-%d"' % (publisher, len(corpus))
+        ids = list(range(publisher, len(corpus), corpus.num_publishers))[-self.server.items_per_feed:]
+        latest = corpus.published(ids[-1]).replace(tzinfo=timezone.utc) if ids else None
+        match, since = self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')
+        # As in HTTP, If-Modified-Since only counts without an If-None-Match
+        if match:
+            not_modified = match == etag
+        else:
+            not_modified = bool(since and latest and parsedate_to_datetime(since) >= latest)
+        if not_modified:
+            self.send_response(304)
+            self.end_headers()
+            return
+        items = ''.join(
+            '<item><title>{0}</title><description>{1}</description><link>{2}</link><pubDate>{3}</pubDate></item>'.format(
+                escape(corpus.title(i)), escape(corpus.description(i)), escape(corpus.link(i, self.server.url)),
+                format_datetime(corpus.published(i)))
+            for i in reversed(ids))
+        feed = ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+                '<title>Publisher {0}</title><link>{1}/p{0}/</link><description>Fixture feed</description>{2}'
+                '</channel></rss>').format(publisher, self.server.url, items)
+        self.send_body(feed, 'application/rss+xml', etag, format_datetime(latest, usegmt=True) if latest else None)
+
+    def send_article(self, i):
+        corpus = self.server.corpus
+        if i >= len(corpus):
+            return self.send_error(404)
+        words = corpus.raw_text(i).split()
+        paragraphs = ''.join('<p>%s</p>' % escape(' '.join(words[j:j + 60])) for j in range(0, len(words), 60))
+        page = ('<html><head><title>{0}</title></head><body><nav><a href="/">Home</a></nav>'
+                '<article><h1>{0}</h1>{1}</article><footer>Fixture</footer></body></html>').format(escape(corpus.title(i)), paragraphs)
+        self.send_body(page, 'text/html; charset=utf-8')
+
+    def log_message(self, format, *args):
+        pass
+
+class FixtureServer:
+    """ A local HTTP server for a corpus, run on a background thread as a context manager:
+
+        with FixtureServer(corpus) as server:
+            poll_feeds(server.feed_urls(), ...)"""
+
+    def __init__(self, corpus, items_per_feed=50):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.corpus = corpus
+        self.httpd.items_per_feed = items_per_feed
+        self.httpd.url = self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+        self.corpus = corpus
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def feed_urls(self):
+        return ['%s/p%d/feed.xml' % (self.url, p) for p in range(self.corpus.num_publishers)]
+
+    def article_links(self):
+        return [self.corpus.link(i, self.url) for i in range(len(self.corpus))]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
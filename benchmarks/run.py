@@ -0,0 +1,332 @@
+import gc
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from benchmarks.corpus import SyntheticCorpus
+from benchmarks.fixture_server import FixtureServer
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+# Throughput drops or peak memory growth beyond this fraction are reported as regressions
+DEFAULT_THRESHOLD = 0.10
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(name):
+    """ Register a benchmark. The decorated generator sets up its inputs, yields
+        (run, items, unit) and cleans up afterwards; only run() is timed."""
+    def register(f):
+        BENCHMARKS[name] = contextmanager(f)
+        return f
+    return register
+
+@contextmanager
+def sqlite_database(directory, name):
+    """Point db_manager at a fresh embedded database for the duration"""
+    import db_manager
+    path = os.path.join(directory, name)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    previous = db_manager.backend
+    db_manager.backend = db_manager.backend_from_url('sqlite:///' + path)
+    try:
+        yield db_manager
+    finally:
+        db_manager.backend.close()
+        db_manager.backend = previous
+        # Article ids, terms and duplicate fingerprints differ between databases
+        db_manager.clear_caches()
+
+@contextmanager
+def content_cache_at(directory, offline=False):
+    """Point the content cache at directory, or turn it off if None, for the duration"""
+    import content_cache
+    previous = content_cache.cache
+    try:
+        yield content_cache.configure(directory, offline=offline)
+    finally:
+        content_cache.cache = previous
+
+def store_corpus(db, corpus):
+    articles = corpus.articles()
+    db.add_articles(articles)
+    for a, document in zip(articles, corpus.documents()):
+        a.filtered_text = document
+    for start in range(0, len(articles), db.BATCH_PAGE_SIZE):
+        db.add_all_to_filtered(articles[start:start + db.BATCH_PAGE_SIZE])
+    return articles
+
+@benchmark('tokenize')
+def tokenize_benchmark(corpus, workdir):
+    from text_normalizer import normalize_many
+    texts = [corpus.raw_text(i) for i in range(len(corpus))]
+    yield (lambda: normalize_many(texts, processes=1)), sum(len(t.split()) for t in texts), 'tokens'
+
+@benchmark('idf')
+def idf_benchmark(corpus, workdir):
+    with sqlite_database(workdir, 'idf.db') as db:
+        store_corpus(db, corpus)
+        yield db.get_idfs, len(db.get_doc_frequencies()), 'terms'
+
+@benchmark('vectorize')
+def vectorize_benchmark(corpus, workdir):
+    from vectorizer import Vectorizer
+    documents = corpus.documents()
+    yield (lambda: Vectorizer().fit_transform(documents)), len(corpus), 'docs'
+
+@benchmark('k_means')
+def k_means_benchmark(corpus, workdir):
+    from clustering import k_means
+    from vectorizer import Vectorizer
+    vectors = Vectorizer().fit_transform(corpus.documents())
+    yield (lambda: k_means(vectors, k=20, max_updates=20, seed=0)), len(corpus), 'docs'
+
+@benchmark('mini_batch_k_means')
+def mini_batch_k_means_benchmark(corpus, workdir):
+    from clustering import mini_batch_k_means
+    from vectorizer import Vectorizer
+    vectors = Vectorizer().fit_transform(corpus.documents())
+    yield (lambda: mini_batch_k_means(vectors, k=20, max_updates=20, seed=0)), len(corpus), 'docs'
+
+@benchmark('similarity')
+def similarity_benchmark(corpus, workdir):
+    from related_index import RelatedIndex
+    index = RelatedIndex()
+    index.add(range(len(corpus)), corpus.documents())
+    index.compact()
+    queries = list(range(0, len(corpus), max(1, len(corpus) // 500)))
+    def run():
+        for article_id in queries:
+            index.related(article_id, 10)
+    yield run, len(queries), 'queries'
+
+@benchmark('search')
+def search_benchmark(corpus, workdir):
+    from search_index import SearchIndex
+    index = SearchIndex()
+    index.add(range(len(corpus)), corpus.documents(), [corpus.published(i) for i in range(len(corpus))],
+              [corpus.link(i) for i in range(len(corpus))])
+    index.compact()
+    # One to four terms each, drawn from the corpus itself so common terms show up as often as they do in text
+    documents = corpus.documents()
+    queries = [documents[i][:1 + i % 4] for i in range(0, len(corpus), max(1, len(corpus) // 500)) if documents[i]]
+    def run():
+        for terms in queries:
+            index.search(terms, 10)
+    yield run, len(queries), 'queries'
+
+@benchmark('near_duplicates')
+def near_duplicates_benchmark(corpus, workdir):
+    from dedup import DuplicateDetector, title_tokens, simhash
+    documents = corpus.documents()
+    def run():
+        detector = DuplicateDetector()
+        found = 0
+        for i, document in enumerate(documents):
+            tokens = set(title_tokens(corpus.title(i), corpus.description(i)))
+            fingerprint = simhash(tokens)
+            if fingerprint is not None and detector.check_title(i, fingerprint, len(tokens)) is not None:
+                found += 1
+            elif detector.check_text(i, detector.signature(document)) is not None:
+                found += 1
+        if found < len(corpus.duplicate_of):
+            raise RuntimeError('found %d of %d duplicates' % (found, len(corpus.duplicate_of)))
+    yield run, len(corpus), 'docs'
+
+@benchmark('db_insert')
+def db_insert_benchmark(corpus, workdir):
+    runs = iter(range(sys.maxsize))
+    def run():
+        with sqlite_database(workdir, 'insert%d.db' % next(runs)) as db:
+            store_corpus(db, corpus)
+    yield run, len(corpus), 'articles'
+
+@benchmark('db_load')
+def db_load_benchmark(corpus, workdir):
+    with sqlite_database(workdir, 'load.db') as db:
+        store_corpus(db, corpus)
+        db.clear_caches()
+        def run():
+            for a in db.iter_articles(with_text=True):
+                pass
+        yield run, len(corpus), 'articles'
+
+@benchmark('feed_poll')
+def feed_poll_benchmark(corpus, workdir):
+    from feed_poller import poll_feeds
+    runs = iter(range(sys.maxsize))
+    with FixtureServer(corpus) as server:
+        def run():
+            # A fresh validator store each run, so every feed is fetched and parsed
+            poll_feeds(server.feed_urls(), lambda url, feed: None, state_file=os.path.join(workdir, 'feeds%d' % next(runs)))
+        yield run, corpus.num_publishers, 'feeds'
+
+@benchmark('extract')
+def extract_benchmark(corpus, workdir):
+    from article_extractor import extract_articles
+    # Every run has to download again
+    with FixtureServer(corpus) as server, content_cache_at(None):
+        articles = corpus.articles(server.url)[:500]
+        def run():
+            extracted = []
+            extract_articles(articles, lambda results: extracted.extend(r for r in results if r.ok),
+                             per_domain=8, domain_delay=0, retries=0)
+            if not extracted:
+                raise RuntimeError('no article could be extracted')
+        yield run, len(articles), 'articles'
+
+@benchmark('extract_cached')
+def extract_cached_benchmark(corpus, workdir):
+    from article_extractor import extract_articles
+    with content_cache_at(os.path.join(workdir, 'content_cache'), offline=True) as cache:
+        articles = corpus.articles()
+        for i, a in enumerate(articles):
+            cache.put(a.link, 'text', corpus.raw_text(i))
+        def run():
+            extracted = []
+            extract_articles(articles, lambda results: extracted.extend(r for r in results if r.ok))
+            if len(extracted) != len(articles):
+                raise RuntimeError('only %d of %d articles were read from the cache' % (len(extracted), len(articles)))
+        yield run, len(articles), 'articles'
+
+@benchmark('startup')
+def startup_benchmark(corpus, workdir):
+    from benchmarks.startup import COMMANDS, command_env, time_command
+    env = command_env('sqlite:///' + os.path.join(workdir, 'startup.db'))
+    # Create the schema before timing
+    time_command(COMMANDS['count'], env)
+    def run():
+        time_command(COMMANDS['count'], env)
+    yield run, 1, 'starts'
+
+def measure(run, repeat, memory):
+    """Best and mean wall time of repeat runs, and the peak traced allocation of one more run"""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return min(times), sum(times) / len(times), peak
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(corpus, names, repeat=3, memory=True):
+    """Run the named benchmarks on a corpus and return the results as a dict"""
+    results = OrderedDict()
+    workdir = tempfile.mkdtemp(prefix='benchmarks-')
+    try:
+        for name in names:
+            print('{0:>20}: '.format(name), end='', flush=True)
+            try:
+                with BENCHMARKS[name](corpus, workdir) as (run, items, unit):
+                    best, mean, peak = measure(run, repeat, memory)
+            except Exception as e:
+                print('failed (%s: %s)' % (type(e).__name__, e))
+                results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+                continue
+            results[name] = {'seconds': best, 'mean_seconds': mean, 'items': items, 'unit': unit,
+                             'throughput': items / best if best else None,
+                             'peak_mb': peak / 2**20 if peak is not None else None}
+            print(format_result(results[name]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {'meta': {'created': datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+                     'python': platform.python_version(), 'platform': platform.platform(),
+                     'cpus': os.cpu_count(), 'repeat': repeat, 'corpus': corpus.params},
+            'results': results}
+
+def format_result(result):
+    text = '{0:.4f}s  {1:,.0f} {2}/sec'.format(result['seconds'], result['throughput'] or 0, result['unit'])
+    if result['peak_mb'] is not None:
+        text += '  peak {0:.1f} MB'.format(result['peak_mb'])
+    return text
+
+def compare(old, new, threshold=DEFAULT_THRESHOLD):
+    """ Print the change in throughput and peak memory of every benchmark in
+        both runs. Returns the names of those that regressed beyond threshold."""
+    if old['meta'].get('corpus') != new['meta'].get('corpus'):
+        print('Warning: the runs used different corpus parameters')
+    regressions = []
+    print('{0:>20}  {1:>14}  {2:>14}  {3:>8}  {4:>9}'.format('benchmark', 'old /sec', 'new /sec', 'change', 'peak MB'))
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if before is None or 'error' in before or 'error' in result:
+            continue
+        change = result['throughput'] / before['throughput'] - 1
+        flags = []
+        if change < -threshold:
+            flags.append('SLOWER')
+        peak = ''
+        if before.get('peak_mb') and result.get('peak_mb') is not None:
+            peak = '{0:+.0%}'.format(result['peak_mb'] / before['peak_mb'] - 1)
+            if result['peak_mb'] > before['peak_mb'] * (1 + threshold):
+                flags.append('MORE MEMORY')
+        if flags:
+            regressions.append(name)
+        print('{0:>20}  {1:>14,.0f}  {2:>14,.0f}  {3:>+8.1%}  {4:>9}  {5}'.format(
+            name, before['throughput'], result['throughput'], change, peak, ' '.join(flags)))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark suite on a synthetic corpus (run from the repository root as python3 -m benchmarks.run)')
+    parser.add_argument("benchmarks", nargs='*', help="benchmarks to run (default: all of %s)" % ', '.join(BENCHMARKS))
+    parser.add_argument("-d", "--docs", type=int, default=2000, help="number of documents")
+    parser.add_argument("-v", "--vocab", type=int, default=20000, help="vocabulary size")
+    parser.add_argument("-l", "--doc-length", type=int, default=300, help="mean terms per document")
+    parser.add_argument("-z", "--zipf", type=float, default=1.1, help="Zipf exponent of the term distribution")
+    parser.add_argument("--duplicates", type=float, default=0.05, help="fraction of documents duplicating an earlier one")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="corpus random seed")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="timed runs per benchmark (the best is reported)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the extra traced run that measures peak memory")
+    parser.add_argument("-o", "--output", help="results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("-c", "--compare", nargs=2, metavar=('OLD', 'NEW'), help="compare two results files instead of running")
+    parser.add_argument("-t", "--threshold", type=float, default=DEFAULT_THRESHOLD, help="fractional change reported as a regression")
+
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.threshold)
+        if regressions:
+            print('Regressions: %s' % ', '.join(regressions))
+            sys.exit(1)
+        print('No regressions')
+        sys.exit(0)
+
+    unknown = [b for b in args.benchmarks if b not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+    corpus = SyntheticCorpus(args.docs, args.vocab, args.doc_length, args.zipf, args.duplicates, seed=args.seed)
+    print('Corpus: {0} documents, {1} tokens, {2} duplicates'.format(len(corpus), corpus.num_tokens, len(corpus.duplicate_of)))
+    results = run_benchmarks(corpus, args.benchmarks or list(BENCHMARKS), args.repeat, not args.no_memory)
+    output = args.output or os.path.join(RESULTS_DIR, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to %s' % output)
@@ -0,0 +1,95 @@
+""" Startup budget of the quick command line lookups.
+
+    Cron jobs and health checks run commands like "rss_parser.py -c" many times
+    a day, so they must start without loading feedparser, newspaper, nltk, numpy
+    or scipy, and without connecting to the database before it is queried.
+    Run from the repository root; exits with status 1 if a command loads one of
+    those modules or its median wall time is over budget:
+
+        python3 -m benchmarks.startup --budget 0.15"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BUDGET = 0.15
+# Modules only the commands that need them may import
+HEAVY_MODULES = ('feedparser', 'newspaper', 'nltk', 'numpy', 'scipy')
+COMMANDS = OrderedDict([
+    ('count', ['rss_parser.py', '-c']),
+    ('publishers', ['rss_parser.py', '-p']),
+])
+
+# Runs a script like "python3 script.py ...", then reports which heavy modules it imported
+PROBE = """import sys, runpy
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    sys.stderr.write('\\nLOADED %s\\n' % ' '.join(m for m in {0!r} if m in sys.modules))
+""".format(HEAVY_MODULES)
+
+def command_env(database=None):
+    env = dict(os.environ)
+    if database is not None:
+        env['ARTICLE_DB'] = database
+    return env
+
+def time_command(args, env):
+    """Wall time of one run of a command in a fresh interpreter"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def loaded_modules(args, env):
+    """The heavy modules a command imports"""
+    result = subprocess.run([sys.executable, '-c', PROBE] + args, cwd=ROOT, env=env, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    line = [l for l in result.stderr.splitlines() if l.startswith('LOADED')][-1]
+    return line.split()[1:]
+
+def check_startup(budget=DEFAULT_BUDGET, repeat=5, database=None):
+    """ Time every command and check what it imports. Returns the names of
+        the commands that failed."""
+    failed = []
+    for name, args in COMMANDS.items():
+        env = command_env(database)
+        # The first run also creates an embedded database's schema
+        time_command(args, env)
+        times = sorted(time_command(args, env) for _ in range(repeat))
+        median = times[len(times) // 2]
+        heavy = loaded_modules(args, env)
+        problems = []
+        if median > budget:
+            problems.append('over budget')
+        if heavy:
+            problems.append('imports %s' % ', '.join(heavy))
+        print('{0:>12}: {1:.0f} ms median of {2}  {3}'.format(name, median * 1000, repeat, '; '.join(problems) or 'ok'))
+        if problems:
+            failed.append(name)
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the startup time and imports of quick command line lookups')
+    parser.add_argument("-b", "--budget", type=float, default=DEFAULT_BUDGET, help="max median wall time per command in seconds")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="timed runs per command")
+    parser.add_argument("--database", help="database URL to run against (default: ARTICLE_DB if set, otherwise an empty embedded database)")
+
+    args = parser.parse_args()
+    database = args.database
+    workdir = None
+    if database is None and 'ARTICLE_DB' not in os.environ:
+        workdir = tempfile.mkdtemp(prefix='startup-')
+        database = 'sqlite:///' + os.path.join(workdir, 'startup.db')
+    failed = check_startup(args.budget, args.repeat, database)
+    if workdir is not None:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        print('Failed: %s' % ', '.join(failed))
+        sys.exit(1)
+    print('All commands within %.0f ms' % (args.budget * 1000))
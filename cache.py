@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+import metrics
+
+# Every cache by name, for stats()
+caches = {}
+MISSING = object()
+
+class LRUCache:
+    """ Thread-safe mapping bounded by size and optionally by entry age.
+
+        The least recently used entry is evicted once maxsize is reached, and
+        entries older than ttl seconds are dropped when next looked up. Hits,
+        misses, evictions and expirations are counted for stats() and, when
+        metrics are enabled, recorded as cache_lookups and cache_evictions."""
+
+    def __init__(self, name, maxsize, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        caches[name] = self
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING, count=False) is not MISSING
+
+    def get(self, key, default=None, count=True):
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is not MISSING and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = MISSING
+            if entry is MISSING:
+                if count:
+                    self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+        if count:
+            metrics.inc('cache_lookups', cache=self.name, result='miss' if entry is MISSING else 'hit')
+        return default if entry is MISSING else entry[0]
+
+    def set(self, key, value):
+        evicted = 0
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            metrics.inc('cache_evictions', evicted, cache=self.name)
+
+    def update(self, items):
+        for key, value in items:
+            self.set(key, value)
+
+    def invalidate(self, *keys):
+        """Drop the given keys, e.g. after the values behind them were written"""
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations, 'hit_rate': self.hits / lookups if lookups else None}
+
+def cached(cache, key=None, unless=None):
+    """ Decorator memoizing a function in an LRUCache, under key(*args) or
+        the arguments themselves. Results for which unless(result) is true,
+        such as "not found" markers, are returned without being cached."""
+    def decorate(f):
+        @wraps(f)
+        def wrapper(*args):
+            k = key(*args) if key is not None else args
+            value = cache.get(k, MISSING)
+            if value is MISSING:
+                value = f(*args)
+                if unless is None or not unless(value):
+                    cache.set(k, value)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorate
+
+def stats():
+    """Stats of every cache by name"""
+    return {name: c.stats() for name, c in caches.items()}
+
+def format_stats():
+    lines = []
+    for name, s in sorted(stats().items()):
+        rate = '-' if s['hit_rate'] is None else '{0:.1%}'.format(s['hit_rate'])
+        lines.append('{0:>24}: {1}/{2} entries, {3} hits, {4} misses ({5} hit rate), {6} evicted, {7} expired'.format(
+            name, s['size'], s['maxsize'], s['hits'], s['misses'], rate, s['evictions'], s['expirations']))
+    return '\n'.join(lines)
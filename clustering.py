@@ -0,0 +1,123 @@
+import numpy
+from scipy import sparse
+from vectorizer import normalize_rows
+
+def reservoir_sample(n, k, rng):
+    """Indices of k elements sampled uniformly from range(n) in one pass (Algorithm R)"""
+    reservoir = numpy.arange(min(k, n))
+    for i in range(k, n):
+        j = rng.integers(0, i + 1)
+        if j < k:
+            reservoir[j] = i
+    return reservoir
+
+def unit_rows(vectors):
+    """Normalize sparse or dense document vectors to unit length"""
+    if sparse.issparse(vectors):
+        return normalize_rows(sparse.csr_matrix(vectors, dtype=numpy.float64))
+    vectors = numpy.asarray(vectors, dtype=numpy.float64)
+    lengths = numpy.linalg.norm(vectors, axis=1)
+    lengths[lengths == 0] = 1.0
+    return vectors / lengths[:, None]
+
+def dense_rows(vectors, rows):
+    """Copy a selection of rows as a dense array"""
+    selected = vectors[rows]
+    return selected.toarray() if sparse.issparse(selected) else numpy.array(selected)
+
+def cosine_similarities(vectors, centroids):
+    """(docs x centroids) cosine similarities of unit document vectors and unit centroids"""
+    return numpy.asarray(vectors @ centroids.T)
+
+def normalize_centroids(centroids):
+    lengths = numpy.linalg.norm(centroids, axis=1)
+    lengths[lengths == 0] = 1.0
+    return centroids / lengths[:, None]
+
+def k_means_plus_plus(vectors, k, rng):
+    """ Choose k starting centroids, each sampled with probability proportional
+        to its squared distance from the closest centroid chosen so far"""
+    n = vectors.shape[0]
+    chosen = [rng.integers(n)]
+    closest = 2.0 - 2.0 * cosine_similarities(vectors, dense_rows(vectors, chosen)).ravel()
+    for _ in range(1, k):
+        weights = numpy.clip(closest, 0, None)
+        total = weights.sum()
+        i = rng.choice(n, p=weights / total) if total > 0 else rng.integers(n)
+        chosen.append(i)
+        distances = 2.0 - 2.0 * cosine_similarities(vectors, dense_rows(vectors, [i])).ravel()
+        numpy.minimum(closest, distances, out=closest)
+    return dense_rows(vectors, chosen)
+
+def initial_centroids(vectors, k, init, rng):
+    if init == 'k-means++':
+        return k_means_plus_plus(vectors, k, rng)
+    elif init == 'random':
+        return dense_rows(vectors, reservoir_sample(vectors.shape[0], k, rng))
+    raise ValueError("Unknown centroid initialization: %s" % init)
+
+def cluster_sums(vectors, labels, k):
+    """Sum of the document vectors assigned to each of the k clusters"""
+    n = vectors.shape[0]
+    membership = sparse.csr_matrix((numpy.ones(n), (labels, numpy.arange(n))), shape=(k, n))
+    sums = membership @ vectors
+    return sums.toarray() if sparse.issparse(sums) else numpy.asarray(sums)
+
+def k_means(document_vectors, k, max_updates=100, init='k-means++', seed=None):
+    """ Spherical k-means over (docs x terms) document vectors, sparse or dense.
+
+        Documents are compared by cosine similarity, which suits normalized
+        tf-idf vectors. Returns (labels, centroids): the cluster index of each
+        document and a dense (k x terms) array of unit-length centroids."""
+    vectors = unit_rows(document_vectors)
+    n = vectors.shape[0]
+    assert n >= k, 'More clusters than documents'
+    rng = numpy.random.default_rng(seed)
+
+    centroids = initial_centroids(vectors, k, init, rng)
+    labels = None
+    for _ in range(max_updates):
+        similarities = cosine_similarities(vectors, centroids)
+        new_labels = similarities.argmax(axis=1)
+        if labels is not None and numpy.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        sums = cluster_sums(vectors, labels, k)
+        # Reseed empty clusters with the documents furthest from their centroids
+        empty = numpy.flatnonzero(numpy.bincount(labels, minlength=k) == 0)
+        if len(empty):
+            furthest = numpy.argsort(similarities[numpy.arange(n), labels])[:len(empty)]
+            sums[empty] = dense_rows(vectors, furthest)
+        centroids = normalize_centroids(sums)
+    return labels, centroids
+
+def mini_batch_k_means(document_vectors, k, batch_size=1024, max_updates=100, tol=1e-4, init='k-means++', seed=None):
+    """ Spherical k-means that updates centroids from random mini-batches of documents.
+
+        Each centroid moves towards the running mean of every document assigned
+        to it so far, so each update costs O(batch_size) instead of O(docs).
+        Stops early once no centroid moves by more than tol in cosine distance.
+        Returns (labels, centroids) like k_means, labelling every document at the end."""
+    vectors = unit_rows(document_vectors)
+    n = vectors.shape[0]
+    assert n >= k, 'More clusters than documents'
+    rng = numpy.random.default_rng(seed)
+
+    seed_rows = rng.choice(n, size=min(n, max(batch_size, 3 * k)), replace=False)
+    centroids = initial_centroids(vectors[seed_rows], k, init, rng)
+    counts = numpy.zeros(k)
+    for _ in range(max_updates):
+        previous = centroids.copy()
+        batch = vectors[rng.choice(n, size=min(n, batch_size), replace=False)]
+        batch_labels = cosine_similarities(batch, centroids).argmax(axis=1)
+        batch_counts = numpy.bincount(batch_labels, minlength=k)
+        updated = batch_counts > 0
+        sums = cluster_sums(batch, batch_labels, k)
+        centroids[updated] = (centroids[updated] * counts[updated, None] + sums[updated]) \
+                             / (counts[updated] + batch_counts[updated])[:, None]
+        counts += batch_counts
+        centroids = normalize_centroids(centroids)
+        if (1.0 - (previous * centroids).sum(axis=1)).max() < tol:
+            break
+    labels = cosine_similarities(vectors, centroids).argmax(axis=1)
+    return labels, centroids
@@ -0,0 +1,5 @@
+# Settings shared by the command line and the modules behind it. Kept free of
+# heavy imports so quick lookups can read them without loading numpy or scipy.
+
+# Ways search_index can rank keyword search results
+SCORINGS = ('bm25', 'cosine')
@@ -0,0 +1,197 @@
+import os
+import gzip
+import hashlib
+import threading
+import time
+import argparse
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import metrics
+
+CACHE_DIR = 'content_cache'
+DEFAULT_MAX_BYTES = 2 * 2**30
+# Eviction removes the least recently used entries until the cache is this fraction of its cap
+LOW_WATER = 0.9
+KINDS = {'html': '.html.gz', 'text': '.txt.gz'}
+# Query parameters that only track where a reader came from, besides any utm_*
+TRACKING_PARAMS = frozenset(['fbclid', 'gclid', 'ocid', 'cmpid', 'mc_cid', 'mc_eid', 'smid', 'ref'])
+
+class NotCached(LookupError):
+    """A page was needed from the network while the content cache is offline"""
+
+def normalize_url(url):
+    """ Key for a page's URL: http and https, a leading www., default ports,
+        the fragment, tracking parameters and the query parameter order are
+        ignored. """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    if parts.port and parts.port not in (80, 443):
+        host += ':%d' % parts.port
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if not (k.lower().startswith('utm_') or k.lower() in TRACKING_PARAMS))
+    return host + (parts.path or '/') + ('?' + urlencode(query) if query else '')
+
+class ContentCache:
+    """ Compressed raw HTML and extracted text of downloaded pages on disk.
+
+        Entries are gzipped files named by the SHA-256 of the normalized URL,
+        spread over 256 subdirectories. Reading an entry touches its
+        modification time, and once the cache grows past max_bytes the least
+        recently used entries are removed. The sizes are scanned from disk on
+        first use, so several processes can share a directory; each one only
+        accounts for its own writes between scans. A cache with no directory
+        stores nothing. When offline, pages missing from the cache raise
+        NotCached instead of being downloaded."""
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.entries = None
+        self.total_bytes = 0
+        self.hits = self.misses = self.writes = self.evictions = 0
+
+    def path(self, url, kind):
+        key = hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key + KINDS[kind])
+
+    def scan(self):
+        """Size and last use of every entry, read from disk once"""
+        if self.entries is None:
+            self.entries = {}
+            self.total_bytes = 0
+            if os.path.isdir(self.directory):
+                for sub in os.scandir(self.directory):
+                    if not sub.is_dir():
+                        continue
+                    for entry in os.scandir(sub.path):
+                        if entry.name.endswith(tuple(KINDS.values())):
+                            stat = entry.stat()
+                            self.entries[entry.path] = [stat.st_size, stat.st_mtime]
+                            self.total_bytes += stat.st_size
+        return self.entries
+
+    def has(self, url, kind='text'):
+        return self.directory is not None and os.path.exists(self.path(url, kind))
+
+    def get(self, url, kind='text'):
+        """The cached content of a page, or None"""
+        if self.directory is None:
+            return None
+        path = self.path(url, kind)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                content = f.read()
+        except (FileNotFoundError, EOFError, OSError):
+            content = None
+        with self.lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                now = time.time()
+                if self.entries is not None and path in self.entries:
+                    self.entries[path][1] = now
+        metrics.inc('content_cache_lookups', kind=kind, result='miss' if content is None else 'hit')
+        if content is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return content
+
+    def put(self, url, kind, content):
+        """Store a page's content, evicting old entries if the cache is over its cap"""
+        if self.directory is None or content is None:
+            return
+        path = self.path(url, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            entries = self.scan()
+            old = entries.get(path)
+            self.total_bytes += size - (old[0] if old else 0)
+            entries[path] = [size, time.time()]
+            self.writes += 1
+            over = self.total_bytes > self.max_bytes
+        metrics.inc('content_cache_writes', kind=kind)
+        if over:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is under LOW_WATER of its cap"""
+        with self.lock:
+            entries = self.scan()
+            target = self.max_bytes * LOW_WATER
+            removed = 0
+            for path, (size, _) in sorted(entries.items(), key=lambda e: e[1][1]):
+                if self.total_bytes <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                del entries[path]
+                self.total_bytes -= size
+                removed += 1
+            self.evictions += removed
+        metrics.inc('content_cache_evictions', removed)
+        return removed
+
+    def clear(self):
+        with self.lock:
+            for path in list(self.scan()):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.entries = {}
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            entries = self.scan() if self.directory is not None else {}
+            return {'directory': self.directory, 'entries': len(entries), 'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes, 'offline': self.offline, 'hits': self.hits,
+                    'misses': self.misses, 'writes': self.writes, 'evictions': self.evictions}
+
+# Set ARTICLE_CACHE_DIR to move the cache, or to an empty string to turn it off
+cache = ContentCache(os.environ.get('ARTICLE_CACHE_DIR', CACHE_DIR) or None,
+                     int(os.environ.get('ARTICLE_CACHE_MB', DEFAULT_MAX_BYTES // 2**20)) * 2**20,
+                     os.environ.get('ARTICLE_OFFLINE', '') not in ('', '0'))
+
+def configure(directory=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+    """Replace the shared cache, e.g. configure(None) to turn it off"""
+    global cache
+    cache = ContentCache(directory, max_bytes, offline)
+    return cache
+
+def add_arguments(parser):
+    """Add the --offline, --cache-dir and --cache-size options to a command line parser"""
+    parser.add_argument("--offline", action="store_true", help="never download; only process pages already in the content cache")
+    parser.add_argument("--cache-dir", default=cache.directory, help="content cache directory (default: %(default)s)")
+    parser.add_argument("--cache-size", type=int, default=cache.max_bytes // 2**20, help="content cache size cap in MB")
+
+def from_arguments(args):
+    return configure(args.cache_dir or None, args.cache_size * 2**20, args.offline or cache.offline)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or trim the on-disk content cache of article pages')
+    add_arguments(parser)
+    parser.add_argument("--evict", action="store_true", help="remove least recently used entries until under the size cap")
+    parser.add_argument("--clear", action="store_true", help="remove every entry")
+
+    args = parser.parse_args()
+    c = from_arguments(args)
+    if args.clear:
+        c.clear()
+    elif args.evict and c.stats()['bytes'] > c.max_bytes:
+        print('Evicted %s entries' % c.evict())
+    s = c.stats()
+    print('{0}: {1} entries, {2:.1f} of {3:.0f} MB'.format(s['directory'], s['entries'], s['bytes'] / 2**20, s['max_bytes'] / 2**20))
@@ -1,49 +1,121 @@
-import psycopg2
+import os
+import json
+import threading
+from math import log10
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
 from contextlib import contextmanager
+from collections import Counter, namedtuple
 from article import *
+from storage import backend_from_url, DEFAULT_DATABASE
+from cache import LRUCache, cached
+import metrics
 import atexit
+import importlib
+# numpy and dedup are only imported once needed, so commands that only count
+# or list articles don't pay for loading them
 
-db_conn = psycopg2.connect("dbname=article_db user=postgres")
-db_conn.autocommit = True
+class LazyModule:
+    """Stands in for a module, importing it the first time one of its attributes is looked up"""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+numpy = LazyModule('numpy')
+
+# Set ARTICLE_DB to a database URL, e.g. sqlite:///articles.db, to use an embedded database instead of Postgres
+backend = backend_from_url(os.environ.get('ARTICLE_DB', DEFAULT_DATABASE))
+
+# Rows per multi-row VALUES statement in the batch inserts
+BATCH_PAGE_SIZE = 1000
+# Rows fetched per round trip when streaming articles
+DEFAULT_ITERSIZE = 2000
+# Set ARTICLE_DEDUP=0 to store every copy of syndicated stories
+detect_duplicates = os.environ.get('ARTICLE_DEDUP', '1') != '0'
+# Only canonical articles published this recently are compared against new ones
+DUPLICATE_WINDOW_DAYS = 14
+ARTICLE_ID_CACHE_SIZE = 100000
+# Terms cached in each direction; term ids never change once assigned, so this
+# only bounds memory. It comfortably holds the working vocabulary of a batch.
+TERM_CACHE_SIZE = 200000
+
+# Latency of each function that queries the db, labelled with its name
+timed_query = metrics.timed('db_query_seconds')
+
+def configure(url):
+    """Switch to the database at url, e.g. sqlite:///articles.db or a Postgres URL"""
+    global backend
+    backend.close()
+    backend = backend_from_url(url)
+    clear_caches()
+
+def clear_caches():
+    """Forget everything cached from the database, e.g. after switching to another one"""
+    global detector
+    article_id_cache.clear()
+    term_id_cache.clear()
+    term_cache.clear()
+    detector = None
 
 @atexit.register
 def close_db():
-    db_conn.close()
+    backend.close()
+
+def cursor():
+    """Cursor on the calling thread's connection"""
+    return backend.cursor()
+
+def execute(curr, query, args=None):
+    backend.execute(curr, query, args)
+
+def transaction():
+    """ Run several statements atomically on the calling thread's connection.
+        Yields a cursor; commits on success and rolls back on any exception."""
+    return backend.transaction()
+
+def execute_values(curr, query, rows, page_size=BATCH_PAGE_SIZE, fetch=False):
+    """Run an "INSERT ... VALUES %s" query for many rows with multi-row VALUES statements"""
+    return backend.execute_values(curr, query, rows, page_size, fetch)
 
 def perform_query(query, args=None):
-    """Submit a query with any necessary args for a single result"""
+    """Submit a query with any necessary args for a single result.
+       Returns (-1,) if the query matched no rows."""
     ret = (-1,)
-   
-    with db_conn.cursor() as curr:
-        if args:
-            curr.execute(query, args)    
-        else:
-            curr.execute(query)
-        try:
-            ret = curr.fetchone()
-            #db_conn.commit()
-        except psycopg2.ProgrammingError: # No result produced
+
+    with cursor() as curr:
+        execute(curr, query, args)
+        if curr.description is None: # No result produced
             ret = (curr.rowcount,)
-            #db_conn.rollback()
-        #curr.close()
+        else:
+            ret = curr.fetchone() or ret
     return ret
 
-def memoize(f):
-    memo = {}
-    def helper(x):
-        if not x in memo:
-            memo[x] = f(x)
-        return memo[x]
-    return helper
+# article_id of recently looked up links. Article rows are never deleted, not by
+# clear_processed or expiry either, so a link keeps its id and entries need no
+# expiry or invalidation; the size only bounds memory.
+article_id_cache = LRUCache('article_ids', ARTICLE_ID_CACHE_SIZE)
 
-@memoize
-def get_article_id(article):
-    """ Gets the table article_id given an article object.
-        Uses in-memory dict for multiple requests to the same article."""
+@cached(article_id_cache, key=lambda link: link, unless=lambda id: id < 1)
+@timed_query
+def get_article_id_by_link(link):
+    """ article_id of a stored link, or -1. Cached by link; -1 never is, so
+        an article stored later is found on the next lookup. """
     query = "SELECT article_id FROM articles WHERE link = %s;"
-    return perform_query(query, (article.link,))[0]
+    return perform_query(query, (link,))[0]
 
+def get_article_id(article):
+    """Gets the table article_id given an article object"""
+    if article.article_id is not None:
+        return article.article_id
+    return get_article_id_by_link(article.link)
+
+@timed_query
 def is_in_table(table, article):
     """ Checks if an article object is in the given table """
     article_id = get_article_id(article)
@@ -52,10 +124,53 @@ def is_in_table(table, article):
     query = "SELECT count(1) FROM {} WHERE article_id = %s;".format(table)
     return perform_query(query, (article_id,))[0] > 0
 
+class ArticleStatus(namedtuple('ArticleStatus', ['article_id', 'filtered', 'failed', 'duplicate', 'expired'])):
+    """Processing state of a stored article"""
+
+    @property
+    def new(self):
+        return not (self.filtered or self.failed or self.duplicate or self.expired)
+
+@timed_query
+def get_article_ids(links):
+    """Map each stored link among the given links to its article_id, querying the uncached ones at once"""
+    ids, missing = {}, []
+    for link in links:
+        id = article_id_cache.get(link)
+        if id is None:
+            missing.append(link)
+        else:
+            ids[link] = id
+    if missing:
+        query = "SELECT link, article_id FROM articles WHERE link = ANY(%s);"
+        with cursor() as curr:
+            execute(curr, query, (missing,))
+            found = curr.fetchall()
+        article_id_cache.update(found)
+        ids.update(found)
+    return ids
+
+@timed_query
+def get_statuses(links):
+    """ Map each stored link among the given links to its ArticleStatus in one query.
+        Links that aren't stored are left out. """
+    query = ("SELECT a.link, a.article_id, f.article_id IS NOT NULL, x.article_id IS NOT NULL, "
+             "d.article_id IS NOT NULL, e.article_id IS NOT NULL "
+             "FROM articles a "
+             "LEFT JOIN filtered_articles f ON f.article_id = a.article_id "
+             "LEFT JOIN failed_articles x ON x.article_id = a.article_id "
+             "LEFT JOIN duplicate_articles d ON d.article_id = a.article_id "
+             "LEFT JOIN expired_articles e ON e.article_id = a.article_id "
+             "WHERE a.link = ANY(%s);")
+    with cursor() as curr:
+        execute(curr, query, (list(links),))
+        return {record[0]: ArticleStatus(record[1], *map(bool, record[2:])) for record in curr}
+
 ######################
 ##  ARTICLES TABLE  ##
 ######################
 
+@timed_query
 def num_articles():
     """Get number of articles in the database"""
     query = "SELECT COUNT(*) FROM articles;"
@@ -66,34 +181,114 @@ def get_url_domain(url):
     parsed = urlparse(url)
     return '{uri.scheme}://{uri.netloc}/'.format(uri=parsed)
 
+@timed_query
 def get_unique_publishers():
     """Get the set of domain names for all articles in the DB"""
     query = "SELECT link FROM articles"
     links = []
-    with db_conn.cursor() as curr:
-        curr.execute(query)
+    with cursor() as curr:
+        execute(curr, query)
         links = [ get_url_domain(record[0]) for record in curr ]
-        db_conn.commit()
-        curr.close()
     return set(links)
 
-def gen_articles():
-    """Create a generator to yield articles from the db"""
-    query = "SELECT * FROM articles;"
-    with db_conn.cursor() as curr:
-        curr.execute(query)
+def publisher_host(publisher):
+    """Host of a publisher given as a domain or as returned by get_unique_publishers, without a leading www."""
+    host = (urlparse(publisher).netloc if '://' in publisher else publisher.strip('/')).lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    return host
+
+def publisher_patterns(publisher):
+    """LIKE patterns for the links of a publisher, over http or https and with or without a leading www."""
+    host = publisher_host(publisher)
+    return ['%://' + host + '/%', '%://www.' + host + '/%']
+
+def iter_articles(fields=ARTICLE_FIELDS, filtered=None, with_text=False, start=None, end=None,
+                  publishers=None, itersize=DEFAULT_ITERSIZE):
+    """ Stream stored articles through one query on a server-side cursor.
+
+        Only the article columns in fields are fetched; the others load on first
+        access. filtered=True keeps filtered articles only, False only articles
+        that are neither filtered, failed, duplicates nor expired. with_text joins in
+        the filtered text. start/end bound the publication date (end exclusive) and
+        publishers limits links to the given domains."""
+    fields = tuple(fields)
+    columns = ['a.article_id'] + ['a.' + f for f in fields]
+    joins, conditions, args = [], [], []
+    if with_text:
+        columns.append('f.filtered_tokens')
+    if with_text or filtered is not None:
+        joins.append("LEFT JOIN filtered_articles f ON f.article_id = a.article_id")
+    if filtered:
+        conditions.append("f.article_id IS NOT NULL")
+    elif filtered is not None:
+        joins.append("LEFT JOIN failed_articles x ON x.article_id = a.article_id")
+        joins.append("LEFT JOIN duplicate_articles d ON d.article_id = a.article_id")
+        joins.append("LEFT JOIN expired_articles e ON e.article_id = a.article_id")
+        conditions.append("f.article_id IS NULL AND x.article_id IS NULL AND d.article_id IS NULL AND e.article_id IS NULL")
+    if start is not None:
+        conditions.append("a.published >= %s")
+        args.append(start)
+    if end is not None:
+        conditions.append("a.published < %s")
+        args.append(end)
+    if publishers:
+        patterns = [pattern for p in publishers for pattern in publisher_patterns(p)]
+        conditions.append('(' + ' OR '.join(["a.link LIKE %s"] * len(patterns)) + ')')
+        args.extend(patterns)
+    query = "SELECT {0} FROM articles a {1}".format(', '.join(columns), ' '.join(joins))
+    if conditions:
+        query += " WHERE " + ' AND '.join(conditions)
+    query += " ORDER BY a.article_id;"
+    with backend.stream(itersize) as curr:
+        execute(curr, query, args)
         for record in curr:
-            a = Article.from_sqlentry(record)
-            if is_filtered(a):
-                a.filtered_text = get_filtered_text(a)
+            a = Article.from_fields(record[0], fields, record[1:len(fields) + 1])
+            if with_text and record[-1] is not None:
+                a.filtered_text = decode_tokens(record[-1])
             yield a
-        db_conn.commit()
-        curr.close()    
+
+@timed_query
+def load_article_fields(article):
+    """Fetch the stored fields an article was loaded without"""
+    query = "SELECT title, description, link, published FROM articles WHERE article_id = %s;"
+    with cursor() as curr:
+        execute(curr, query, (article.article_id,))
+        row = curr.fetchone()
+    if row is None:
+        raise LookupError("No stored article with id %s" % article.article_id)
+    for field, value in zip(ARTICLE_FIELDS, row):
+        try:
+            object.__getattribute__(article, field)
+        except AttributeError:
+            setattr(article, field, value)
+
+def gen_articles():
+    """Create a generator to yield articles from the db"""
+    return iter_articles(with_text=True)
 
 def get_articles():
     """Helper to get all articles currently stored in the db"""
     return [a for a in gen_articles()]
 
+@timed_query
+def get_article_by_link(link):
+    """Get the stored article with the given link, or None"""
+    query = "SELECT * FROM articles WHERE link = %s;"
+    with cursor() as curr:
+        execute(curr, query, (link,))
+        row = curr.fetchone()
+    return Article.from_sqlentry(row) if row else None
+
+@timed_query
+def get_articles_by_id(ids):
+    """Map each of the given article ids to its stored article"""
+    query = "SELECT * FROM articles WHERE article_id = ANY(%s);"
+    with cursor() as curr:
+        execute(curr, query, ([int(i) for i in ids],))
+        return {record[0]: Article.from_sqlentry(record) for record in curr}
+
+@timed_query
 def add_article(article):
     """ Adds an article entry with the table data:
 
@@ -102,16 +297,38 @@ def add_article(article):
     link (TEXT): URL to article
     published (DATE): publication date of article
     """
-    if not get_article_id(article):
+    query = ("INSERT INTO articles (title, description, link, published) VALUES (%s, %s, %s, %s) "
+             "ON CONFLICT (link) DO NOTHING RETURNING article_id;")
+    id = perform_query(query, article.sql_entry())[0]
+    if id < 1:
         return 0
-    query = "INSERT INTO articles (null, title, description, link, published) VALUES (%s, %s, %s, %s) ;"
-    args = (article.title, article.description, article.link, article.published)
-    return perform_query(query, args)[0]
+    article_id_cache.set(article.link, id)
+    metrics.inc('articles_added')
+    add_title_duplicates([(id, article)])
+    return 1
+
+@timed_query
+def add_articles(articles):
+    """ Adds many article entries in one statement, skipping links already stored.
+        New articles whose title nearly matches an earlier one are recorded as duplicates. """
+    query = ("INSERT INTO articles (title, description, link, published) VALUES %s "
+             "ON CONFLICT (link) DO NOTHING RETURNING article_id, link;")
+    articles = {a.link: a for a in articles}
+    rows = [a.sql_entry() for a in articles.values()]
+    if not rows:
+        return 0
+    with cursor() as curr:
+        inserted = execute_values(curr, query, rows, page_size=BATCH_PAGE_SIZE, fetch=True)
+    article_id_cache.update((link, id) for id, link in inserted)
+    metrics.inc('articles_added', len(inserted))
+    add_title_duplicates((id, articles[link]) for id, link in inserted)
+    return len(inserted)
 
 ###################
 ##  FAILED TABLE ##
 ###################
 
+@timed_query
 def add_to_failed(article):
     """ Adds an article to the failed table if we can't parse it"""
     query  = "INSERT INTO failed_articles(article_id, fail_date) VALUES (%s, %s);"
@@ -119,85 +336,591 @@ def add_to_failed(article):
     if has_failed(article) or id < 1:
         return -1
     args = (id, article.published)
-    return perform_query(query, args)[0]
+    failed = perform_query(query, args)[0]
+    metrics.inc('articles_failed', max(failed, 0))
+    return failed
+
+@timed_query
+def add_all_to_failed(articles):
+    """ Adds many articles to the failed table at once """
+    query = "INSERT INTO failed_articles(article_id, fail_date) VALUES %s ON CONFLICT (article_id) DO NOTHING;"
+    ids = get_article_ids(a.link for a in articles)
+    rows = [(ids[a.link], a.sql_entry()[-1]) for a in articles if a.link in ids]
+    if not rows:
+        return 0
+    with cursor() as curr:
+        failed = execute_values(curr, query, rows, page_size=BATCH_PAGE_SIZE)
+    metrics.inc('articles_failed', failed)
+    return failed
 
 def has_failed(article):
     """ Checks if an article has already failed parsing """
     return is_in_table('failed_articles', article)
 
+#######################
+## DUPLICATES TABLES ##
+#######################
+
+# Fingerprints of recent canonical articles, loaded from the db on first use
+detector = None
+detector_lock = threading.Lock()
+
+def to_signed(fingerprint):
+    """Store an unsigned 64-bit fingerprint in a signed BIGINT column"""
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+def encode_signature(signature):
+    return numpy.asarray(signature, dtype='<u4').tobytes()
+
+def decode_signature(blob):
+    return numpy.frombuffer(blob, dtype='<u4')
+
+def iter_fingerprints(since=None, itersize=DEFAULT_ITERSIZE):
+    """Stream (article_id, simhash, signature) of canonical articles published since a date, or all of them"""
+    query = ("SELECT p.article_id, p.simhash, p.minhash FROM article_fingerprints p "
+             "JOIN articles a ON a.article_id = p.article_id")
+    args = []
+    if since is not None:
+        query += " WHERE a.published IS NULL OR a.published >= %s"
+        args.append(since)
+    with backend.stream(itersize) as curr:
+        execute(curr, query + ";", args)
+        for id, fingerprint, signature in curr:
+            yield (id, to_unsigned(fingerprint) if fingerprint is not None else None,
+                   decode_signature(signature) if signature is not None else None)
+
+def duplicate_detector():
+    """The shared DuplicateDetector, loaded with the canonical articles of the last DUPLICATE_WINDOW_DAYS"""
+    global detector
+    from dedup import DuplicateDetector
+    with detector_lock:
+        if detector is None:
+            detector = DuplicateDetector()
+            detector.load(iter_fingerprints(datetime.now() - timedelta(days=DUPLICATE_WINDOW_DAYS)))
+        return detector
+
+def store_duplicates(curr, duplicates):
+    """Record (article_id, canonical_id, method, similarity) rows inside a transaction"""
+    query = ("INSERT INTO duplicate_articles (article_id, canonical_id, method, similarity) VALUES %s "
+             "ON CONFLICT (article_id) DO NOTHING;")
+    execute_values(curr, query, duplicates, page_size=BATCH_PAGE_SIZE)
+    for method in set(d[2] for d in duplicates):
+        metrics.inc('articles_duplicate', sum(1 for d in duplicates if d[2] == method), method=method)
+
+@timed_query
+def add_title_duplicates(new_articles):
+    """ Fingerprint the titles and descriptions of newly stored (article_id,
+        article) pairs. Those nearly matching an earlier canonical article are
+        recorded as its duplicates, so they are never downloaded. Returns the
+        number of duplicates found."""
+    if not detect_duplicates:
+        return 0
+    from dedup import title_tokens, simhash
+    detector = duplicate_detector()
+    fingerprints, duplicates = [], []
+    for id, a in new_articles:
+        tokens = set(title_tokens(a.title, a.description))
+        fingerprint = simhash(tokens)
+        if fingerprint is None:
+            continue
+        match = detector.check_title(id, fingerprint, len(tokens))
+        if match is None:
+            fingerprints.append((id, to_signed(fingerprint)))
+        else:
+            duplicates.append((id, match[0], 'simhash', match[1]))
+    if fingerprints or duplicates:
+        with transaction() as curr:
+            execute_values(curr, "INSERT INTO article_fingerprints (article_id, simhash) VALUES %s ON CONFLICT (article_id) DO NOTHING;",
+                           fingerprints, page_size=BATCH_PAGE_SIZE)
+            store_duplicates(curr, duplicates)
+    return len(duplicates)
+
+@timed_query
+def record_text_duplicates(articles):
+    """ MinHash the filtered text of freshly extracted articles. Those nearly
+        matching an earlier canonical article are recorded as its duplicates
+        instead of being filtered; the rest are returned. """
+    articles = list(articles)
+    if not detect_duplicates or not articles:
+        return articles
+    detector = duplicate_detector()
+    ids = get_article_ids(a.link for a in articles)
+    canonical, signatures, duplicates = [], [], []
+    for a in articles:
+        id = ids.get(a.link)
+        signature = detector.signature(a.filtered_text) if id is not None else None
+        match = detector.check_text(id, signature) if signature is not None else None
+        if match is None:
+            canonical.append(a)
+            if signature is not None:
+                signatures.append((id, encode_signature(signature)))
+        else:
+            duplicates.append((id, match[0], 'minhash', match[1]))
+    if signatures or duplicates:
+        with transaction() as curr:
+            execute_values(curr, "INSERT INTO article_fingerprints (article_id, minhash) VALUES %s "
+                                 "ON CONFLICT (article_id) DO UPDATE SET minhash = EXCLUDED.minhash;",
+                           signatures, page_size=BATCH_PAGE_SIZE)
+            if duplicates:
+                # Duplicates stop being canonical for later titles too
+                execute(curr, "DELETE FROM article_fingerprints WHERE article_id = ANY(%s);", ([d[0] for d in duplicates],))
+            store_duplicates(curr, duplicates)
+    return canonical
+
+def backfill_duplicates():
+    """ Fingerprint every stored article in id order, as if each had just
+        arrived, for a database filled before duplicates were detected.
+        Filtered articles are compared by text and the duplicates among them
+        are removed from the filtered table and document frequencies, so the
+        next document matrix leaves them out. The others are compared by
+        title. Returns the number of duplicates found."""
+    global detector
+    from dedup import DuplicateDetector, title_fingerprint
+    with detector_lock:
+        detector = DuplicateDetector()
+    with cursor() as curr:
+        execute(curr, "DELETE FROM article_fingerprints;")
+        execute(curr, "SELECT article_id FROM duplicate_articles;")
+        known = set(r[0] for r in curr)
+        execute(curr, "SELECT article_id FROM articles ORDER BY article_id;")
+        ids = [r[0] for r in curr if r[0] not in known]
+    found = 0
+    for start in range(0, len(ids), BATCH_PAGE_SIZE):
+        chunk = ids[start:start + BATCH_PAGE_SIZE]
+        articles = get_articles_by_id(chunk)
+        texts = get_filtered_texts(chunk)
+        filtered = []
+        for id, text in texts.items():
+            articles[id].filtered_text = text
+            filtered.append(articles[id])
+        canonical = record_text_duplicates(filtered)
+        kept = set(a.article_id for a in canonical)
+        for a in filtered:
+            if a.article_id not in kept:
+                remove_from_filtered(a)
+        fingerprints = []
+        for a in canonical:
+            fingerprint = title_fingerprint(a.title, a.description)
+            if fingerprint is not None:
+                detector.add_title(a.article_id, fingerprint)
+                fingerprints.append((a.article_id, to_signed(fingerprint)))
+        with cursor() as curr:
+            execute_values(curr, "INSERT INTO article_fingerprints (article_id, simhash) VALUES %s "
+                                 "ON CONFLICT (article_id) DO UPDATE SET simhash = EXCLUDED.simhash;",
+                           fingerprints, page_size=BATCH_PAGE_SIZE)
+        found += len(filtered) - len(canonical)
+        found += add_title_duplicates((id, a) for id, a in articles.items() if id not in texts)
+        metrics.print_progress("Articles fingerprinted", min(start + BATCH_PAGE_SIZE, len(ids)), len(ids))
+    return found
+
+@timed_query
+def get_duplicates(article):
+    """(article, method, similarity) for every recorded duplicate of a canonical article"""
+    query = ("SELECT a.*, d.method, d.similarity FROM duplicate_articles d "
+             "JOIN articles a ON a.article_id = d.article_id WHERE d.canonical_id = %s ORDER BY a.article_id;")
+    with cursor() as curr:
+        execute(curr, query, (get_article_id(article),))
+        return [(Article.from_sqlentry(record[:-2]), record[-2], record[-1]) for record in curr]
+
+@timed_query
+def get_canonical_id(article):
+    """Article id of the canonical article an article duplicates, or -1 if it isn't a duplicate"""
+    query = "SELECT canonical_id FROM duplicate_articles WHERE article_id = %s;"
+    return perform_query(query, (get_article_id(article),))[0]
+
+#################
+## TERMS TABLE ##
+#################
+
+# term_id of recently looked up terms, and the other way round
+term_id_cache = LRUCache('term_ids', TERM_CACHE_SIZE)
+term_cache = LRUCache('terms', TERM_CACHE_SIZE)
+
+def cache_terms(rows):
+    """Cache (term, term_id) rows in both directions"""
+    for term, id in rows:
+        term_id_cache.set(term, id)
+        term_cache.set(id, term)
+
+@timed_query
+def get_term_ids(terms):
+    """ Map each term to its integer id, assigning ids to unseen terms in one batch """
+    terms = set(terms)
+    found = {}
+    for t in terms:
+        id = term_id_cache.get(t)
+        if id is not None:
+            found[t] = id
+    # Sorted so concurrent writers lock the new terms' keys in the same order and can't deadlock
+    missing = sorted(terms.difference(found))
+    if missing:
+        with cursor() as curr:
+            execute_values(curr, "INSERT INTO terms (term) VALUES %s ON CONFLICT (term) DO NOTHING;", [(t,) for t in missing])
+            execute(curr, "SELECT term, term_id FROM terms WHERE term = ANY(%s);", (missing,))
+            rows = curr.fetchall()
+        cache_terms(rows)
+        found.update(rows)
+    return found
+
+@timed_query
+def get_terms(ids):
+    """ Map each term id to its term """
+    ids = set(int(i) for i in ids)
+    found = {}
+    for i in ids:
+        term = term_cache.get(i)
+        if term is not None:
+            found[i] = term
+    missing = list(ids.difference(found))
+    if missing:
+        with cursor() as curr:
+            execute(curr, "SELECT term, term_id FROM terms WHERE term_id = ANY(%s);", (missing,))
+            rows = curr.fetchall()
+        cache_terms(rows)
+        found.update((id, term) for term, id in rows)
+    return found
+
+def encode_ids(ids):
+    """Pack term ids into little-endian int32 bytes"""
+    return numpy.asarray(ids, dtype='<i4').tobytes()
+
+def decode_ids(blob):
+    """Unpack term ids from a binary column straight into an int32 array"""
+    return numpy.frombuffer(blob, dtype='<i4')
+
+def encode_tokens(tokens, ids=None):
+    """Pack a list of terms as their int32 term ids, looking up ids unless given"""
+    ids = ids or get_term_ids(tokens)
+    return numpy.fromiter((ids[t] for t in tokens), dtype='<i4', count=len(tokens)).tobytes()
+
+def decode_tokens(blob):
+    """Unpack a list of terms from their packed term ids"""
+    tokens = decode_ids(blob)
+    terms = get_terms(numpy.unique(tokens))
+    return [terms[i] for i in tokens.tolist()]
+
 ####################
 ## FILTERED TABLE ##
 ####################
 
+@timed_query
 def add_to_filtered(article):
-    """ Adds an article to the filtered table if successfully parsed """
-    query = "INSERT INTO filtered_articles(article_id, filtered_text) VALUES (%s, %s);"
+    """ Adds an article to the filtered table if successfully parsed,
+        counting its terms towards the corpus document frequencies """
+    query = "INSERT INTO filtered_articles(article_id, filtered_tokens) VALUES (%s, %s);"
     id = get_article_id(article)
     if id < 1 or is_filtered(article):
         return -1
-    args = (id, article.filtered_text)
-    return perform_query(query, args)[0]
+    tokens = encode_tokens(article.filtered_text)
+    with transaction() as curr:
+        execute(curr, query, (id, tokens))
+        ret = curr.rowcount
+        update_doc_frequencies(curr, Counter(set(article.filtered_text)), 1)
+    metrics.inc('articles_filtered')
+    return ret
 
-def get_filtered_text(article):
-    """ Gets filtered text if an article has already been processed """
-    if not is_filtered(article):
+@timed_query
+def add_all_to_filtered(articles):
+    """ Adds many parsed articles to the filtered table and the document
+        frequencies in one transaction, skipping articles already filtered """
+    query = ("INSERT INTO filtered_articles(article_id, filtered_tokens) VALUES %s "
+             "ON CONFLICT (article_id) DO NOTHING RETURNING article_id;")
+    ids = get_article_ids(a.link for a in articles)
+    texts = {ids[a.link]: a.filtered_text for a in articles if a.link in ids}
+    if not texts:
+        return 0
+    vocabulary = get_term_ids(t for text in texts.values() for t in text)
+    rows = [(id, encode_tokens(text, vocabulary)) for id, text in texts.items()]
+    with transaction() as curr:
+        inserted = execute_values(curr, query, rows, page_size=BATCH_PAGE_SIZE, fetch=True)
+        term_deltas = Counter()
+        for (id,) in inserted:
+            term_deltas.update(set(texts[id]))
+        update_doc_frequencies(curr, term_deltas, len(inserted))
+    metrics.inc('articles_filtered', len(inserted))
+    return len(inserted)
+
+@timed_query
+def clear_processed(article_ids):
+    """ Delete the filtered text and failure records of articles so they can
+        be processed again, taking the filtered ones out of the document
+        frequencies"""
+    ids = [int(i) for i in article_ids]
+    with transaction() as curr:
+        delete_filtered(curr, ids)
+        execute(curr, "DELETE FROM failed_articles WHERE article_id = ANY(%s);", (ids,))
+
+def delete_filtered(curr, ids):
+    """ Delete the filtered text of articles and subtract them from the
+        document frequencies, in the caller's transaction. Returns the number
+        of filtered articles deleted."""
+    execute(curr, "DELETE FROM filtered_articles WHERE article_id = ANY(%s) RETURNING filtered_tokens;", (ids,))
+    removed = [numpy.unique(decode_ids(tokens)) for (tokens,) in curr.fetchall()]
+    if removed:
+        term_ids, counts = numpy.unique(numpy.concatenate(removed), return_counts=True)
+        terms = get_terms(term_ids)
+        update_doc_frequencies(curr, Counter({terms[i]: -n for i, n in zip(term_ids.tolist(), counts.tolist())}), -len(removed))
+    return len(removed)
+
+@timed_query
+def remove_from_filtered(article):
+    """ Removes an article from the filtered table and the corpus document frequencies """
+    query = "DELETE FROM filtered_articles WHERE article_id = %s RETURNING filtered_tokens;"
+    id = get_article_id(article)
+    if id < 1:
         return -1
-    query = "SELECT filtered_text FROM filtered_articles WHERE article_id = %s;"
+    with transaction() as curr:
+        execute(curr, query, (id,))
+        row = curr.fetchone()
+        if row is None:
+            return 0
+        terms = get_terms(numpy.unique(decode_ids(row[0])))
+        update_doc_frequencies(curr, Counter({t: -1 for t in terms.values()}), -1)
+    return 1
+
+@timed_query
+def get_filtered_tokens(article):
+    """ Gets the term ids of an article's filtered text as an int32 array, or None """
+    query = "SELECT filtered_tokens FROM filtered_articles WHERE article_id = %s;"
     id = get_article_id(article)
     if id < 1:
+        return None
+    row = perform_query(query, (id,))
+    return decode_ids(row[0]) if row[0] != -1 else None
+
+def get_filtered_text(article):
+    """ Gets filtered text if an article has already been processed """
+    tokens = get_filtered_tokens(article)
+    if tokens is None:
         return -1
-    return perform_query(query, (id,))[0]
+    terms = get_terms(numpy.unique(tokens))
+    return [terms[i] for i in tokens.tolist()]
+
+@timed_query
+def get_filtered_token_arrays(article_ids):
+    """Map each filtered article among the given ids to its int32 term id array in one query"""
+    query = "SELECT article_id, filtered_tokens FROM filtered_articles WHERE article_id = ANY(%s);"
+    with cursor() as curr:
+        execute(curr, query, ([int(i) for i in article_ids],))
+        return {id: decode_ids(tokens) for id, tokens in curr}
+
+def get_filtered_texts(article_ids):
+    """Map each filtered article among the given ids to its filtered text in one query"""
+    arrays = get_filtered_token_arrays(article_ids)
+    terms = get_terms(numpy.unique(numpy.concatenate(list(arrays.values())))) if arrays else {}
+    return {id: [terms[i] for i in tokens.tolist()] for id, tokens in arrays.items()}
 
 def is_filtered(article):
     """ Checks if an article has already been successfully filtered """
     return is_in_table('filtered_articles', article)
 
-##################################
-## TF-CALCULATED ARTICLES TABLE ##
-#################################
+###################################
+## DOCUMENT FREQUENCIES TABLE    ##
+###################################
 
-def add_tfs(article, term_frequencies):
-    """ Stores term frequencies for an individual article """
-    query = "INSERT INTO term_frequencies (article_id, term_frequencies) VALUES (%s, %s);"
-    id = get_article_id(article)
-    if has_tfs(article):
-        return -1
-    args = (id, term_frequencies)
-    return perform_query(query, args)[0]
+@timed_query
+def update_doc_frequencies(curr, term_deltas, doc_delta):
+    """ Adds each term's delta to its document frequency and doc_delta to the corpus size.
+        Must run inside transaction() alongside the filtered table change. """
+    # Lock rows in a consistent order so concurrent writers can't deadlock
+    rows = sorted(term_deltas.items())
+    if rows:
+        query = ("INSERT INTO document_frequencies (term, doc_frequency) VALUES %s "
+                 "ON CONFLICT (term) DO UPDATE SET doc_frequency = document_frequencies.doc_frequency + EXCLUDED.doc_frequency;")
+        execute_values(curr, query, rows, page_size=BATCH_PAGE_SIZE)
+        removed = [t for t, delta in rows if delta < 0]
+        if removed:
+            execute(curr, "DELETE FROM document_frequencies WHERE doc_frequency <= 0 AND term = ANY(%s);", (removed,))
+    execute(curr, "UPDATE corpus_stats SET value = value + %s WHERE stat = 'num_docs';", (doc_delta,))
 
-def get_tfs(article):
-    """ Gets the term frequencies for a processed article """
-    query = "SELECT term_frequencies FROM term_frequencies WHERE ( article_id = %s );"
-    if not has_tfs(article):
-        return None
-    id = get_article_id(article)
-    if id < 1:
-        return None
-    return perform_query(query, (id,))[0]
+@timed_query
+def rebuild_doc_frequencies():
+    """ Recounts document frequencies from every filtered article.
+        Only needed once to backfill a database filtered before they were tracked. """
+    id_counts = Counter()
+    num_docs = 0
+    with cursor() as curr:
+        execute(curr, "SELECT filtered_tokens FROM filtered_articles;")
+        for (tokens,) in curr:
+            id_counts.update(numpy.unique(decode_ids(tokens)).tolist())
+            num_docs += 1
+    terms = get_terms(id_counts)
+    with transaction() as curr:
+        execute(curr, "DELETE FROM document_frequencies;")
+        execute_values(curr, "INSERT INTO document_frequencies (term, doc_frequency) VALUES %s;",
+                       [(terms[i], n) for i, n in id_counts.items()])
+        execute(curr, "UPDATE corpus_stats SET value = %s WHERE stat = 'num_docs';", (num_docs,))
 
-def has_tfs(article):
-    return is_in_table('term_frequencies', article)
+@timed_query
+def get_num_docs():
+    """Number of filtered articles counted in the document frequencies"""
+    query = "SELECT value FROM corpus_stats WHERE stat = 'num_docs';"
+    num_docs = perform_query(query)[0]
+    metrics.set_gauge('corpus_documents', num_docs)
+    return num_docs
 
-################################
-## IDF-CALCULATED TERMS TABLE ##
-################################
+def get_doc_frequency(term):
+    query = "SELECT doc_frequency FROM document_frequencies WHERE term = %s;"
+    return max(perform_query(query, (term,))[0], 0)
 
-def add_idf(term, idf):
-    if has_idf(term):
-        return 0
-    query = "INSERT INTO inverse_document_frequencies (term, idf) VALUES (%s, %s);"
-    args = (term, idf)
-    return perform_query(query, args)[0]
+@timed_query
+def get_doc_frequencies(terms=None):
+    """Map each term (or every known term) to its document frequency"""
+    with cursor() as curr:
+        if terms is None:
+            execute(curr, "SELECT term, doc_frequency FROM document_frequencies;")
+        else:
+            execute(curr, "SELECT term, doc_frequency FROM document_frequencies WHERE term = ANY(%s);", (list(terms),))
+        return dict(curr.fetchall())
+
+def idf_from_frequency(doc_frequency, num_docs):
+    """log10(N / (1 + n_t)), the same formula as text_processor.inv_document_frequency"""
+    return log10(num_docs / (1 + doc_frequency)) if num_docs else 0.0
 
-@memoize
 def get_idf(term):
-    query = "SELECT idf FROM inverse_document_frequencies WHERE term = %s;"
-    return perform_query(query, (term,))[0]
+    """Current idf of a term, derived from the maintained document frequencies"""
+    return idf_from_frequency(get_doc_frequency(term), get_num_docs())
+
+def get_idfs(terms=None):
+    """Map each term (or every known term) to its current idf"""
+    num_docs = get_num_docs()
+    return {t: idf_from_frequency(df, num_docs) for t, df in get_doc_frequencies(terms).items()}
+
+###################
+## EXPIRED TABLE ##
+###################
+
+def window_start(days, end=None):
+    """Start of the sliding window covering the last days days before end (default now)"""
+    return (end or datetime.now()) - timedelta(days=days)
+
+def archive_articles(curr, ids, archive):
+    """Write the link, publication date and filtered text of the filtered articles among ids to archive as JSON lines"""
+    query = ("SELECT a.article_id, a.link, a.published, f.filtered_tokens FROM articles a "
+             "JOIN filtered_articles f ON f.article_id = a.article_id "
+             "WHERE a.article_id = ANY(%s) ORDER BY a.article_id;")
+    execute(curr, query, (ids,))
+    rows = curr.fetchall()
+    if not rows:
+        return
+    tokens = [decode_ids(row[3]) for row in rows]
+    terms = get_terms(numpy.unique(numpy.concatenate(tokens)))
+    for row, token_ids in zip(rows, tokens):
+        record = {'article_id': row[0], 'link': row[1], 'published': row[2].isoformat() if row[2] is not None else None,
+                  'filtered_text': [terms[i] for i in token_ids.tolist()]}
+        archive.write(json.dumps(record) + '\n')
+
+@timed_query
+def expire_articles(before, archive=None, batch_size=BATCH_PAGE_SIZE):
+    """ Retention: drop the filtered text and fingerprints of every article
+        published before a date, taking them out of the document frequencies,
+        and record the articles as expired so they are never processed again. The article rows stay, so their links are still
+        recognized when feeds repeat them. If archive is a text file, filtered
+        articles are first written to it (see archive_articles). Returns the
+        number of articles expired."""
+    global detector
+    query = ("SELECT a.article_id FROM articles a "
+             "LEFT JOIN expired_articles e ON e.article_id = a.article_id "
+             "WHERE a.published < %s AND e.article_id IS NULL ORDER BY a.article_id LIMIT %s;")
+    expired = 0
+    while True:
+        with transaction() as curr:
+            execute(curr, query, (before, batch_size))
+            ids = [row[0] for row in curr.fetchall()]
+            if not ids:
+                break
+            if archive is not None:
+                archive_articles(curr, ids, archive)
+            delete_filtered(curr, ids)
+            execute(curr, "DELETE FROM article_fingerprints WHERE article_id = ANY(%s);", (ids,))
+            now = datetime.now()
+            execute_values(curr, "INSERT INTO expired_articles (article_id, expired_date) VALUES %s;", [(id, now) for id in ids])
+        expired += len(ids)
+        metrics.inc('articles_expired', len(ids))
+    if expired:
+        # Fingerprints of expired articles may still be indexed
+        detector = None
+    return expired
+
+######################
+## WORK QUEUE TABLE ##
+######################
+
+# A job whose lease has run out this many times, e.g. because it keeps crashing its worker, is given up
+MAX_JOB_ATTEMPTS = 3
+
+@timed_query
+def enqueue_jobs(article_ids):
+    """ Queue a processing job for each article id. Jobs already pending or
+        leased are left alone and finished ones are queued again. Returns the
+        number of jobs queued."""
+    query = ("INSERT INTO article_jobs (article_id, state, attempts, updated) VALUES %s "
+             "ON CONFLICT (article_id) DO UPDATE SET state = 'pending', worker = NULL, lease_expires = NULL, "
+             "attempts = 0, updated = EXCLUDED.updated WHERE article_jobs.state = 'done';")
+    now = datetime.now()
+    with cursor() as curr:
+        queued = execute_values(curr, query, [(int(id), 'pending', 0, now) for id in article_ids])
+    metrics.inc('jobs_queued', queued)
+    return queued
+
+@timed_query
+def claim_jobs(worker, batch_size, lease_seconds):
+    """ Lease up to batch_size jobs to worker for lease_seconds, taking pending
+        jobs and jobs whose lease expired without being renewed. On Postgres,
+        rows being claimed by other workers are skipped rather than waited for.
+        Jobs that have run out of attempts are marked failed instead. Returns
+        the claimed article ids."""
+    query = ("UPDATE article_jobs SET state = CASE WHEN attempts < %s THEN 'leased' ELSE 'failed' END, "
+             "worker = %s, lease_expires = %s, attempts = attempts + 1, updated = %s "
+             "WHERE article_id IN (SELECT article_id FROM article_jobs "
+             "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < %s) "
+             "ORDER BY article_id LIMIT %s FOR UPDATE SKIP LOCKED) "
+             "RETURNING article_id, state, attempts;")
+    now = datetime.now()
+    with transaction() as curr:
+        execute(curr, query, (MAX_JOB_ATTEMPTS, worker, now + timedelta(seconds=lease_seconds), now, now, batch_size))
+        rows = curr.fetchall()
+    claimed = sorted(id for id, state, _ in rows if state == 'leased')
+    metrics.inc('jobs_claimed', len(claimed))
+    metrics.inc('jobs_reclaimed', sum(1 for _, state, attempts in rows if state == 'leased' and attempts > 1))
+    metrics.inc('jobs_failed', len(rows) - len(claimed))
+    return claimed
+
+@timed_query
+def renew_leases(worker, article_ids, lease_seconds):
+    """ Heartbeat: extend worker's leases on the given jobs. Returns how many
+        it still held; the others were reclaimed after their lease expired."""
+    query = ("UPDATE article_jobs SET lease_expires = %s, updated = %s "
+             "WHERE worker = %s AND state = 'leased' AND article_id = ANY(%s);")
+    now = datetime.now()
+    return perform_query(query, (now + timedelta(seconds=lease_seconds), now, worker, [int(i) for i in article_ids]))[0]
+
+@timed_query
+def complete_jobs(worker, article_ids):
+    """ Mark worker's leased jobs as done. Jobs reclaimed by another worker in
+        the meantime are left to it. Returns the number completed."""
+    query = ("UPDATE article_jobs SET state = 'done', lease_expires = NULL, updated = %s "
+             "WHERE worker = %s AND state = 'leased' AND article_id = ANY(%s);")
+    completed = perform_query(query, (datetime.now(), worker, [int(i) for i in article_ids]))[0]
+    metrics.inc('jobs_completed', completed)
+    return completed
 
-def has_idf(term):
-    query = "SELECT count(1) FROM inverse_document_frequencies WHERE term = %s;"
-    return perform_query(query, (term,))[0]
+@timed_query
+def release_jobs(worker, article_ids, refund=True):
+    """ Hand worker's leased jobs back to the queue right away, e.g. when it
+        stops mid-batch. With refund the claim doesn't count as an attempt, so
+        interrupted workers don't push healthy jobs towards MAX_JOB_ATTEMPTS."""
+    query = ("UPDATE article_jobs SET state = 'pending', worker = NULL, lease_expires = NULL, "
+             "attempts = attempts - %s, updated = %s "
+             "WHERE worker = %s AND state = 'leased' AND article_id = ANY(%s);")
+    return perform_query(query, (1 if refund else 0, datetime.now(), worker, [int(i) for i in article_ids]))[0]
 
-def get_idfs():
-    query = "SELECT idf FROM inverse_document_frequencies;"
-    return perform_query(query)
+@timed_query
+def get_job_counts():
+    """Number of jobs in each state"""
+    with cursor() as curr:
+        execute(curr, "SELECT state, count(*) FROM article_jobs GROUP BY state;")
+        return dict(curr.fetchall())
@@ -0,0 +1,261 @@
+import hashlib
+import threading
+import numpy
+from collections import defaultdict
+from functools import lru_cache
+from text_normalizer import tokenize, filter_tokens
+
+SIMHASH_BITS = 64
+# Title fingerprints at most this many bits apart are near-duplicates. One token
+# added to a typical title and description moves about 5 bits; unrelated ones differ in over 14.
+SIMHASH_DISTANCE = 6
+# With fewer distinct tokens than SHORT_TITLE_TOKENS a single changed token moves
+# 8-10 bits on average, and 6 bits would often pass distinct stories ("X wins
+# final" / "Y wins final") as copies, so short titles only get this much slack.
+SHORT_TITLE_TOKENS = 12
+SHORT_SIMHASH_DISTANCE = 3
+# Titles and descriptions with fewer filtered tokens than this aren't fingerprinted
+MIN_SIMHASH_TOKENS = 6
+NUM_PERMUTATIONS = 128
+# Filtered tokens per shingle of article text
+SHINGLE_SIZE = 3
+# Estimated Jaccard similarity of text shingles at which articles are duplicates
+TEXT_THRESHOLD = 0.8
+# Odd 64-bit multiplier for combining token hashes into shingle hashes
+SHINGLE_MULTIPLIER = numpy.uint64(0x9E3779B97F4A7C15)
+TOKEN_CACHE_SIZE = 100000
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def token_hash(token):
+    """Stable 64-bit hash of a token"""
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def token_hashes(tokens):
+    return numpy.fromiter((token_hash(t) for t in tokens), dtype=numpy.uint64, count=len(tokens))
+
+def simhash(tokens):
+    """ 64-bit SimHash of the set of tokens in a list: each bit is set if most
+        token hashes have it set. Similar token sets give fingerprints that
+        differ in few bits. None if there are too few tokens to be meaningful."""
+    tokens = list(set(tokens))
+    if len(tokens) < MIN_SIMHASH_TOKENS:
+        return None
+    bits = (token_hashes(tokens)[:, None] >> numpy.arange(SIMHASH_BITS, dtype=numpy.uint64)) & numpy.uint64(1)
+    votes = 2 * bits.sum(axis=0, dtype=numpy.int64) - len(tokens)
+    return sum(1 << int(i) for i in numpy.flatnonzero(votes > 0))
+
+def title_tokens(title, description):
+    return filter_tokens(tokenize('%s %s' % (title or '', description or '')))
+
+def title_fingerprint(title, description):
+    """SimHash of the filtered tokens of an article's title and description"""
+    return simhash(title_tokens(title, description))
+
+def simhash_distance(num_tokens):
+    """Bits a fingerprint of num_tokens distinct tokens may differ in from a near-duplicate"""
+    return SHORT_SIMHASH_DISTANCE if num_tokens < SHORT_TITLE_TOKENS else SIMHASH_DISTANCE
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class SimHashIndex:
+    """ Fingerprints looked up by Hamming distance.
+
+        Fingerprints are split into distance + 1 blocks. Two fingerprints that
+        differ in at most distance bits must agree on at least one whole block,
+        so only fingerprints sharing a block with the query are compared. A
+        query can ask for any smaller distance too."""
+
+    def __init__(self, distance=SIMHASH_DISTANCE):
+        self.distance = distance
+        num_blocks = distance + 1
+        bounds = [SIMHASH_BITS * i // num_blocks for i in range(num_blocks + 1)]
+        self.blocks = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self.tables = [defaultdict(list) for _ in self.blocks]
+        self.fingerprints = {}
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __contains__(self, article_id):
+        return article_id in self.fingerprints
+
+    def keys(self, fingerprint):
+        return [(fingerprint >> start) & mask for start, mask in self.blocks]
+
+    def add(self, article_id, fingerprint):
+        if article_id in self.fingerprints:
+            return
+        self.fingerprints[article_id] = fingerprint
+        for table, key in zip(self.tables, self.keys(fingerprint)):
+            table[key].append(article_id)
+
+    def remove(self, article_id):
+        fingerprint = self.fingerprints.pop(article_id, None)
+        if fingerprint is None:
+            return
+        for table, key in zip(self.tables, self.keys(fingerprint)):
+            table[key].remove(article_id)
+            if not table[key]:
+                del table[key]
+
+    def query(self, fingerprint, exclude=None, distance=None):
+        """(article_id, distance) of the closest indexed fingerprint within distance bits, or None"""
+        distance = self.distance if distance is None else min(distance, self.distance)
+        best = None
+        for table, key in zip(self.tables, self.keys(fingerprint)):
+            for article_id in table.get(key, ()):
+                if article_id == exclude:
+                    continue
+                d = hamming_distance(fingerprint, self.fingerprints[article_id])
+                if d <= distance and (best is None or d < best[1]):
+                    best = (article_id, d)
+        return best
+
+class MinHasher:
+    """ MinHash signatures of the SHINGLE_SIZE-token shingles of a text.
+
+        Each of the num_permutations values is the minimum of a random
+        multiply-add-shift hash, the top 32 bits of (a * x + b) mod 2**64,
+        over the text's 32-bit shingle hashes x. The fraction of equal values
+        in two signatures estimates the Jaccard similarity of their shingle
+        sets."""
+
+    def __init__(self, num_permutations=NUM_PERMUTATIONS, shingle_size=SHINGLE_SIZE, seed=1):
+        rng = numpy.random.default_rng(seed)
+        self.a = rng.integers(0, 1 << 64, num_permutations, dtype=numpy.uint64, endpoint=False) | numpy.uint64(1)
+        self.b = rng.integers(0, 1 << 64, num_permutations, dtype=numpy.uint64, endpoint=False)
+        self.shingle_size = shingle_size
+
+    def shingles(self, tokens):
+        """Unique 32-bit hashes of the shingles of a list of tokens"""
+        hashes = token_hashes(tokens)
+        n = max(1, len(hashes) - self.shingle_size + 1)
+        combined = hashes[:n].copy()
+        for j in range(1, min(self.shingle_size, len(hashes))):
+            combined = combined * SHINGLE_MULTIPLIER ^ hashes[j:j + n]
+        return numpy.unique(combined >> numpy.uint64(32))
+
+    def signature(self, tokens):
+        """uint32 MinHash signature of a list of tokens, or None if it is empty"""
+        if not tokens:
+            return None
+        x = self.shingles(tokens)[:, None]
+        return ((x * self.a + self.b) >> numpy.uint64(32)).min(axis=0).astype(numpy.uint32)
+
+def lsh_bands(threshold, num_permutations):
+    """ Bands and rows per band for locality sensitive hashing of signatures.
+
+        Signatures that agree on a whole band become candidates, which happens
+        to pairs of similarity s with probability 1 - (1 - s**rows)**bands. The
+        split whose steepest rise, near (1 / bands) ** (1 / rows), lies closest
+        below the threshold keeps recall high; candidates are verified anyway."""
+    splits = [(num_permutations // rows, rows) for rows in range(1, num_permutations + 1) if num_permutations % rows == 0]
+    below = [s for s in splits if (1 / s[0]) ** (1 / s[1]) <= threshold]
+    return max(below, key=lambda s: (1 / s[0]) ** (1 / s[1])) if below else splits[0]
+
+class MinHashLSH:
+    """ MinHash signatures bucketed by band, for finding the indexed texts
+        whose estimated similarity to a query reaches threshold without
+        comparing against all of them."""
+
+    def __init__(self, threshold=TEXT_THRESHOLD, num_permutations=NUM_PERMUTATIONS):
+        self.threshold = threshold
+        self.bands, self.rows = lsh_bands(threshold, num_permutations)
+        self.buckets = [defaultdict(list) for _ in range(self.bands)]
+        self.signatures = {}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, article_id):
+        return article_id in self.signatures
+
+    def keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, article_id, signature):
+        if article_id in self.signatures:
+            return
+        self.signatures[article_id] = signature
+        for bucket, key in zip(self.buckets, self.keys(signature)):
+            bucket[key].append(article_id)
+
+    def remove(self, article_id):
+        signature = self.signatures.pop(article_id, None)
+        if signature is None:
+            return
+        for bucket, key in zip(self.buckets, self.keys(signature)):
+            bucket[key].remove(article_id)
+            if not bucket[key]:
+                del bucket[key]
+
+    def query(self, signature, exclude=None):
+        """(article_id, similarity) of the most similar indexed text at or above threshold, or None"""
+        candidates = set()
+        for bucket, key in zip(self.buckets, self.keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        candidates.discard(exclude)
+        best = None
+        for article_id in candidates:
+            similarity = float(numpy.mean(self.signatures[article_id] == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (article_id, similarity)
+        return best
+
+class DuplicateDetector:
+    """ Two-stage near-duplicate detection over canonical articles.
+
+        check_title() compares the SimHash of a new article's title and
+        description, so obvious copies can be skipped before they are
+        downloaded. check_text() compares MinHash signatures of filtered text
+        after extraction, so only one article per group is vectorized. Each
+        check indexes the article as canonical if it matches nothing. Safe to
+        share between threads."""
+
+    def __init__(self, distance=SIMHASH_DISTANCE, threshold=TEXT_THRESHOLD, num_permutations=NUM_PERMUTATIONS):
+        self.titles = SimHashIndex(distance)
+        self.texts = MinHashLSH(threshold, num_permutations)
+        self.hasher = MinHasher(num_permutations)
+        self.lock = threading.Lock()
+
+    def load(self, fingerprints):
+        """Index (article_id, simhash, signature) rows of canonical articles; either may be None"""
+        with self.lock:
+            for article_id, fingerprint, signature in fingerprints:
+                if fingerprint is not None:
+                    self.titles.add(article_id, fingerprint)
+                if signature is not None:
+                    self.texts.add(article_id, signature)
+
+    def signature(self, tokens):
+        return self.hasher.signature(tokens)
+
+    def add_title(self, article_id, fingerprint):
+        """Index a title fingerprint as canonical without checking it"""
+        with self.lock:
+            self.titles.add(article_id, fingerprint)
+
+    def check_title(self, article_id, fingerprint, num_tokens=None):
+        """ (canonical_id, similarity) for a title fingerprint, or None once it
+            is indexed as canonical. Given the number of distinct tokens it was
+            made from, short titles are held to a tighter distance (see
+            simhash_distance)."""
+        distance = simhash_distance(num_tokens) if num_tokens is not None else None
+        with self.lock:
+            match = self.titles.query(fingerprint, exclude=article_id, distance=distance)
+            if match is None:
+                self.titles.add(article_id, fingerprint)
+                return None
+        return match[0], 1 - match[1] / SIMHASH_BITS
+
+    def check_text(self, article_id, signature):
+        """(canonical_id, similarity) for a text signature, or None once it is indexed as canonical"""
+        with self.lock:
+            match = self.texts.query(signature, exclude=article_id)
+            if match is None:
+                self.texts.add(article_id, signature)
+            else:
+                # A duplicate can't be the canonical article of later titles either
+                self.titles.remove(article_id)
+        return match
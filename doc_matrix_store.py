@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import time
+import numpy
+from scipy import sparse
+from vectorizer import Vectorizer, widen, used_terms
+
+DOC_MATRIX_DIR = 'doc_matrix'
+FORMAT_VERSION = 1
+CURRENT_FILE = 'CURRENT'
+
+class DocMatrix:
+    """ A stored version of the document matrix, opened lazily and memory-mapped.
+
+        Each version directory holds the raw augmented term frequencies and
+        the tf-idf matrix as separate CSR component .npy files, plus the term
+        vocabulary (in column order), document frequencies and the article id
+        of every row. Arrays are only mapped when first used, and the pages are
+        shared by every process that opens the same version."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format'] != FORMAT_VERSION:
+            raise ValueError("Unsupported document matrix format %s in %s" % (self.manifest['format'], path))
+        self.arrays = {}
+        self._vocabulary = None
+
+    def array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = numpy.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self.arrays[name]
+
+    def csr(self, prefix):
+        shape = (self.manifest['num_docs'], self.manifest['num_terms'])
+        return sparse.csr_matrix((self.array(prefix + '_data'), self.array(prefix + '_indices'), self.array(prefix + '_indptr')),
+                                 shape=shape, copy=False)
+
+    @property
+    def version(self):
+        return self.manifest['version']
+
+    @property
+    def article_ids(self):
+        """Article id of each matrix row"""
+        return self.array('article_ids')
+
+    @property
+    def terms(self):
+        """Term of each matrix column"""
+        return self.array('terms')
+
+    @property
+    def vocabulary(self):
+        if self._vocabulary is None:
+            self._vocabulary = {t: i for i, t in enumerate(self.terms.tolist())}
+        return self._vocabulary
+
+    @property
+    def matrix(self):
+        """Sparse (articles x terms) matrix of unit tf-idf vectors"""
+        return self.csr('tfidf')
+
+    @property
+    def term_frequencies(self):
+        """Sparse (articles x terms) matrix of augmented term frequencies"""
+        return self.csr('tf')
+
+    def vectorizer(self):
+        """A vectorizer that continues counting from this version's corpus"""
+        return Vectorizer(self.vocabulary, self.array('doc_frequencies').tolist(), self.manifest['num_docs'])
+
+def open_doc_matrix(directory=DOC_MATRIX_DIR):
+    """Open the current stored document matrix, or None if none has been stored"""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return DocMatrix(os.path.join(directory, name))
+
+def write_version(directory, version, article_ids, vectorizer, term_frequencies):
+    """Write a new version directory and atomically make it the current one"""
+    name = 'v%d' % version
+    path = os.path.join(directory, name)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    term_frequencies = widen(term_frequencies, len(vectorizer.vocabulary))
+    tf_idf = vectorizer.tf_idf(term_frequencies)
+    arrays = {
+        'tf_data': term_frequencies.data, 'tf_indices': term_frequencies.indices, 'tf_indptr': term_frequencies.indptr,
+        'tfidf_data': tf_idf.data, 'tfidf_indices': tf_idf.indices, 'tfidf_indptr': tf_idf.indptr,
+        'article_ids': numpy.asarray(article_ids, dtype=numpy.int64),
+        'terms': numpy.array(vectorizer.terms(), dtype=str),
+        'doc_frequencies': numpy.frombuffer(vectorizer.doc_frequencies, dtype=numpy.int64).copy(),
+    }
+    for array_name, array in arrays.items():
+        numpy.save(os.path.join(tmp_path, array_name + '.npy'), array)
+    manifest = {'format': FORMAT_VERSION, 'version': version, 'created': time.time(),
+                'num_docs': term_frequencies.shape[0], 'num_terms': term_frequencies.shape[1], 'nnz': tf_idf.nnz}
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+    current_tmp = os.path.join(directory, CURRENT_FILE + '.tmp')
+    with open(current_tmp, 'w') as f:
+        f.write(name)
+    os.replace(current_tmp, os.path.join(directory, CURRENT_FILE))
+    remove_old_versions(directory, version)
+    return DocMatrix(path)
+
+def remove_old_versions(directory, version, keep=1):
+    """Delete versions older than the previous `keep` ones; open maps of them stay valid"""
+    for name in os.listdir(directory):
+        if name.startswith('v') and name[1:].isdigit() and int(name[1:]) < version - keep:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+def drop_rows(current, article_ids, vectorizer):
+    """ The article ids and term frequencies of a stored version without the
+        rows of articles not among article_ids. Their document frequencies are
+        subtracted from the version's vectorizer and terms left in no article
+        are dropped from it."""
+    stored = current.article_ids.tolist()
+    keep = numpy.array([a in article_ids for a in stored], dtype=bool)
+    term_frequencies = current.term_frequencies
+    vectorizer.forget(term_frequencies[~keep])
+    term_frequencies = term_frequencies[keep]
+    live = vectorizer.prune(used_terms(term_frequencies, term_frequencies.shape[1]))
+    if live is not None:
+        term_frequencies = term_frequencies[:, live]
+    return [a for a, k in zip(stored, keep.tolist()) if k], sparse.csr_matrix(term_frequencies)
+
+def update_doc_matrix(article_ids, documents, directory=DOC_MATRIX_DIR, rebuild=False, corpus=None):
+    """ Bring the stored document matrix up to date with a corpus of filtered
+        documents and their article ids, and return it.
+
+        The stored version is reused as is if it covers exactly these articles.
+        Otherwise the rows of articles no longer in the corpus, e.g. because a
+        time window moved past them, are dropped and the rows of new articles
+        appended to a new version with refreshed idfs, so only new articles are
+        counted. If rebuild is set because the documents themselves changed, the
+        matrix is rebuilt from scratch. corpus is an optional (document
+        frequencies by term, number of documents) pair to take the idfs from
+        (see Vectorizer.use_corpus) rather than counting them."""
+    article_ids = list(article_ids)
+    documents = dict(zip(article_ids, documents))
+    current = open_doc_matrix(directory)
+    if current is not None and not rebuild:
+        stored = current.article_ids.tolist()
+        stored_set = set(stored)
+        if stored_set == set(article_ids):
+            return current
+        vectorizer = current.vectorizer()
+        if corpus is not None:
+            vectorizer.use_corpus(*corpus)
+        if stored_set.issubset(documents):
+            term_frequencies = current.term_frequencies
+        else:
+            stored, term_frequencies = drop_rows(current, documents, vectorizer)
+            stored_set = set(stored)
+        new_ids = [a for a in article_ids if a not in stored_set]
+        new_tfs = vectorizer.count(documents[a] for a in new_ids)
+        num_terms = len(vectorizer.vocabulary)
+        term_frequencies = sparse.vstack([widen(term_frequencies, num_terms), widen(new_tfs, num_terms)], format='csr')
+        return write_version(directory, current.version + 1, stored + new_ids, vectorizer, term_frequencies)
+    os.makedirs(directory, exist_ok=True)
+    vectorizer = Vectorizer()
+    if corpus is not None:
+        vectorizer.use_corpus(*corpus)
+    term_frequencies = vectorizer.count(documents[a] for a in article_ids)
+    version = current.version + 1 if current is not None else 1
+    return write_version(directory, version, article_ids, vectorizer, term_frequencies)
@@ -0,0 +1,122 @@
+import asyncio
+import shelve
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import feedparser
+import metrics
+
+DEFAULT_TIMEOUT = 15
+DEFAULT_PER_HOST = 2
+DEFAULT_WORKERS = 16
+FEED_STATE_FILE = 'feed_state'
+USER_AGENT = 'news-aggregator/1.0'
+
+class PollStats:
+    """Counters for a single polling run"""
+
+    def __init__(self):
+        self.fetched = 0
+        self.not_modified = 0
+        self.failed = 0
+        self.wall_time = 0.0
+
+    def __str__(self):
+        return "Fetched: {0}  Not modified: {1}  Failed: {2}  Wall time: {3:.2f}s".format(
+            self.fetched, self.not_modified, self.failed, self.wall_time)
+
+def dedupe_urls(urls):
+    """Strip whitespace and drop blank or repeated URLs, keeping the original order"""
+    seen = set()
+    unique = []
+    for url in urls:
+        url = url.strip()
+        if url and url not in seen:
+            seen.add(url)
+            unique.append(url)
+    return unique
+
+def open_feed(url, etag=None, modified=None, timeout=DEFAULT_TIMEOUT):
+    """ Conditional GET of a feed. Returns (status, body, headers), where body
+        is None if the server answered 304 Not Modified. Other HTTP errors raise
+        urllib.error.HTTPError, whose headers may carry a Retry-After."""
+    headers = {'User-Agent': USER_AGENT}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    request = urllib.request.Request(url, headers=headers)
+    with metrics.timer('feed_fetch_seconds'):
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as resp:
+                return resp.status, resp.read(), resp.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return 304, None, e.headers
+            raise
+
+def fetch_feed(url, etag=None, modified=None, timeout=DEFAULT_TIMEOUT):
+    """ Conditional GET of a feed. Returns (status, body, etag, modified),
+        where body is None if the server answered 304 Not Modified."""
+    status, body, headers = open_feed(url, etag, modified, timeout)
+    if status == 304:
+        return 304, None, etag, modified
+    return status, body, headers.get('ETag'), headers.get('Last-Modified')
+
+async def poll_feed(url, state, host_limits, stats, on_feed, timeout):
+    """Fetch and parse one feed, skipping the parse entirely on a 304"""
+    loop = asyncio.get_running_loop()
+    cached = state.get(url, {})
+    async with host_limits[urlparse(url).netloc]:
+        try:
+            status, body, etag, modified = await loop.run_in_executor(
+                None, fetch_feed, url, cached.get('etag'), cached.get('modified'), timeout)
+        except Exception as e:
+            print("Failed to fetch %s: %s" % (url, e))
+            stats.failed += 1
+            metrics.inc('feeds_polled', result='failed')
+            return
+    if status == 304:
+        stats.not_modified += 1
+        metrics.inc('feeds_polled', result='not_modified')
+        return
+    feed = await loop.run_in_executor(None, feedparser.parse, body)
+    if feed.bozo == 1:
+        print("Malformed RSS Feed: %s" % url)
+        stats.failed += 1
+        metrics.inc('feeds_polled', result='malformed')
+        return
+    # Stored on a worker thread so database writes don't hold up the other polls
+    try:
+        await loop.run_in_executor(None, on_feed, url, feed)
+    except Exception as e:
+        print("Failed to store entries of %s: %s" % (url, e))
+        stats.failed += 1
+        metrics.inc('feeds_polled', result='failed')
+        return
+    # Only remember validators once the entries have been handled
+    state[url] = {'etag': etag, 'modified': modified}
+    stats.fetched += 1
+    metrics.inc('feeds_polled', result='fetched')
+
+async def poll_all(urls, on_feed, state, per_host, timeout, workers):
+    stats = PollStats()
+    host_limits = defaultdict(lambda: asyncio.Semaphore(per_host))
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=workers))
+    start = time.perf_counter()
+    await asyncio.gather(*[poll_feed(url, state, host_limits, stats, on_feed, timeout) for url in urls])
+    stats.wall_time = time.perf_counter() - start
+    return stats
+
+def poll_feeds(urls, on_feed, state_file=FEED_STATE_FILE, per_host=DEFAULT_PER_HOST,
+               timeout=DEFAULT_TIMEOUT, workers=DEFAULT_WORKERS):
+    """ Concurrently poll every unique feed URL, calling on_feed(url, feed) for each
+        feed that changed since the last run, on the worker threads (so it must
+        be thread-safe). ETag/Last-Modified validators are
+        persisted per feed in state_file. Returns the PollStats for the run."""
+    with shelve.open(state_file) as state:
+        return asyncio.run(poll_all(dedupe_urls(urls), on_feed, state, per_host, timeout, workers))
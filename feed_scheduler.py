@@ -0,0 +1,313 @@
+import asyncio
+import heapq
+import random
+import shelve
+import time
+import calendar
+import argparse
+import urllib.error
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import feedparser
+from feed_poller import dedupe_urls, open_feed, DEFAULT_TIMEOUT, DEFAULT_PER_HOST, DEFAULT_WORKERS
+import metrics
+
+SCHEDULE_FILE = 'feed_schedule'
+DEFAULT_MIN_INTERVAL = 60
+DEFAULT_MAX_INTERVAL = 6 * 3600
+# Poll interval of a feed whose publishing rate isn't known yet
+DEFAULT_INTERVAL = 900
+# Weight of the latest poll in a feed's new-entry rate; each poll that finds
+# nothing new stretches the interval by 1 / (1 - RATE_WEIGHT)
+RATE_WEIGHT = 0.3
+# Failing feeds are retried after at most this long
+MAX_BACKOFF = 24 * 3600
+# Entry ids remembered per feed to tell new entries from ones already seen
+SEEN_ENTRIES = 500
+# Polls are delayed by up to this fraction so feeds added together drift apart
+JITTER = 0.1
+# Seconds between status lines (and metrics file writes)
+STATUS_INTERVAL = 60
+
+def new_schedule(now):
+    """Schedule state of a feed that was never polled: due right away"""
+    return {'next_poll': now, 'last_poll': None, 'last_change': None, 'interval': DEFAULT_INTERVAL,
+            'rate': None, 'errors': 0, 'etag': None, 'modified': None, 'seen': []}
+
+def cache_max_age(headers):
+    """Seconds from a Cache-Control max-age directive, or None"""
+    value = headers.get('Cache-Control') if headers else None
+    for directive in (value or '').split(','):
+        name, _, arg = directive.strip().partition('=')
+        if name.lower() in ('max-age', 's-maxage'):
+            try:
+                return max(0, int(arg.strip('"')))
+            except ValueError:
+                return None
+    return None
+
+def retry_after(headers, now):
+    """Seconds to wait from a Retry-After header, given as seconds or an HTTP date, or None"""
+    value = (headers.get('Retry-After') if headers else None) or ''
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - now)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def entry_key(entry):
+    return entry.get('id') or entry.get('link') or entry.get('title')
+
+def published_rate(entries):
+    """Entries per second implied by the spread of their publication dates, or None"""
+    times = sorted(calendar.timegm(e.published_parsed) for e in entries if e.get('published_parsed'))
+    if len(times) < 2 or times[-1] <= times[0]:
+        return None
+    return (len(times) - 1) / (times[-1] - times[0])
+
+class FeedScheduler:
+    """ Polls every feed on its own schedule, driven by a heap of due times.
+
+        Each feed's rate of new entries is tracked as a moving average over its
+        polls, and it is polled about once per expected new entry, within
+        [min_interval, max_interval]. Feeds that stop publishing drift out to
+        max_interval and busy ones come down to min_interval. A Cache-Control
+        max-age delays the next poll (up to max_interval) and a Retry-After is
+        always waited out. Errors and malformed feeds back off exponentially.
+
+        The schedule, new-entry rate and validators of every feed are kept in
+        state (a shelf), so a restart picks up where the last run stopped.
+        Only due feeds have a fetch in flight, at most workers at a time and
+        per_host per host, so one process handles thousands of feeds."""
+
+    def __init__(self, urls, on_feed, state, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 per_host=DEFAULT_PER_HOST, timeout=DEFAULT_TIMEOUT, workers=DEFAULT_WORKERS):
+        self.on_feed = on_feed
+        self.state = state
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.per_host = per_host
+        self.timeout = timeout
+        self.workers = workers
+        now = time.time()
+        urls = dedupe_urls(urls)
+        for url in set(state.keys()) - set(urls):
+            del state[url]
+        self.heap = []
+        for url in urls:
+            if url not in state:
+                state[url] = new_schedule(now)
+            self.heap.append((state[url]['next_poll'], url))
+        heapq.heapify(self.heap)
+        self.num_feeds = len(urls)
+        self.polls = defaultdict(int)
+        self.new_entries = 0
+
+    def __str__(self):
+        polls = ', '.join('%s %s' % (n, result) for result, n in sorted(self.polls.items())) or 'none'
+        text = "Feeds: {0}  Polls: {1}  New entries: {2}".format(self.num_feeds, polls, self.new_entries)
+        if self.heap:
+            text += "  Next poll in {0:.0f}s".format(max(0, self.heap[0][0] - time.time()))
+        return text
+
+    def clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def reschedule(self, url, schedule, delay):
+        """Store a feed's schedule with its next poll delay seconds from now"""
+        schedule['next_poll'] = time.time() + delay * random.uniform(1, 1 + JITTER)
+        heapq.heappush(self.heap, (schedule['next_poll'], url))
+        self.wakeup.set()
+        try:
+            self.state[url] = schedule
+        except Exception as e:
+            # Still polled on time; only a restart loses the update
+            print("Failed to save the schedule of %s: %s" % (url, e))
+
+    def adapt(self, schedule, now, new, entries=()):
+        """ Fold the number of new entries found by a successful poll into the
+            feed's rate and return its next interval"""
+        if schedule['last_poll'] is not None:
+            observed = new / max(now - schedule['last_poll'], 1)
+            rate = schedule['rate']
+            schedule['rate'] = observed if rate is None else RATE_WEIGHT * observed + (1 - RATE_WEIGHT) * rate
+        elif entries:
+            # First poll: everything is new, so estimate from publication dates
+            schedule['rate'] = published_rate(entries)
+        schedule['last_poll'] = now
+        schedule['errors'] = 0
+        if new:
+            schedule['last_change'] = now
+        if schedule['rate'] is not None:
+            schedule['interval'] = 1 / schedule['rate'] if schedule['rate'] > 0 else self.max_interval
+        schedule['interval'] = self.clamp(schedule['interval'])
+        return schedule['interval']
+
+    def cache_delay(self, delay, max_age):
+        """Don't poll again before a Cache-Control max-age runs out, unless that is past max_interval"""
+        return max(delay, min(max_age or 0, self.max_interval))
+
+    def backoff(self, schedule, headers=None):
+        """ Next delay of a feed whose poll failed: the time the server asked
+            for in a Retry-After, otherwise doubling with every error in a row"""
+        schedule['errors'] += 1
+        interval = schedule['interval'] = self.clamp(schedule['interval'])
+        wait = retry_after(headers, time.time())
+        if wait is not None:
+            return min(max(wait, interval), MAX_BACKOFF)
+        return min(interval * 2 ** schedule['errors'], MAX_BACKOFF)
+
+    async def poll(self, url, host_limits):
+        """ Fetch a feed and reschedule it. Whatever fails along the way, the
+            feed is rescheduled with backoff rather than dropped."""
+        try:
+            schedule = self.state[url]
+        except Exception as e:
+            print("Failed to read the schedule of %s: %s" % (url, e))
+            schedule = new_schedule(time.time())
+        try:
+            await self.fetch(url, schedule, host_limits)
+        except Exception as e:
+            print("Failed to poll %s: %s" % (url, e))
+            self.done(url, schedule, 'failed', self.backoff(schedule))
+
+    async def fetch(self, url, schedule, host_limits):
+        loop = asyncio.get_running_loop()
+        now = time.time()
+        metrics.observe('feed_poll_lag_seconds', max(0, now - schedule['next_poll']))
+        try:
+            async with host_limits[urlparse(url).netloc]:
+                status, body, headers = await loop.run_in_executor(
+                    None, open_feed, url, schedule['etag'], schedule['modified'], self.timeout)
+        except urllib.error.HTTPError as e:
+            print("Failed to fetch %s: %s" % (url, e))
+            return self.done(url, schedule, 'failed', self.backoff(schedule, e.headers))
+        except Exception as e:
+            print("Failed to fetch %s: %s" % (url, e))
+            return self.done(url, schedule, 'failed', self.backoff(schedule))
+        max_age = cache_max_age(headers)
+        if status == 304:
+            delay = self.adapt(schedule, now, 0)
+            return self.done(url, schedule, 'not_modified', self.cache_delay(delay, max_age))
+        feed = await loop.run_in_executor(None, feedparser.parse, body)
+        if feed.bozo == 1:
+            print("Malformed RSS Feed: %s" % url)
+            return self.done(url, schedule, 'malformed', self.backoff(schedule))
+        seen = set(schedule['seen'])
+        keys = [entry_key(e) for e in feed.entries]
+        new = sum(1 for k in keys if k not in seen)
+        if new:
+            try:
+                await loop.run_in_executor(None, self.on_feed, url, feed)
+            except Exception as e:
+                print("Failed to store entries of %s: %s" % (url, e))
+                return self.done(url, schedule, 'failed', self.backoff(schedule))
+        # Only remember entries and validators once the entries have been handled
+        current = set(keys)
+        schedule['seen'] = (keys + [k for k in schedule['seen'] if k not in current])[:SEEN_ENTRIES]
+        schedule['etag'], schedule['modified'] = headers.get('ETag'), headers.get('Last-Modified')
+        self.new_entries += new
+        metrics.inc('feed_entries_new', new)
+        delay = self.adapt(schedule, now, new, feed.entries)
+        self.done(url, schedule, 'fetched', self.cache_delay(delay, max_age))
+
+    def done(self, url, schedule, result, delay):
+        self.polls[result] += 1
+        metrics.inc('feeds_polled', result=result)
+        self.reschedule(url, schedule, delay)
+
+    async def run(self, duration=None, metrics_file=None):
+        """ Poll feeds as they come due, forever or for duration seconds, then
+            wait for the polls in flight"""
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.workers))
+        host_limits = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+        slots = asyncio.Semaphore(self.workers)
+        self.wakeup = asyncio.Event()
+        tasks = set()
+        end = time.time() + duration if duration is not None else None
+        next_status = time.time() + STATUS_INTERVAL
+
+        async def poll(url):
+            try:
+                await self.poll(url, host_limits)
+            finally:
+                slots.release()
+
+        while end is None or time.time() < end:
+            now = time.time()
+            if now >= next_status:
+                print(self)
+                metrics.set_gauge('feeds_scheduled', len(self.state))
+                if metrics_file:
+                    metrics.write(metrics_file)
+                next_status = now + STATUS_INTERVAL
+            if self.heap and self.heap[0][0] <= now:
+                await slots.acquire()
+                _, url = heapq.heappop(self.heap)
+                task = asyncio.ensure_future(poll(url))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                continue
+            wait = min([next_status] + ([self.heap[0][0]] if self.heap else []) + ([end] if end else [])) - now
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(wait, 0))
+            except asyncio.TimeoutError:
+                pass
+        if tasks:
+            await asyncio.gather(*tasks)
+
+def run_scheduler(urls, on_feed, state_file=SCHEDULE_FILE, duration=None, metrics_file=None, **kwargs):
+    """ Run a FeedScheduler over the feed URLs with its state in state_file,
+        calling on_feed(url, feed) for every feed with new entries. Returns
+        the scheduler once stopped by Ctrl-C or after duration seconds."""
+    with shelve.open(state_file) as state:
+        scheduler = FeedScheduler(urls, on_feed, state, **kwargs)
+        try:
+            asyncio.run(scheduler.run(duration, metrics_file))
+        except KeyboardInterrupt:
+            pass
+        return scheduler
+
+def print_schedule(state_file=SCHEDULE_FILE):
+    """Print every feed's next poll, interval, new-entry rate and error count"""
+    now = time.time()
+    with shelve.open(state_file, 'r') as state:
+        schedules = sorted(state.items(), key=lambda item: item[1]['next_poll'])
+    print('{0:>9} {1:>9} {2:>10} {3:>11} {4:>6}  {5}'.format('next (s)', 'interval', 'per hour', 'changed (s)', 'errors', 'feed'))
+    for url, s in schedules:
+        rate = '%.2f' % (s['rate'] * 3600) if s['rate'] is not None else '-'
+        changed = '%.0f' % (now - s['last_change']) if s['last_change'] else '-'
+        print('{0:>9.0f} {1:>9.0f} {2:>10} {3:>11} {4:>6}  {5}'.format(s['next_poll'] - now, s['interval'], rate, changed, s['errors'], url))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Long-running feed poller that adapts each feed\'s poll interval to how often it publishes')
+    parser.add_argument("-f", "--feeds", default='feeds.txt', help="file listing the RSS feed URLs")
+    parser.add_argument("--min-interval", type=float, default=DEFAULT_MIN_INTERVAL, help="shortest time between polls of a feed in seconds")
+    parser.add_argument("--max-interval", type=float, default=DEFAULT_MAX_INTERVAL, help="longest time between polls of a feed in seconds")
+    parser.add_argument("--per-host", type=int, default=DEFAULT_PER_HOST, help="max concurrent connections per feed host")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="per-feed fetch timeout in seconds")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="max feeds fetched at once")
+    parser.add_argument("--state", default=SCHEDULE_FILE, help="file the per-feed schedules are kept in across restarts")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds instead of running until Ctrl-C")
+    parser.add_argument("--status", action="store_true", help="print the saved schedule of every feed and exit")
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics.from_arguments(args)
+    if args.status:
+        print_schedule(args.state)
+    else:
+        from rss_parser import add_feed_entries
+        with open(args.feeds) as f:
+            urls = f.readlines()
+        scheduler = run_scheduler(urls, add_feed_entries, args.state, args.duration, args.metrics,
+                                  min_interval=args.min_interval, max_interval=args.max_interval,
+                                  per_host=args.per_host, timeout=args.timeout, workers=args.workers)
+        print(scheduler)
+    metrics.write_from_arguments(args)
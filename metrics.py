@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+
+# Prefix of every exported metric name
+NAMESPACE = 'news'
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PROFILE_DIR = 'profiles'
+
+# Checked before any work is done, so instrumentation costs one global lookup while disabled
+enabled = os.environ.get('ARTICLE_METRICS', '') not in ('', '0')
+profiled_stages = set()
+
+class Registry:
+    """ Counters, gauges and latency histograms, each identified by a name and
+        a tuple of (label, value) pairs."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value, labels):
+        with self.lock:
+            self.counters[name, labels] += value
+
+    def set(self, name, value, labels):
+        with self.lock:
+            self.gauges[name, labels] = float(value)
+
+    def observe(self, name, value, labels):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+registry = Registry()
+
+def enable(profile=()):
+    """Start recording metrics, and cProfile the named stages"""
+    global enabled
+    enabled = True
+    profiled_stages.update(profile)
+
+def disable():
+    global enabled
+    enabled = False
+    profiled_stages.clear()
+
+def inc(name, value=1, **labels):
+    """Add to a counter"""
+    if enabled:
+        registry.inc(name, value, tuple(sorted(labels.items())))
+
+def set_gauge(name, value, **labels):
+    if enabled:
+        registry.set(name, value, tuple(sorted(labels.items())))
+
+def observe(name, seconds, **labels):
+    """Record one latency in a histogram"""
+    if enabled:
+        registry.observe(name, seconds, tuple(sorted(labels.items())))
+
+class timer:
+    """ Context manager recording the time spent in its block in a histogram:
+
+        with metrics.timer('feed_fetch_seconds'):
+            ..."""
+
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+def timed(name):
+    """Decorator recording each call's latency in a histogram, labelled with the function name"""
+    def decorate(f):
+        labels = (('function', f.__name__),)
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                registry.observe(name, time.perf_counter() - start, labels)
+        return wrapper
+    return decorate
+
+#######################
+##  STAGE PROFILING  ##
+#######################
+
+# One profile per (stage, thread ident), enabled again on every entry so it accumulates
+profiles = {}
+profiles_lock = threading.Lock()
+active_profile = threading.local()
+
+class profiled:
+    """ Context manager that runs its block under cProfile if its stage was
+        passed to enable(profile=...). Each thread profiles separately and the
+        results are merged by write_profiles(); nested stages are counted
+        towards the outermost one."""
+
+    __slots__ = ('stage', 'profile')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.profile = None
+
+    def __enter__(self):
+        self.profile = None
+        if self.stage in profiled_stages and not getattr(active_profile, 'on', False):
+            import cProfile
+            key = (self.stage, threading.get_ident())
+            with profiles_lock:
+                if key not in profiles:
+                    profiles[key] = cProfile.Profile()
+                self.profile = profiles[key]
+            active_profile.on = True
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+            active_profile.on = False
+
+def write_profiles(directory=PROFILE_DIR):
+    """Write the merged profile of every profiled stage to <directory>/<stage>.prof"""
+    import pstats
+    collected = defaultdict(list)
+    with profiles_lock:
+        for (stage, _), profile in profiles.items():
+            collected[stage].append(profile)
+    if not collected:
+        return []
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for stage, stage_profiles in collected.items():
+        stats = pstats.Stats(stage_profiles[0])
+        for p in stage_profiles[1:]:
+            stats.add(p)
+        path = os.path.join(directory, stage + '.prof')
+        stats.dump_stats(path)
+        paths.append(path)
+    return paths
+
+#################
+##  EXPORTING  ##
+#################
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+def prometheus_text():
+    """All metrics in the Prometheus text exposition format"""
+    with registry.lock:
+        counters = sorted(registry.counters.items())
+        gauges = sorted(registry.gauges.items())
+        histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in registry.histograms.items())
+    lines = []
+    typed = set()
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE %s %s' % (name, kind))
+    for (name, labels), value in counters:
+        name = '%s_%s_total' % (NAMESPACE, name)
+        declare(name, 'counter')
+        lines.append('%s%s %r' % (name, format_labels(labels), value))
+    for (name, labels), value in gauges:
+        name = '%s_%s' % (NAMESPACE, name)
+        declare(name, 'gauge')
+        lines.append('%s%s %r' % (name, format_labels(labels), value))
+    for (name, labels), (buckets, total, count) in histograms:
+        name = '%s_%s' % (NAMESPACE, name)
+        declare(name, 'histogram')
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+            cumulative += n
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', bound)]), cumulative))
+        lines.append('%s_sum%s %r' % (name, format_labels(labels), total))
+        lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    """All metrics as a JSON-serializable dict"""
+    with registry.lock:
+        return {
+            'time': time.time(),
+            'counters': [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in sorted(registry.counters.items())],
+            'gauges': [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in sorted(registry.gauges.items())],
+            'histograms': [{'name': n, 'labels': dict(l), 'count': h[2], 'sum': h[1],
+                            'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], h[0]))}
+                           for (n, l), h in sorted(registry.histograms.items())],
+        }
+
+def write(path):
+    """ Atomically write all metrics to path: a JSON snapshot if it ends in
+        .json, otherwise a Prometheus text file (e.g. for node_exporter's
+        textfile collector)."""
+    if path.endswith('.json'):
+        text = json.dumps(snapshot(), indent=2)
+    else:
+        text = prometheus_text()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def add_arguments(parser):
+    """Add the --metrics and --profile options to a command line parser"""
+    parser.add_argument("--metrics", metavar="FILE", help="record metrics and write them to FILE (.json for a JSON snapshot, otherwise Prometheus text)")
+    parser.add_argument("--profile", metavar="STAGE", action="append", default=[], help="cProfile a stage into %s/STAGE.prof (repeatable)" % PROFILE_DIR)
+
+def from_arguments(args):
+    """Enable metrics if the command line asked for them"""
+    if args.metrics or args.profile:
+        enable(args.profile)
+
+def write_from_arguments(args):
+    """Write whatever the command line asked for"""
+    if args.metrics:
+        write(args.metrics)
+    for path in write_profiles():
+        print('Profile written to %s' % path)
+
+def print_progress(msg, i, max_val, line_num=0, show_frac=True):
+    """Print progress of some process, and record it as a gauge"""
+    set_gauge('progress_ratio', i / max_val if max_val else 1.0, task=msg)
+    prcnt = (i / max_val) * 100 if max_val else 100.0
+    if show_frac:
+        sys.stdout.write("\n"*line_num + "\r{0}: {1:.2f}%    ({2}/{3})".format(msg, prcnt, i, max_val))
+    else:
+        sys.stdout.write("\r{0}: {1:.2f}%".format(msg, prcnt))
+    sys.stdout.flush()
@@ -0,0 +1,83 @@
+import argparse
+import db_manager
+from db_manager import cursor, execute, transaction, perform_query, get_term_ids, encode_tokens
+from metrics import print_progress
+
+MIGRATION_BATCH_SIZE = 500
+
+def has_column(table, column):
+    try:
+        perform_query("SELECT {0} FROM {1} LIMIT 1;".format(column, table))
+        return True
+    except Exception:
+        return False
+
+def column_bytes(table, columns):
+    """Total stored size in bytes of the given columns of a table"""
+    size = db_manager.backend.size_function
+    total = ' + '.join("COALESCE(SUM({0}({1})), 0)".format(size, c) for c in columns)
+    return perform_query("SELECT {0} FROM {1};".format(total, table))[0]
+
+def migrate_filtered_text():
+    """ Rewrite filtered_articles.filtered_text string arrays as packed int32 filtered_tokens.
+
+        Rows are copied in batches into a new table declared as in the schema
+        files, NOT NULL included (SQLite can't add that to an existing
+        column), which then replaces the old one. A run that was stopped
+        carries on after the last article it copied."""
+    if not has_column('filtered_articles', 'filtered_text'):
+        print('filtered_articles already uses filtered_tokens')
+        return None
+    before = column_bytes('filtered_articles', ['filtered_text'])
+    perform_query("CREATE TABLE IF NOT EXISTS filtered_articles_compact ("
+                  "article_id INTEGER PRIMARY KEY REFERENCES articles (article_id), "
+                  "filtered_tokens {0} NOT NULL);".format(db_manager.backend.binary_type))
+    num = perform_query("SELECT COUNT(*) FROM filtered_articles;")[0]
+    done = perform_query("SELECT COUNT(*) FROM filtered_articles_compact;")[0]
+    query = "INSERT INTO filtered_articles_compact (article_id, filtered_tokens) VALUES %s;"
+    while True:
+        with cursor() as curr:
+            execute(curr, "SELECT article_id, filtered_text FROM filtered_articles WHERE article_id > "
+                          "(SELECT COALESCE(MAX(article_id), 0) FROM filtered_articles_compact) "
+                          "ORDER BY article_id LIMIT %s;", (MIGRATION_BATCH_SIZE,))
+            rows = curr.fetchall()
+        if not rows:
+            break
+        ids = get_term_ids(t for _, text in rows for t in text or [])
+        with cursor() as curr:
+            db_manager.execute_values(curr, query, [(article_id, encode_tokens(text or [], ids)) for article_id, text in rows])
+        done += len(rows)
+        print_progress('Filtered text', done, num)
+    with transaction() as curr:
+        execute(curr, "DROP TABLE filtered_articles;")
+        execute(curr, "ALTER TABLE filtered_articles_compact RENAME TO filtered_articles;")
+    return before, column_bytes('filtered_articles', ['filtered_tokens'])
+
+def drop_term_frequencies():
+    """ Drop the term_frequencies table. Stored frequencies were never read back,
+        the matrix and indexes count terms from the filtered tokens."""
+    if not has_column('term_frequencies', 'article_id'):
+        print('term_frequencies already dropped')
+        return None
+    columns = ['term_ids', 'tf_values'] if has_column('term_frequencies', 'term_ids') else ['term_frequencies']
+    before = column_bytes('term_frequencies', columns)
+    perform_query("DROP TABLE term_frequencies;")
+    return before, 0
+
+def report(table, sizes):
+    if sizes is None:
+        return
+    before, after = sizes
+    saved = 100.0 * (1 - after / before) if before else 0.0
+    print("\n{0}: {1:.2f} MB -> {2:.2f} MB ({3:.1f}% smaller)".format(table, before / 2**20, after / 2**20, saved))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate stored text to the compact integer encoding and drop the unused term frequencies')
+    parser.add_argument("--vacuum", action="store_true", help="reclaim the freed space afterwards (locks the tables while it runs)")
+
+    args = parser.parse_args()
+    db_manager.backend.create_schema()
+    report('filtered_articles', migrate_filtered_text())
+    report('term_frequencies', drop_term_frequencies())
+    if args.vacuum:
+        perform_query(db_manager.backend.vacuum)
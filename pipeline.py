@@ -0,0 +1,300 @@
+import queue
+import threading
+import time
+import argparse
+from collections import OrderedDict
+from db_manager import *
+from article import Article
+from article_extractor import ExtractionResult, DomainLimiter, download_article, filter_article, DEFAULT_PER_DOMAIN, DEFAULT_DOMAIN_DELAY, DEFAULT_TIMEOUT, DEFAULT_RETRIES
+from article_processor import store_extraction_results
+from feed_poller import dedupe_urls, poll_feeds
+from related_index import RelatedIndex, IndexLock, RELATED_INDEX_FILE
+from search_index import SearchIndex, SEARCH_INDEX_FILE
+import metrics
+import cache
+import content_cache
+
+DEFAULT_QUEUE_SIZE = 200
+DEFAULT_POLL_INTERVAL = 300
+# Seconds between saves of the related-articles and search indexes while new articles are arriving
+DEFAULT_SAVE_INTERVAL = 5
+# Links remembered in memory so articles repeated across polls skip the database
+SEEN_LINKS = 100000
+DEFAULT_STAGE_WORKERS = {'dedupe': 1, 'download': 8, 'tokenize': 2}
+
+# Queued after the last item; each stage passes it on once all its workers have finished
+STOP = object()
+
+class Stage:
+    """ A pool of worker threads between two bounded queues.
+
+        Workers take up to batch_size items that are already waiting in the
+        inbox, hand them to process(batch) and put whatever it returns on the
+        next stage's inbox. A full inbox blocks the stage feeding it, so a slow
+        stage throttles everything upstream instead of letting items pile up.
+        A batch that raises is handed to on_error(batch), if given, and dropped."""
+
+    def __init__(self, name, process, workers=1, batch_size=1, queue_size=DEFAULT_QUEUE_SIZE, on_error=None):
+        self.name = name
+        self.process = process
+        self.on_error = on_error
+        self.workers = workers
+        self.batch_size = batch_size
+        self.inbox = queue.Queue(queue_size)
+        self.outbox = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.processed = 0
+        self.errors = 0
+
+    def start(self, outbox=None):
+        self.outbox = outbox
+        self.running = self.workers
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, name='%s-%d' % (self.name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def next_batch(self):
+        """Block for one item, then take whatever else is waiting up to batch_size. None once stopped."""
+        item = self.inbox.get()
+        if item is STOP:
+            self.inbox.put(STOP)
+            return None
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is STOP:
+                # Leave the sentinel for the next call (and the other workers)
+                self.inbox.put(STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            metrics.set_gauge('queue_depth', self.inbox.qsize(), stage=self.name)
+            try:
+                with metrics.profiled(self.name), metrics.timer('stage_seconds', stage=self.name):
+                    outputs = self.process(batch) or []
+            except Exception as e:
+                print("\npipeline: %s stage failed on %s items: %s" % (self.name, len(batch), e))
+                outputs = []
+                if self.on_error:
+                    self.on_error(batch)
+                metrics.inc('stage_errors', stage=self.name)
+                with self.lock:
+                    self.errors += 1
+            metrics.inc('stage_items', len(batch), stage=self.name)
+            if self.outbox is not None:
+                for output in outputs:
+                    self.outbox.put(output)
+            with self.lock:
+                self.processed += len(batch)
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            # Every worker has seen the sentinel; take it back out and pass it on
+            self.inbox.get_nowait()
+            if self.outbox is not None:
+                self.outbox.put(STOP)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def __str__(self):
+        return "{0}: {1} processed, {2} queued, {3} errors".format(self.name, self.processed, self.inbox.qsize(), self.errors)
+
+class Pipeline:
+    """ Streams articles from feed entries into the related-articles and search indexes.
+
+        poll -> dedupe -> download -> tokenize -> index, each stage on
+        its own threads with a bounded queue in front of it, so memory use
+        depends on the queue sizes rather than the backlog. Articles are
+        written to the database as they clear each stage and the indexes are
+        saved every save_interval seconds, so new articles can be queried
+        shortly after they appear in a feed.
+
+        The indexes are locked (see IndexLock) from creation until close(), so
+        article_processor.py can't update them meanwhile. Articles in a batch
+        that fails before they are stored are forgotten by dedupe, so a later
+        poll retries them; those that fail to be indexed are already stored and
+        are listed in self.unindexed for the next article_processor.py run."""
+
+    def __init__(self, workers=None, queue_size=DEFAULT_QUEUE_SIZE, per_domain=DEFAULT_PER_DOMAIN,
+                 domain_delay=DEFAULT_DOMAIN_DELAY, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 index_path=RELATED_INDEX_FILE, search_index_path=SEARCH_INDEX_FILE, save_interval=DEFAULT_SAVE_INTERVAL):
+        workers = dict(DEFAULT_STAGE_WORKERS, **(workers or {}))
+        self.limiter = DomainLimiter(per_domain, domain_delay)
+        self.timeout = timeout
+        self.retries = retries
+        self.seen = OrderedDict()
+        self.seen_lock = threading.Lock()
+        self.unindexed = []
+        self.lock = IndexLock(index_path)
+        self.lock.acquire()
+        self.index_path = index_path
+        self.index = RelatedIndex.load(index_path)
+        self.search_index_path = search_index_path
+        self.search_index = SearchIndex.load(search_index_path)
+        # Terms are weighted by the document frequencies kept in the db
+        corpus = get_doc_frequencies(), get_num_docs()
+        for index in (self.index, self.search_index):
+            index.vectorizer.use_corpus(*corpus)
+        self.save_interval = save_interval
+        self.last_save = time.monotonic()
+        self.unsaved = 0
+        self.stages = [
+            Stage('dedupe', self.dedupe, workers['dedupe'], batch_size=BATCH_PAGE_SIZE, queue_size=queue_size,
+                  on_error=self.forget),
+            Stage('download', self.download, workers['download'], queue_size=queue_size, on_error=self.forget),
+            Stage('tokenize', self.tokenize, workers['tokenize'], batch_size=50, queue_size=queue_size,
+                  on_error=lambda downloads: self.forget(a for a, _, _ in downloads)),
+            # The indexes aren't thread safe, so they always get a single worker
+            Stage('index', self.add_to_index, 1, batch_size=BATCH_PAGE_SIZE, queue_size=queue_size,
+                  on_error=self.unindexed.extend),
+        ]
+
+    def start(self):
+        for stage, following in zip(self.stages, self.stages[1:] + [None]):
+            stage.start(following.inbox if following else None)
+
+    def submit(self, article):
+        """Queue a polled article, blocking while the pipeline is full"""
+        self.stages[0].inbox.put(article)
+
+    def on_feed(self, url, feed):
+        articles = [a for a in map(Article.from_feedparser, feed.entries) if a]
+        for a in articles:
+            self.submit(a)
+        print('Queued %s articles from %s' % (len(articles), url))
+
+    def close(self):
+        """Let every queued article finish, then save and unlock the indexes"""
+        self.stages[0].inbox.put(STOP)
+        for stage in self.stages:
+            stage.join()
+        self.save_index()
+        self.lock.release()
+        if self.unindexed:
+            print('%s articles failed to be indexed; run article_processor.py to add them' % len(self.unindexed))
+
+    def dedupe(self, articles):
+        """Store polled articles and pass on the ones not yet filtered, failed or found to be duplicates"""
+        unseen = {}
+        with self.seen_lock:
+            for a in articles:
+                if a.link in self.seen:
+                    self.seen.move_to_end(a.link)
+                else:
+                    unseen[a.link] = a
+        if not unseen:
+            return []
+        add_articles(unseen.values())
+        statuses = get_statuses(unseen)
+        with self.seen_lock:
+            for link in unseen:
+                self.seen[link] = True
+            while len(self.seen) > SEEN_LINKS:
+                self.seen.popitem(last=False)
+        return [a for link, a in unseen.items() if link in statuses and statuses[link].new]
+
+    def forget(self, articles):
+        """Drop the links of a failed batch from the seen links, so the next poll passes them on again"""
+        with self.seen_lock:
+            for a in articles:
+                self.seen.pop(a.link, None)
+
+    def download(self, articles):
+        return [(a,) + download_article(a, self.limiter, self.timeout, self.retries) for a in articles]
+
+    def tokenize(self, downloads):
+        """Filter downloaded text and store it, passing on the articles that had any and weren't duplicates"""
+        results = [ExtractionResult(a, error=error) if error else filter_article(a, raw_text)
+                   for a, raw_text, error in downloads]
+        return store_extraction_results(results)
+
+    def add_to_index(self, articles):
+        article_ids = get_article_ids(a.link for a in articles)
+        items = [(article_ids[a.link], a) for a in articles if a.link in article_ids]
+        # Filtering the batch changed the document frequencies of its terms
+        frequencies = get_doc_frequencies({t for _, a in items for t in a.filtered_text})
+        num_docs = get_num_docs()
+        for index in (self.index, self.search_index):
+            index.vectorizer.update_corpus(frequencies, num_docs)
+        self.unsaved += self.index.add([id for id, _ in items], [a.filtered_text for _, a in items])
+        self.search_index.add([id for id, _ in items], [a.filtered_text for _, a in items],
+                              [a.published for _, a in items], [a.link for _, a in items])
+        metrics.set_gauge('related_index_articles', len(self.index))
+        if time.monotonic() - self.last_save >= self.save_interval:
+            self.save_index()
+
+    def save_index(self):
+        if self.unsaved:
+            self.index.save(self.index_path)
+            self.search_index.save(self.search_index_path)
+            print('\nRelated articles and search indexes: {0} added, {1} total'.format(self.unsaved, len(self.index)))
+            self.unsaved = 0
+        self.last_save = time.monotonic()
+
+    def __str__(self):
+        return '\n'.join(str(stage) for stage in self.stages)
+
+def run_pipeline(urls, once=False, interval=DEFAULT_POLL_INTERVAL, per_host=2, poll_timeout=15, metrics_file=None, **kwargs):
+    """ Poll the feeds into a running pipeline, once or every interval seconds
+        until interrupted, then drain it. Metrics are written to metrics_file,
+        if given, after every poll. Returns the pipeline."""
+    pipeline = Pipeline(**kwargs)
+    pipeline.start()
+    urls = dedupe_urls(urls)
+    try:
+        while True:
+            start = time.monotonic()
+            with metrics.profiled('poll'):
+                print(poll_feeds(urls, pipeline.on_feed, per_host=per_host, timeout=poll_timeout))
+            if metrics_file:
+                metrics.write(metrics_file)
+            if once:
+                break
+            time.sleep(max(0, interval - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        print('\nStopping, finishing queued articles...')
+    pipeline.close()
+    return pipeline
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming ingest: poll feeds, filter and index new articles as they arrive')
+    parser.add_argument("-f", "--feeds", default='feeds.txt', help="file listing the RSS feed URLs")
+    parser.add_argument("--once", action="store_true", help="poll every feed once, process what was found and exit")
+    parser.add_argument("-i", "--interval", type=float, default=DEFAULT_POLL_INTERVAL, help="seconds between feed polls")
+    parser.add_argument("-q", "--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="max items waiting in front of each stage")
+    for stage, count in DEFAULT_STAGE_WORKERS.items():
+        parser.add_argument("--%s-workers" % stage, type=int, default=count, help="worker threads for the %s stage" % stage)
+    parser.add_argument("--per-host", type=int, default=2, help="max concurrent connections per feed host")
+    parser.add_argument("--save-interval", type=float, default=DEFAULT_SAVE_INTERVAL, help="seconds between saves of the related-articles and search indexes")
+    content_cache.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics.from_arguments(args)
+    content_cache.from_arguments(args)
+    with open(args.feeds) as f:
+        urls = f.readlines()
+    workers = {stage: getattr(args, '%s_workers' % stage) for stage in DEFAULT_STAGE_WORKERS}
+    start = time.perf_counter()
+    pipeline = run_pipeline(urls, once=args.once, interval=args.interval, per_host=args.per_host,
+                            workers=workers, queue_size=args.queue_size, save_interval=args.save_interval,
+                            metrics_file=args.metrics)
+    print(pipeline)
+    print(cache.format_stats())
+    print('Wall time: {0:.2f}s'.format(time.perf_counter() - start))
+    metrics.write_from_arguments(args)
@@ -0,0 +1,227 @@
+import os
+import csv
+import argparse
+import numpy
+from scipy import sparse
+from vectorizer import Vectorizer, widen
+from doc_matrix_store import open_doc_matrix
+import metrics
+
+PROJECTION_FILE = 'projection.npz'
+DEFAULT_COMPONENTS = 100
+
+def randomized_svd(matrix, k, oversamples=10, power_iterations=4, seed=None):
+    """ Truncated SVD of a sparse (docs x terms) matrix to k components, as (U, s, Vt).
+
+        Uses the randomized range finder of Halko, Martinsson and Tropp: the
+        matrix is only ever multiplied by thin dense blocks, so it stays sparse
+        and the work is linear in its non-zeros. Power iterations sharpen the
+        slowly decaying spectrum typical of tf-idf matrices."""
+    rng = numpy.random.default_rng(seed)
+    n, m = matrix.shape
+    size = min(k + oversamples, n, m)
+    q, _ = numpy.linalg.qr(matrix @ rng.standard_normal((m, size)))
+    for _ in range(power_iterations):
+        z, _ = numpy.linalg.qr(matrix.T @ q)
+        q, _ = numpy.linalg.qr(matrix @ z)
+    u, s, vt = numpy.linalg.svd(numpy.asarray((matrix.T @ q).T), full_matrices=False)
+    u = q @ u
+    # Fix each component's sign so that repeated fits give the same axes
+    signs = numpy.sign(vt[numpy.arange(len(vt)), numpy.abs(vt).argmax(axis=1)])
+    signs[signs == 0] = 1
+    return u[:, :k] * signs[:k], s[:k], vt[:k] * signs[:k, None]
+
+def unit(vectors):
+    lengths = numpy.linalg.norm(vectors, axis=1)
+    lengths[lengths == 0] = 1.0
+    return vectors / lengths[:, None]
+
+class Projection:
+    """ Latent semantic projection of tf-idf article vectors onto k components.
+
+        vectors holds the reduced (docs x k) vector of every projected article.
+        Articles added after the fit are folded in by projecting their tf-idf
+        rows onto the fitted components, without refitting. Terms first seen
+        after the fit have no component weights and are ignored."""
+
+    def __init__(self, components, singular_values, vectorizer, article_ids=None, vectors=None):
+        self.components = components
+        self.singular_values = singular_values
+        self.vectorizer = vectorizer
+        self.article_ids = list(article_ids) if article_ids is not None else []
+        self.rows = {a: i for i, a in enumerate(self.article_ids)}
+        self.vectors = vectors if vectors is not None else numpy.zeros((0, len(components)), dtype=numpy.float32)
+        self._unit_vectors = None
+
+    @classmethod
+    def fit(cls, matrix, article_ids, vectorizer, k=DEFAULT_COMPONENTS, seed=0):
+        """Fit a projection to a (docs x terms) tf-idf matrix and the vectorizer that made it"""
+        with metrics.timer('reduce_seconds', step='fit'):
+            u, s, vt = randomized_svd(sparse.csr_matrix(matrix), k, seed=seed)
+        return cls(vt.astype(numpy.float32), s, vectorizer, article_ids, (u * s).astype(numpy.float32))
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def __contains__(self, article_id):
+        return article_id in self.rows
+
+    @property
+    def num_components(self):
+        return self.components.shape[0]
+
+    @property
+    def num_terms(self):
+        return self.components.shape[1]
+
+    def project(self, matrix):
+        """Reduced (docs x k) vectors of tf-idf rows"""
+        matrix = sparse.csr_matrix(matrix)
+        if matrix.shape[1] > self.num_terms:
+            matrix = matrix[:, :self.num_terms]
+        elif matrix.shape[1] < self.num_terms:
+            matrix = widen(matrix, self.num_terms)
+        return numpy.asarray(matrix @ self.components.T, dtype=numpy.float32)
+
+    def add(self, article_ids, matrix):
+        """Fold in the tf-idf rows of articles that aren't projected yet"""
+        article_ids = list(article_ids)
+        new = [i for i, a in enumerate(article_ids) if a not in self.rows]
+        if not new:
+            return 0
+        with metrics.timer('reduce_seconds', step='fold_in'):
+            vectors = self.project(sparse.csr_matrix(matrix)[new])
+        for i in new:
+            self.rows[article_ids[i]] = len(self.article_ids)
+            self.article_ids.append(article_ids[i])
+        self.vectors = numpy.vstack([self.vectors, vectors])
+        self._unit_vectors = None
+        return len(new)
+
+    def retain(self, article_ids):
+        """Drop the vectors of projected articles not among article_ids. Returns the number dropped."""
+        article_ids = set(article_ids)
+        keep = numpy.array([a in article_ids for a in self.article_ids], dtype=bool)
+        if keep.all():
+            return 0
+        self.vectors = self.vectors[keep]
+        self.article_ids = [a for a, k in zip(self.article_ids, keep.tolist()) if k]
+        self.rows = {a: i for i, a in enumerate(self.article_ids)}
+        self._unit_vectors = None
+        return int(len(keep) - keep.sum())
+
+    @property
+    def unit_vectors(self):
+        """Reduced vectors scaled to unit length, for cosine similarity and k_means"""
+        if self._unit_vectors is None:
+            self._unit_vectors = unit(self.vectors)
+        return self._unit_vectors
+
+    def top_k(self, query, n, exclude=None):
+        """Ids and cosine similarities of the n projected articles closest to a reduced vector"""
+        query = unit(numpy.atleast_2d(query))[0]
+        scores = self.unit_vectors @ query
+        if exclude is not None:
+            scores[self.rows[exclude]] = -numpy.inf
+        n = min(n, len(scores) - (exclude is not None))
+        if n <= 0:
+            return []
+        best = numpy.argpartition(-scores, n - 1)[:n]
+        best = best[numpy.argsort(-scores[best])]
+        return [(self.article_ids[i], float(scores[i])) for i in best if scores[i] > 0]
+
+    def related(self, article_id, n=10, document=None):
+        """ Ids and similarities of the n articles most related to an article, in
+            the reduced space. Articles not projected yet are folded in from
+            their filtered document."""
+        if article_id in self.rows:
+            return self.top_k(self.vectors[self.rows[article_id]], n, exclude=article_id)
+        if document is None:
+            return []
+        return self.top_k(self.project(self.vectorizer.transform([document])), n)
+
+    def coordinates(self, dims=2):
+        """ (docs x dims) coordinates for plotting: the principal components of
+            the unit reduced vectors, which are small enough to center densely."""
+        vectors = self.unit_vectors - self.unit_vectors.mean(axis=0)
+        _, _, vt = numpy.linalg.svd(vectors, full_matrices=False)
+        return vectors @ vt[:dims].T
+
+    def save(self, path=PROJECTION_FILE):
+        tmp_path = path + '.tmp.npz'
+        numpy.savez(tmp_path, components=self.components, singular_values=self.singular_values,
+                    article_ids=numpy.array(self.article_ids, dtype=numpy.int64), vectors=self.vectors,
+                    terms=numpy.array(self.vectorizer.terms(), dtype=str),
+                    doc_frequencies=numpy.frombuffer(self.vectorizer.doc_frequencies, dtype=numpy.int64).copy(),
+                    num_docs=numpy.array(self.vectorizer.num_docs))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=PROJECTION_FILE):
+        """Load a saved projection, or None if none has been saved"""
+        if not os.path.exists(path):
+            return None
+        with numpy.load(path) as f:
+            terms = f['terms'].tolist()
+            vectorizer = Vectorizer({t: i for i, t in enumerate(terms)}, f['doc_frequencies'].tolist(), int(f['num_docs']))
+            return cls(f['components'], f['singular_values'], vectorizer, f['article_ids'].tolist(), f['vectors'])
+
+def update_projection(doc_matrix, k=DEFAULT_COMPONENTS, path=PROJECTION_FILE, refit=False):
+    """ Bring the saved projection up to date with a stored document matrix and return it.
+
+        New articles are folded in and articles no longer in the matrix are
+        dropped. The projection is refitted if asked, if the number of
+        components changed (k, or fewer if the matrix has fewer rows or
+        columns), or if the matrix was rebuilt with a different column order."""
+    projection = None if refit else Projection.load(path)
+    terms = doc_matrix.terms
+    if projection is not None:
+        fitted_terms = projection.vectorizer.terms()
+        components = min(k, *doc_matrix.matrix.shape)
+        if projection.num_components != components or len(fitted_terms) > len(terms) or fitted_terms != terms[:len(fitted_terms)].tolist():
+            projection = None
+    article_ids = doc_matrix.article_ids.tolist()
+    if projection is None:
+        projection = Projection.fit(doc_matrix.matrix, article_ids, doc_matrix.vectorizer(), k)
+    else:
+        projection.retain(article_ids)
+        rows = [i for i, a in enumerate(article_ids) if a not in projection]
+        projection.add([article_ids[i] for i in rows], doc_matrix.matrix[rows])
+    projection.save(path)
+    return projection
+
+def export_coordinates(projection, path, dims=2, labels=None):
+    """Write article_id, the dims plot coordinates and an optional cluster label per article as CSV"""
+    coordinates = projection.coordinates(dims)
+    axes = ['x', 'y', 'z'][:dims]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['article_id'] + axes + (['cluster'] if labels is not None else []))
+        for i, article_id in enumerate(projection.article_ids):
+            row = [article_id] + ['%.6f' % c for c in coordinates[i]]
+            if labels is not None:
+                row.append(int(labels[i]))
+            writer.writerow(row)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reduce the stored document matrix with randomized truncated SVD')
+    parser.add_argument("-k", "--components", type=int, default=DEFAULT_COMPONENTS, help="number of SVD components to keep")
+    parser.add_argument("--refit", action="store_true", help="refit the projection instead of folding in new articles")
+    parser.add_argument("-e", "--export", metavar="CSV", help="write plot coordinates for every article to CSV")
+    parser.add_argument("-d", "--dims", type=int, choices=[2, 3], default=2, help="dimensions of the exported coordinates")
+    parser.add_argument("-c", "--clusters", type=int, help="cluster the reduced vectors with k-means into this many clusters")
+
+    args = parser.parse_args()
+    doc_matrix = open_doc_matrix()
+    if doc_matrix is None:
+        parser.error('no stored document matrix; run article_processor.py first')
+    projection = update_projection(doc_matrix, args.components, refit=args.refit)
+    print('Projection of {0} articles onto {1} components saved to {2}'.format(len(projection), projection.num_components, PROJECTION_FILE))
+    labels = None
+    if args.clusters:
+        from clustering import k_means
+        labels, _ = k_means(projection.unit_vectors, args.clusters, seed=0)
+        print('Cluster sizes: %s' % numpy.bincount(labels, minlength=args.clusters).tolist())
+    if args.export:
+        export_coordinates(projection, args.export, args.dims, labels)
+        print('Coordinates written to %s' % args.export)
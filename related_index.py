@@ -0,0 +1,245 @@
+import os
+import fcntl
+import numpy
+from scipy import sparse
+from vectorizer import Vectorizer, widen, used_terms
+import db_manager
+
+RELATED_INDEX_FILE = 'related_index.npz'
+# Merge appended articles into the inverted index once they exceed this fraction of it
+COMPACT_FRACTION = 0.1
+
+class IndexLocked(Exception):
+    pass
+
+class IndexLock:
+    """ Exclusive lock on the saved related-articles and search indexes.
+
+        Writers load an index, extend it and save it back, so two of them at
+        once would each overwrite the other's additions. The pipeline holds
+        the lock for as long as it runs and article_processor.py while it
+        updates the indexes; whichever comes second fails with IndexLocked
+        rather than waiting. The lock is a flock on path + '.lock', released
+        when its holder exits, however it exits."""
+
+    def __init__(self, path=RELATED_INDEX_FILE):
+        self.path = path + '.lock'
+        self.file = None
+
+    def acquire(self):
+        self.file = open(self.path, 'a')
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            raise IndexLocked("%s is held by another process updating the indexes" % self.path)
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class RelatedIndex:
+    """ Cosine similarity index over unit tf-idf article vectors.
+
+        Indexed vectors are kept column-major (CSC), which makes each term
+        column a postings list, so scoring a query only touches the articles
+        that share a term with it. A row-major copy serves lookups of an
+        indexed article's own vector. Newly added articles go to a small
+        row-major delta that is merged into the postings once it grows past
+        COMPACT_FRACTION of the index. The terms each article was counted
+        under are kept as well, since a term with zero idf has no entry in the
+        vectors but still counts towards the document frequencies.
+
+        Added articles are weighted with the idfs at the time they were added;
+        call rebuild() to reweight everything against the current corpus."""
+
+    def __init__(self, vectorizer=None, vectors=None, article_ids=None, patterns=None):
+        self.vectorizer = vectorizer or Vectorizer()
+        self.vectors = vectors if vectors is not None else sparse.csr_matrix((0, 0))
+        self.postings = sparse.csc_matrix(self.vectors)
+        # Blocks of (articles x terms) term patterns, together one row per indexed article
+        self.patterns = [patterns if patterns is not None else term_pattern(self.vectors)]
+        self.article_ids = list(article_ids) if article_ids is not None else []
+        self.rows = {a: i for i, a in enumerate(self.article_ids)}
+        self.delta = []
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def __contains__(self, article_id):
+        return article_id in self.rows
+
+    def add(self, article_ids, documents):
+        """Vectorize and index filtered documents, skipping article ids already indexed"""
+        new = [(a, d) for a, d in zip(article_ids, documents) if a not in self.rows]
+        if not new:
+            return 0
+        for a, _ in new:
+            self.rows[a] = len(self.article_ids)
+            self.article_ids.append(a)
+        counts = self.vectorizer.count(d for _, d in new)
+        self.patterns.append(term_pattern(counts))
+        self.delta.append(self.vectorizer.tf_idf(counts))
+        if sum(m.shape[0] for m in self.delta) > COMPACT_FRACTION * self.postings.shape[0]:
+            self.compact()
+        return len(new)
+
+    def compact(self):
+        """Merge every appended article into the column-major postings"""
+        if not self.delta:
+            return
+        num_terms = len(self.vectorizer.vocabulary)
+        blocks = [widen(self.vectors, num_terms)] + [widen(m, num_terms) for m in self.delta]
+        self.vectors = sparse.vstack(blocks, format='csr')
+        self.postings = sparse.csc_matrix(self.vectors)
+        self.delta = []
+
+    def retain(self, article_ids):
+        """ Drop every indexed article not among article_ids, e.g. once it falls
+            out of the corpus window, along with its document frequencies and
+            any terms left in no article. Returns the number dropped."""
+        article_ids = set(article_ids)
+        keep = numpy.array([a in article_ids for a in self.article_ids], dtype=bool)
+        if keep.all():
+            return 0
+        self.compact()
+        num_terms = len(self.vectorizer.vocabulary)
+        vectors = widen(self.vectors, num_terms)
+        patterns = self.stacked_patterns()
+        self.vectorizer.forget(patterns[~keep])
+        vectors = vectors[keep]
+        patterns = patterns[keep]
+        live = self.vectorizer.prune(used_terms(patterns, num_terms))
+        if live is not None:
+            vectors = vectors[:, live]
+            patterns = patterns[:, live]
+        self.patterns = [sparse.csr_matrix(patterns)]
+        self.vectors = sparse.csr_matrix(vectors)
+        self.postings = sparse.csc_matrix(self.vectors)
+        self.article_ids = [a for a, k in zip(self.article_ids, keep.tolist()) if k]
+        self.rows = {a: i for i, a in enumerate(self.article_ids)}
+        return int(len(keep) - keep.sum())
+
+    def rebuild(self, documents):
+        """Re-vectorize every indexed article (given in index order) against fresh idfs"""
+        vectorizer = Vectorizer()
+        if self.vectorizer.corpus is not None:
+            vectorizer.use_corpus(self.vectorizer.corpus, self.vectorizer.num_docs)
+        counts = vectorizer.count(documents)
+        self.vectors = vectorizer.tf_idf(counts)
+        self.postings = sparse.csc_matrix(self.vectors)
+        self.patterns = [term_pattern(counts)]
+        self.vectorizer = vectorizer
+        self.delta = []
+
+    def stacked_patterns(self):
+        """The term pattern of every indexed article as one (articles x terms) CSR matrix"""
+        num_terms = len(self.vectorizer.vocabulary)
+        return sparse.vstack([widen(p, num_terms) for p in self.patterns], format='csr')
+
+    def vector(self, article_id):
+        """The indexed unit vector of an article as a 1 x terms CSR row"""
+        row = self.rows[article_id]
+        if row < self.vectors.shape[0]:
+            return self.vectors[row]
+        row -= self.vectors.shape[0]
+        for m in self.delta:
+            if row < m.shape[0]:
+                return m[row]
+            row -= m.shape[0]
+
+    def scores(self, query):
+        """Cosine similarity of a unit 1 x terms query vector with every indexed article"""
+        query = sparse.csr_matrix(query)
+        terms, weights = query.indices, query.data
+        scores = numpy.zeros(len(self.article_ids))
+        known = terms < self.postings.shape[1]
+        n = self.postings.shape[0]
+        if n and known.any():
+            scores[:n] = self.postings[:, terms[known]] @ weights[known]
+        for m in self.delta:
+            width = max(m.shape[1], query.shape[1])
+            scores[n:n + m.shape[0]] = (widen(m, width) @ widen(query, width).T).toarray().ravel()
+            n += m.shape[0]
+        return scores
+
+    def top_k(self, query, n, exclude=None):
+        """Ids and similarities of the n indexed articles most similar to a query vector"""
+        scores = self.scores(query)
+        if exclude is not None:
+            scores[self.rows[exclude]] = -numpy.inf
+        n = min(n, len(scores) - (exclude is not None))
+        if n <= 0:
+            return []
+        best = numpy.argpartition(-scores, n - 1)[:n]
+        best = best[numpy.argsort(-scores[best])]
+        return [(self.article_ids[i], float(scores[i])) for i in best if scores[i] > 0]
+
+    def related(self, article_id, n=10, document=None):
+        """ Ids and similarities of the n articles most related to an article.
+            Articles that aren't indexed yet are vectorized from their filtered document."""
+        if article_id in self.rows:
+            return self.top_k(self.vector(article_id), n, exclude=article_id)
+        if document is None:
+            return []
+        return self.top_k(self.vectorizer.transform([document]), n)
+
+    def save(self, path=RELATED_INDEX_FILE):
+        self.compact()
+        vectors = self.vectors
+        patterns = self.stacked_patterns()
+        self.patterns = [patterns]
+        tmp_path = path + '.tmp.npz'
+        numpy.savez(tmp_path,
+                    data=vectors.data, indices=vectors.indices, indptr=vectors.indptr,
+                    shape=numpy.array(vectors.shape),
+                    pattern_indices=patterns.indices, pattern_indptr=patterns.indptr, article_ids=numpy.array(self.article_ids, dtype=numpy.int64),
+                    terms=numpy.array(self.vectorizer.terms(), dtype=str),
+                    doc_frequencies=numpy.frombuffer(self.vectorizer.doc_frequencies, dtype=numpy.int64).copy(),
+                    num_docs=numpy.array(self.vectorizer.num_docs))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=RELATED_INDEX_FILE):
+        """Load a saved index, or start an empty one if none has been saved"""
+        if not os.path.exists(path):
+            return cls()
+        with numpy.load(path) as f:
+            terms = f['terms'].tolist()
+            vectorizer = Vectorizer({t: i for i, t in enumerate(terms)}, f['doc_frequencies'].tolist(), int(f['num_docs']))
+            vectors = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            patterns = None
+            if 'pattern_indices' in f:
+                indices = f['pattern_indices']
+                patterns = sparse.csr_matrix((numpy.ones(len(indices), dtype=bool), indices, f['pattern_indptr']),
+                                             shape=vectors.shape)
+            return cls(vectorizer, vectors, f['article_ids'].tolist(), patterns)
+
+def term_pattern(matrix):
+    """A boolean CSR matrix with an entry wherever a (docs x terms) matrix has one"""
+    matrix = sparse.csr_matrix(matrix)
+    return sparse.csr_matrix((numpy.ones(len(matrix.indices), dtype=bool), matrix.indices, matrix.indptr),
+                             shape=matrix.shape)
+
+def related_articles(article, n=10, index=None):
+    """ The n stored articles most related to an article, as (article, similarity)
+        pairs from most to least similar. Loads the saved index if none is given."""
+    if index is None:
+        index = RelatedIndex.load()
+    article_id = db_manager.get_article_id(article)
+    document = None
+    if article_id not in index and db_manager.is_filtered(article):
+        document = db_manager.get_filtered_text(article)
+    related = index.related(article_id, n, document)
+    by_id = db_manager.get_articles_by_id([i for i, _ in related])
+    return [(by_id[i], score) for i, score in related if i in by_id]
@@ -1,34 +1,60 @@
-import feedparser
 import re
 from datetime import datetime
 from time import mktime
 from db_manager import *
 from article import *
+from constants import SCORINGS
+import metrics
 import argparse
 
+# Feed parsing, the indexes and the projection pull in feedparser, numpy and
+# scipy, so only the commands using them import them and lookups such as -c
+# and -p start without them
 
 def read_rss_urls(filename):
-    """ Parse filename for a list of RSS feed URLS """
-    return [line for line in open(filename, 'r')]
+    """ Parse filename for a list of unique RSS feed URLS """
+    from feed_poller import dedupe_urls
+    with open(filename, 'r') as f:
+        return dedupe_urls(f)
+
+def add_feed_entries(url, feed):
+    """ Add every article entry of a parsed feed to the database """
+    articles = [a for a in map(Article.from_feedparser, feed.entries) if a]
+    added = add_articles(articles)
+    print('Added %s new of %s articles from %s' % (added, len(articles), url))
 
 def update_feed(url):
+    import feedparser
     print("Updating URL: %s" % url)
-    feed = feedparser.parse(url)
+    with metrics.timer('feed_fetch_seconds'):
+        feed = feedparser.parse(url)
     if feed.bozo == 1:
         print("Malformed RSS Feed")
+        metrics.inc('feeds_polled', result='malformed')
         return
-    for item in feed.entries:
-        a = Article.from_feedparser(item)
-        if a:
-            add_article(a)
-            print('Added %s ...' % a.link)
+    metrics.inc('feeds_polled', result='fetched')
+    add_feed_entries(url, feed)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='RSS Parser Program')
     parser.add_argument("-c", "--count", action="store_true",  help='get number of articles stored')
     parser.add_argument("-p", "--publishers", action="store_true", help="list unique publishers for articles in the database")
+    parser.add_argument("-r", "--related", metavar="LINK", help="list the stored articles most related to the article with this link")
+    parser.add_argument("-s", "--search", metavar="QUERY", help="list the stored articles best matching a keyword query")
+    parser.add_argument("-n", "--num", type=int, default=10, help="number of related articles or search results to list")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="only search articles published on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="only search articles published before this date (YYYY-MM-DD)")
+    parser.add_argument("--publisher", action="append", help="only search articles from this publisher domain (repeatable)")
+    parser.add_argument("--scoring", choices=SCORINGS, default='bm25', help="how search results are ranked")
+    parser.add_argument("-d", "--duplicates", metavar="LINK", help="list the recorded near-duplicates of the article with this link")
+    parser.add_argument("--reduced", action="store_true", help="compare related articles in the reduced SVD space (see reduction.py)")
+    parser.add_argument("-a", "--async-poll", action="store_true", help="poll all feeds concurrently using conditional GETs")
+    parser.add_argument("--per-host", type=int, default=2, help="max concurrent connections per feed host when polling asynchronously")
+    parser.add_argument("--timeout", type=float, default=15, help="per-feed fetch timeout in seconds when polling asynchronously")
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
+    metrics.from_arguments(args)
 
     if args.count:
         print("Number of articles stored: %s" % num_articles())
@@ -36,7 +62,45 @@ if __name__ == '__main__':
         print("Article publishers in database:")
         for p in get_unique_publishers():
             print("    - %s" % p)
+    elif args.related:
+        from related_index import related_articles
+        from reduction import Projection
+        article = get_article_by_link(args.related)
+        index = Projection.load() if args.reduced else None
+        if not article:
+            print("No stored article with link %s" % args.related)
+        elif args.reduced and index is None:
+            print("No saved projection; run reduction.py first")
+        else:
+            print("Articles related to %s:" % article.title)
+            for a, score in related_articles(article, args.num, index):
+                print("    - {0:.3f}  {1}".format(score, a.link))
+    elif args.search:
+        from search_index import search_articles
+        results = search_articles(args.search, args.num, args.since, args.until, args.publisher, args.scoring)
+        print("Articles matching %r:" % args.search)
+        for a, score in results:
+            print("    - {0:.3f}  {1}  {2}".format(score, a.published, a.link))
+    elif args.duplicates:
+        article = get_article_by_link(args.duplicates)
+        if not article:
+            print("No stored article with link %s" % args.duplicates)
+        else:
+            canonical_id = get_canonical_id(article)
+            if canonical_id > 0:
+                print("Duplicate of %s" % get_articles_by_id([canonical_id])[canonical_id].link)
+            print("Duplicates of %s:" % article.title)
+            for a, method, similarity in get_duplicates(article):
+                print("    - {0:.3f}  {1:<8} {2}".format(similarity, method, a.link))
+    elif args.async_poll:
+        from feed_poller import poll_feeds
+        with metrics.profiled('poll'):
+            stats = poll_feeds(read_rss_urls('feeds.txt'), add_feed_entries,
+                               per_host=args.per_host, timeout=args.timeout)
+        print(stats)
     else:
-        for url in read_rss_urls('feeds.txt'):
-            update_feed(url)
+        with metrics.profiled('poll'):
+            for url in read_rss_urls('feeds.txt'):
+                update_feed(url)
+    metrics.write_from_arguments(args)
 
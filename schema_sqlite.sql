@@ -0,0 +1,82 @@
+-- SQLite version of schema.sql, created automatically by storage.SQLiteBackend.
+
+CREATE TABLE IF NOT EXISTS articles (
+    article_id   INTEGER PRIMARY KEY,
+    title        TEXT,
+    description  TEXT,
+    link         TEXT UNIQUE NOT NULL,
+    published    TIMESTAMP
+);
+
+-- Window queries (see iter_articles start/end) and the retention job scan articles by date
+CREATE INDEX IF NOT EXISTS articles_published ON articles (published);
+
+CREATE TABLE IF NOT EXISTS failed_articles (
+    article_id   INTEGER PRIMARY KEY REFERENCES articles (article_id),
+    fail_date    TIMESTAMP
+);
+
+-- Integer id for every term seen in filtered text
+CREATE TABLE IF NOT EXISTS terms (
+    term_id  INTEGER PRIMARY KEY,
+    term     TEXT UNIQUE NOT NULL
+);
+
+-- Filtered text as packed little-endian int32 term ids
+CREATE TABLE IF NOT EXISTS filtered_articles (
+    article_id       INTEGER PRIMARY KEY REFERENCES articles (article_id),
+    filtered_tokens  BLOB NOT NULL
+);
+
+-- Near-duplicate fingerprints of canonical articles (see dedup.py): a signed 64-bit
+-- SimHash of the title and description, and a packed uint32 MinHash signature of the filtered text
+CREATE TABLE IF NOT EXISTS article_fingerprints (
+    article_id  INTEGER PRIMARY KEY REFERENCES articles (article_id),
+    simhash     BIGINT,
+    minhash     BLOB
+);
+
+-- Articles that nearly duplicate an earlier canonical article. They are never
+-- downloaded (method 'simhash') or never vectorized (method 'minhash').
+CREATE TABLE IF NOT EXISTS duplicate_articles (
+    article_id    INTEGER PRIMARY KEY REFERENCES articles (article_id),
+    canonical_id  INTEGER NOT NULL REFERENCES articles (article_id),
+    method        TEXT NOT NULL,
+    similarity    REAL
+);
+
+CREATE INDEX IF NOT EXISTS duplicate_articles_canonical ON duplicate_articles (canonical_id);
+
+-- Articles past the retention period (see db_manager.expire_articles). Their filtered
+-- text and fingerprints were dropped, and they are never processed again.
+CREATE TABLE IF NOT EXISTS expired_articles (
+    article_id    INTEGER PRIMARY KEY REFERENCES articles (article_id),
+    expired_date  TIMESTAMP
+);
+
+-- Article processing jobs (download, filter) claimed by work_queue.py
+-- workers. state is pending, leased (by worker until lease_expires), done, or failed
+-- once a job's leases have run out too many times.
+CREATE TABLE IF NOT EXISTS article_jobs (
+    article_id     INTEGER PRIMARY KEY REFERENCES articles (article_id),
+    state          TEXT NOT NULL DEFAULT 'pending',
+    worker         TEXT,
+    lease_expires  TIMESTAMP,
+    attempts       INTEGER NOT NULL DEFAULT 0,
+    updated        TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS article_jobs_state ON article_jobs (state, article_id);
+
+-- Number of filtered articles containing each term, maintained by add_to_filtered/remove_from_filtered
+CREATE TABLE IF NOT EXISTS document_frequencies (
+    term           TEXT PRIMARY KEY,
+    doc_frequency  INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS corpus_stats (
+    stat   TEXT PRIMARY KEY,
+    value  INTEGER NOT NULL
+);
+
+INSERT INTO corpus_stats (stat, value) VALUES ('num_docs', 0) ON CONFLICT DO NOTHING;
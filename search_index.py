@@ -0,0 +1,334 @@
+import os
+from collections import Counter
+from datetime import datetime
+from math import log, log10, sqrt
+from time import mktime, struct_time
+import numpy
+from scipy import sparse
+from vectorizer import Vectorizer, widen, used_terms
+from text_normalizer import normalize
+from constants import SCORINGS
+import db_manager
+import metrics
+
+SEARCH_INDEX_FILE = 'search_index.npz'
+# Merge appended articles into the postings once they exceed this fraction of the index
+COMPACT_FRACTION = 0.1
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def timestamp(published):
+    """Seconds since the epoch of a stored or feed publication date, or NaN if it is unknown"""
+    if isinstance(published, datetime):
+        return published.timestamp()
+    if isinstance(published, struct_time):
+        return mktime(published)
+    return float('nan')
+
+def publisher_domain(publisher):
+    """ Domain of a link, or of a publisher given as a domain or as returned by
+        get_unique_publishers, without a leading www. as in db_manager"""
+    return db_manager.publisher_host(publisher)
+
+class SearchIndex:
+    """ Inverted index of filtered article text for top-k keyword search.
+
+        Raw term counts are kept column-major (CSC), which makes each term
+        column a postings list of the articles containing it in index order.
+        As in RelatedIndex, newly added articles go to a small row-major delta
+        that is merged into the postings once it grows past COMPACT_FRACTION
+        of the index.
+
+        Queries are scored with BM25 or tf-idf cosine. Along with the postings,
+        each term keeps an upper bound on what it can add to an article's
+        score, so search() can stop looking at new articles early (MaxScore).
+        Cosine document lengths use the idfs at the time an article was added."""
+
+    def __init__(self, vectorizer=None):
+        self.vectorizer = vectorizer or Vectorizer()
+        self.postings = sparse.csc_matrix((0, 0))
+        self.delta = []
+        self._delta_postings = None
+        self.article_ids = []
+        self.rows = {}
+        # Per indexed article
+        self.lengths = numpy.zeros(0)
+        self.max_counts = numpy.zeros(0)
+        self.norms = numpy.zeros(0)
+        self.published = numpy.zeros(0)
+        self.publishers = numpy.zeros(0, dtype=numpy.int32)
+        self.publisher_names = []
+        self.publisher_ids = {}
+        # Per term, by column
+        self.term_max_counts = numpy.zeros(0)
+        self.term_min_lengths = numpy.zeros(0)
+        self.term_max_weights = numpy.zeros(0)
+        self.average_length = 1.0
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def __contains__(self, article_id):
+        return article_id in self.rows
+
+    def publisher_id(self, link):
+        domain = publisher_domain(link or '')
+        if domain not in self.publisher_ids:
+            self.publisher_ids[domain] = len(self.publisher_names)
+            self.publisher_names.append(domain)
+        return self.publisher_ids[domain]
+
+    def add(self, article_ids, documents, published=None, links=None):
+        """ Index filtered documents, skipping article ids already indexed.
+            published and links are the articles' publication dates and links,
+            for filtering searches by date and publisher."""
+        article_ids = list(article_ids)
+        documents = list(documents)
+        published = list(published) if published is not None else [None] * len(article_ids)
+        links = list(links) if links is not None else [None] * len(article_ids)
+        new = []
+        for i, a in enumerate(article_ids):
+            if a not in self.rows:
+                self.rows[a] = len(self.article_ids)
+                self.article_ids.append(a)
+                new.append(i)
+        if not new:
+            return 0
+        counts = self.vectorizer.count((documents[i] for i in new), raw=True)
+        rows = numpy.repeat(numpy.arange(len(new)), numpy.diff(counts.indptr))
+        lengths = numpy.asarray(counts.sum(axis=1), dtype=numpy.float64).ravel()
+        max_counts = counts.max(axis=1).toarray().ravel().astype(numpy.float64)
+        max_counts[max_counts == 0] = 1.0
+        augmented = 0.5 + 0.5 * counts.data / max_counts[rows]
+        norms = numpy.sqrt(numpy.bincount(rows, (augmented * self.vectorizer.idfs()[counts.indices]) ** 2, minlength=len(new)))
+        norms[norms == 0] = 1.0
+
+        num_terms = len(self.vectorizer.vocabulary)
+        grow = num_terms - len(self.term_max_counts)
+        self.term_max_counts = numpy.concatenate([self.term_max_counts, numpy.zeros(grow)])
+        self.term_min_lengths = numpy.concatenate([self.term_min_lengths, numpy.full(grow, numpy.inf)])
+        self.term_max_weights = numpy.concatenate([self.term_max_weights, numpy.zeros(grow)])
+        numpy.maximum.at(self.term_max_counts, counts.indices, counts.data)
+        numpy.minimum.at(self.term_min_lengths, counts.indices, lengths[rows])
+        numpy.maximum.at(self.term_max_weights, counts.indices, augmented / norms[rows])
+
+        self.lengths = numpy.concatenate([self.lengths, lengths])
+        self.max_counts = numpy.concatenate([self.max_counts, max_counts])
+        self.norms = numpy.concatenate([self.norms, norms])
+        self.published = numpy.concatenate([self.published, [timestamp(published[i]) for i in new]])
+        self.publishers = numpy.concatenate([self.publishers, numpy.array([self.publisher_id(links[i]) for i in new], dtype=numpy.int32)])
+
+        self.delta.append(counts)
+        self._delta_postings = None
+        if sum(m.shape[0] for m in self.delta) > COMPACT_FRACTION * self.postings.shape[0]:
+            self.compact()
+        metrics.set_gauge('search_index_articles', len(self))
+        return len(new)
+
+    def compact(self):
+        """Merge every appended article into the column-major postings"""
+        if not self.delta:
+            return
+        num_terms = len(self.vectorizer.vocabulary)
+        postings = self.postings.copy()
+        postings.resize((postings.shape[0], num_terms))
+        self.postings = sparse.vstack([postings] + [widen(m, num_terms) for m in self.delta], format='csc')
+        self.postings.sort_indices()
+        self.delta = []
+        self._delta_postings = None
+
+    def retain(self, article_ids):
+        """ Drop every indexed article not among article_ids, e.g. once it falls
+            out of the corpus window, along with its document frequencies and
+            any terms left in no article. The remaining terms keep their upper
+            bounds, which stay valid if looser. Returns the number dropped."""
+        article_ids = set(article_ids)
+        keep = numpy.array([a in article_ids for a in self.article_ids], dtype=bool)
+        if keep.all():
+            return 0
+        self.compact()
+        postings = sparse.csr_matrix(self.postings)
+        postings.resize((postings.shape[0], len(self.vectorizer.vocabulary)))
+        self.vectorizer.forget(postings[~keep])
+        postings = postings[keep]
+        live = self.vectorizer.prune(used_terms(postings, postings.shape[1]))
+        if live is not None:
+            postings = postings[:, live]
+            self.term_max_counts = self.term_max_counts[live]
+            self.term_min_lengths = self.term_min_lengths[live]
+            self.term_max_weights = self.term_max_weights[live]
+        self.postings = sparse.csc_matrix(postings)
+        self.postings.sort_indices()
+        for name in ('lengths', 'max_counts', 'norms', 'published', 'publishers'):
+            setattr(self, name, getattr(self, name)[keep])
+        self.article_ids = [a for a, k in zip(self.article_ids, keep.tolist()) if k]
+        self.rows = {a: i for i, a in enumerate(self.article_ids)}
+        return int(len(keep) - keep.sum())
+
+    def delta_postings(self):
+        if self.delta and self._delta_postings is None:
+            num_terms = len(self.vectorizer.vocabulary)
+            self._delta_postings = sparse.vstack([widen(m, num_terms) for m in self.delta], format='csc')
+            self._delta_postings.sort_indices()
+        return self._delta_postings
+
+    def term_postings(self, col):
+        """Ascending index rows of the articles containing a term, and the term's count in each"""
+        parts = []
+        for postings, offset in ((self.postings, 0), (self.delta_postings(), self.postings.shape[0])):
+            if postings is not None and col < postings.shape[1]:
+                start, end = postings.indptr[col], postings.indptr[col + 1]
+                parts.append((postings.indices[start:end] + offset, postings.data[start:end]))
+        if len(parts) == 1:
+            return parts[0]
+        return numpy.concatenate([p[0] for p in parts]), numpy.concatenate([p[1] for p in parts])
+
+    def query_weights(self, terms, scoring):
+        """(column, weight) of every indexed term of a filtered query that can add to a score"""
+        counts = Counter(t for t in terms if t in self.vectorizer.vocabulary)
+        if not counts:
+            return []
+        num_docs = self.vectorizer.num_docs
+        cols = [self.vectorizer.vocabulary[t] for t in counts]
+        doc_frequencies = [self.vectorizer.doc_frequencies[c] for c in cols]
+        if scoring == 'bm25':
+            weights = [f * log(1 + (num_docs - n + 0.5) / (n + 0.5)) for f, n in zip(counts.values(), doc_frequencies)]
+        else:
+            # The query's own unit tf-idf vector, times the idf the articles are weighted with
+            max_f = max(counts.values())
+            idfs = [max(0.0, log10(num_docs / (1.0 + n))) for n in doc_frequencies]
+            query = [(0.5 + 0.5 * f / max_f) * idf for f, idf in zip(counts.values(), idfs)]
+            length = sqrt(sum(q * q for q in query)) or 1.0
+            weights = [q / length * idf for q, idf in zip(query, idfs)]
+        return [(c, w) for c, w in zip(cols, weights) if w > 0]
+
+    def upper_bound(self, col, weight, scoring):
+        """The most a query term can add to any article's score"""
+        if scoring == 'bm25':
+            f = self.term_max_counts[col]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.term_min_lengths[col] / self.average_length)
+            return weight * f * (BM25_K1 + 1) / (f + norm)
+        return weight * self.term_max_weights[col]
+
+    def contributions(self, rows, counts, weight, scoring):
+        """What a query term adds to the scores of the articles at rows, given its counts in them"""
+        if scoring == 'bm25':
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[rows] / self.average_length)
+            return weight * counts * (BM25_K1 + 1) / (counts + norm)
+        return weight * (0.5 + 0.5 * counts / self.max_counts[rows]) / self.norms[rows]
+
+    def allowed(self, start=None, end=None, publishers=None):
+        """Mask of the indexed articles published in [start, end) by one of publishers, or None to allow all"""
+        mask = None
+        if start is not None:
+            mask = self.published >= timestamp(start)
+        if end is not None:
+            before = self.published < timestamp(end)
+            mask = before if mask is None else mask & before
+        if publishers:
+            ids = [self.publisher_ids[d] for d in map(publisher_domain, publishers) if d in self.publisher_ids]
+            by = numpy.isin(self.publishers, ids)
+            mask = by if mask is None else mask & by
+        return mask
+
+    def search(self, query, n=10, start=None, end=None, publishers=None, scoring='bm25'):
+        """ Ids and scores of the n indexed articles best matching a query, from best
+            to worst. The query is raw text, normalized like article text, or a
+            list of filtered terms. start/end bound the publication date (end
+            exclusive) and publishers limits results to the given domains.
+
+            Query terms are scored one at a time, from the highest upper bound
+            down. Once the bounds of the terms left add up to less than the n-th
+            best score so far, no article missing from every term scored so far
+            can make the top n. The remaining terms then only score the articles
+            already found, and articles are dropped as soon as their score plus
+            the bounds left falls below the n-th best."""
+        if scoring not in SCORINGS:
+            raise ValueError("Unknown scoring %r; expected one of %s" % (scoring, ', '.join(SCORINGS)))
+        terms = normalize(query) if isinstance(query, str) else query
+        weights = self.query_weights(terms, scoring)
+        if not weights or n <= 0 or not len(self):
+            return []
+        with metrics.timer('search_seconds', scoring=scoring):
+            allowed = self.allowed(start, end, publishers)
+            self.average_length = self.lengths.mean() or 1.0
+            bounded = sorted(((self.upper_bound(c, w, scoring), c, w) for c, w in weights), reverse=True)
+            remaining = sum(b for b, _, _ in bounded)
+            # Every article a term was scored for has a positive score
+            scores = numpy.zeros(len(self))
+            candidates = None
+            threshold = 0.0
+            for bound, col, weight in bounded:
+                rows, counts = self.term_postings(col)
+                if candidates is None and remaining < threshold:
+                    candidates = numpy.flatnonzero(scores)
+                    candidate_scores = scores[candidates]
+                if candidates is None:
+                    if allowed is not None:
+                        keep = allowed[rows]
+                        rows, counts = rows[keep], counts[keep]
+                    scores[rows] += self.contributions(rows, counts, weight, scoring)
+                    if len(rows) >= n:
+                        threshold = max(threshold, numpy.partition(scores[rows], -n)[-n])
+                else:
+                    keep = candidate_scores + remaining >= threshold
+                    candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+                    at = numpy.minimum(numpy.searchsorted(rows, candidates), len(rows) - 1)
+                    hit = numpy.flatnonzero(rows[at] == candidates) if len(rows) else numpy.zeros(0, dtype=numpy.int64)
+                    candidate_scores[hit] += self.contributions(candidates[hit], counts[at[hit]], weight, scoring)
+                remaining -= bound
+            if candidates is None:
+                candidates = numpy.flatnonzero(scores)
+                candidate_scores = scores[candidates]
+            metrics.inc('search_candidates', len(candidates))
+            n = min(n, len(candidates))
+            if n <= 0:
+                return []
+            best = numpy.argpartition(-candidate_scores, n - 1)[:n]
+            best = best[numpy.argsort(-candidate_scores[best], kind='stable')]
+            return [(self.article_ids[candidates[i]], float(candidate_scores[i])) for i in best if candidate_scores[i] > 0]
+
+    def save(self, path=SEARCH_INDEX_FILE):
+        self.compact()
+        postings = self.postings
+        tmp_path = path + '.tmp.npz'
+        numpy.savez(tmp_path,
+                    data=postings.data, indices=postings.indices, indptr=postings.indptr,
+                    shape=numpy.array(postings.shape), article_ids=numpy.array(self.article_ids, dtype=numpy.int64),
+                    lengths=self.lengths, max_counts=self.max_counts, norms=self.norms,
+                    published=self.published, publishers=self.publishers,
+                    publisher_names=numpy.array(self.publisher_names, dtype=str),
+                    term_max_counts=self.term_max_counts, term_min_lengths=self.term_min_lengths,
+                    term_max_weights=self.term_max_weights,
+                    terms=numpy.array(self.vectorizer.terms(), dtype=str),
+                    doc_frequencies=numpy.frombuffer(self.vectorizer.doc_frequencies, dtype=numpy.int64).copy(),
+                    num_docs=numpy.array(self.vectorizer.num_docs))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=SEARCH_INDEX_FILE):
+        """Load a saved index, or start an empty one if none has been saved"""
+        if not os.path.exists(path):
+            return cls()
+        with numpy.load(path) as f:
+            terms = f['terms'].tolist()
+            index = cls(Vectorizer({t: i for i, t in enumerate(terms)}, f['doc_frequencies'].tolist(), int(f['num_docs'])))
+            index.postings = sparse.csc_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            index.article_ids = f['article_ids'].tolist()
+            index.rows = {a: i for i, a in enumerate(index.article_ids)}
+            for name in ('lengths', 'max_counts', 'norms', 'published', 'publishers',
+                         'term_max_counts', 'term_min_lengths', 'term_max_weights'):
+                setattr(index, name, f[name])
+            index.publisher_names = f['publisher_names'].tolist()
+            index.publisher_ids = {p: i for i, p in enumerate(index.publisher_names)}
+            return index
+
+def search_articles(query, n=10, start=None, end=None, publishers=None, scoring='bm25', index=None):
+    """ The n stored articles best matching a keyword query, as (article, score)
+        pairs from best to worst. Loads the saved index if none is given."""
+    if index is None:
+        index = SearchIndex.load()
+    results = index.search(query, n, start, end, publishers, scoring)
+    by_id = db_manager.get_articles_by_id([i for i, _ in results])
+    return [(by_id[i], score) for i, score in results if i in by_id]
@@ -0,0 +1,261 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import weakref
+from itertools import count
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_DATABASE = "dbname=article_db user=postgres"
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+SQLITE_SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema_sqlite.sql')
+
+class StorageBackend:
+    """ A database that db_manager runs its queries against.
+
+        Queries are written for Postgres, with %s placeholders. Backends hand
+        every process and thread its own connection, so forked workers and
+        extraction threads never share a socket or SQLite handle."""
+
+    begin = "BEGIN;"
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def connect(self):
+        raise NotImplementedError
+
+    def translate(self, query):
+        """Rewrite a Postgres query for this database"""
+        return query
+
+    def release(self, conn, pid):
+        """Close the connection of a thread that has finished"""
+        if pid == os.getpid():
+            conn.close()
+
+    def connection(self):
+        """ The calling thread's connection, opened on first use in each process
+            and released once the thread is gone, so short-lived threads don't
+            hold on to connections"""
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            conn = self.local.conn = self.connect()
+            self.local.pid = pid
+            weakref.finalize(threading.current_thread(), self.release, conn, pid).atexit = False
+        return self.local.conn
+
+    @contextmanager
+    def cursor(self):
+        curr = self.connection().cursor()
+        try:
+            yield curr
+        finally:
+            curr.close()
+
+    def execute(self, curr, query, args=None):
+        if args:
+            curr.execute(self.translate(query), args)
+        else:
+            curr.execute(self.translate(query))
+
+    @contextmanager
+    def stream(self, itersize):
+        """ Cursor for iterating over a large result without holding all of it,
+            fetching itersize rows at a time."""
+        with self.cursor() as curr:
+            curr.arraysize = itersize
+            yield curr
+
+    @contextmanager
+    def transaction(self):
+        """ Run several statements atomically on this thread's connection.
+            Yields a cursor; commits on success and rolls back on any exception."""
+        with self.cursor() as curr:
+            curr.execute(self.begin)
+            try:
+                yield curr
+            except:
+                curr.execute("ROLLBACK;")
+                raise
+            curr.execute("COMMIT;")
+
+    def execute_values(self, curr, query, rows, page_size=1000, fetch=False):
+        """ Run a query with a single "VALUES %s" for every row, page_size rows
+            per statement. Returns the fetched rows if fetch is set, otherwise
+            the total row count."""
+        rows = list(rows)
+        if not rows:
+            return [] if fetch else 0
+        width = len(rows[0])
+        row_sql = '(' + ', '.join(['%s'] * width) + ')'
+        page_size = max(1, min(page_size, self.max_variables // width))
+        fetched, count = [], 0
+        for start in range(0, len(rows), page_size):
+            page = rows[start:start + page_size]
+            values = ', '.join([row_sql] * len(page))
+            self.execute(curr, query.replace('VALUES %s', 'VALUES ' + values), [v for row in page for v in row])
+            if fetch:
+                fetched.extend(curr.fetchall())
+            count += curr.rowcount
+        return fetched if fetch else count
+
+    def create_schema(self):
+        raise NotImplementedError
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            conn.close()
+            self.local.conn = None
+
+class PostgresBackend(StorageBackend):
+    """ Postgres through a psycopg2 connection pool.
+
+        Each thread checks its own autocommit connection out of a pool that is
+        created separately in every process, so children never reuse the
+        parent's sockets."""
+
+    max_variables = 65535
+    binary_type = 'BYTEA'
+    size_function = 'pg_column_size'
+    vacuum = "VACUUM FULL;"
+
+    def __init__(self, dsn=DEFAULT_DATABASE, max_connections=32):
+        super().__init__()
+        self.dsn = dsn
+        self.max_connections = max_connections
+        self.pool = None
+        self.pool_pid = None
+        self.lock = threading.Lock()
+        self.stream_ids = count()
+        self.thread_ids = count()
+
+    def connect(self):
+        from psycopg2.pool import ThreadedConnectionPool
+        with self.lock:
+            if self.pool_pid != os.getpid():
+                self.pool = ThreadedConnectionPool(1, self.max_connections, self.dsn)
+                self.pool_pid = os.getpid()
+        # A key of its own per thread: thread idents are reused, connections must not be
+        conn = self.pool.getconn(key=('thread', next(self.thread_ids)))
+        conn.autocommit = True
+        return conn
+
+    def release(self, conn, pid):
+        """Put the connection of a thread that has finished back into the pool"""
+        from psycopg2.pool import PoolError
+        with self.lock:
+            if pid != os.getpid() or self.pool is None or self.pool.closed:
+                return
+            try:
+                self.pool.putconn(conn)
+            except PoolError:
+                # Checked out of an earlier pool that has since been closed
+                pass
+
+    @contextmanager
+    def stream(self, itersize):
+        """ A named server-side cursor on its own pooled connection. Rows come
+            over in itersize batches, and the calling thread's connection stays
+            free for other queries while the stream is open."""
+        self.connection()
+        key = ('stream', next(self.stream_ids))
+        conn = self.pool.getconn(key=key)
+        # Named cursors only live inside a transaction
+        conn.autocommit = False
+        curr = conn.cursor(name='stream_%d' % key[1])
+        curr.itersize = itersize
+        try:
+            yield curr
+        finally:
+            # Rolling back also drops the server-side cursor, even after an error
+            conn.rollback()
+            curr.close()
+            conn.autocommit = True
+            self.pool.putconn(conn, key=key)
+
+    def create_schema(self):
+        with open(SCHEMA_FILE) as f:
+            with self.cursor() as curr:
+                curr.execute(f.read())
+
+    def close(self):
+        if self.pool is not None and self.pool_pid == os.getpid():
+            self.pool.closeall()
+            self.pool = None
+
+def adapt_datetime(value):
+    return value.isoformat(' ')
+
+def convert_datetime(value):
+    return datetime.fromisoformat(value.decode())
+
+# List parameters (as used with = ANY) are passed to SQLite as JSON, and JSONARRAY columns hold JSON lists
+sqlite3.register_adapter(list, json.dumps)
+sqlite3.register_adapter(datetime, adapt_datetime)
+sqlite3.register_converter('JSONARRAY', json.loads)
+sqlite3.register_converter('TIMESTAMP', convert_datetime)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA foreign_keys = ON;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -65536;",
+    "PRAGMA mmap_size = 268435456;",
+    "PRAGMA busy_timeout = 10000;",
+)
+
+class SQLiteBackend(StorageBackend):
+    """ Embedded SQLite database file for single-node deployments and tests.
+
+        Runs in WAL mode so readers don't block the writer, keeps a cache of
+        prepared statements per connection and creates the schema on first
+        connect. Postgres array parameters and columns are stored as JSON."""
+
+    max_variables = 32766
+    binary_type = 'BLOB'
+    size_function = 'length'
+    vacuum = "VACUUM;"
+    # Take the write lock up front so concurrent writers wait instead of failing to upgrade
+    begin = "BEGIN IMMEDIATE;"
+    any_pattern = re.compile(r'=\s*ANY\(%s\)')
+    # Row locks don't exist here; the write lock taken by BEGIN IMMEDIATE already makes claims exclusive
+    skip_locked_pattern = re.compile(r'\s+FOR UPDATE SKIP LOCKED')
+
+    def __init__(self, path='articles.db', cached_statements=512):
+        super().__init__()
+        self.path = path
+        self.cached_statements = cached_statements
+        self.schema_lock = threading.Lock()
+        self.schema_created = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=self.cached_statements)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        with self.schema_lock:
+            if not self.schema_created:
+                with open(SQLITE_SCHEMA_FILE) as f:
+                    conn.executescript(f.read())
+                self.schema_created = True
+        return conn
+
+    def translate(self, query):
+        query = self.any_pattern.sub('IN (SELECT value FROM json_each(%s))', query)
+        query = self.skip_locked_pattern.sub('', query)
+        return query.replace('%s', '?')
+
+    def create_schema(self):
+        self.connection()
+
+def backend_from_url(url):
+    """ Backend for a database URL: sqlite:///path/to/file.db for an embedded
+        database, or a Postgres URL or connection string for a server """
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    return PostgresBackend(url)
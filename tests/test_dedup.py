@@ -0,0 +1,81 @@
+""" Near-duplicate detection on filtered tokens, so no nltk data is needed."""
+import random
+from dedup import (DuplicateDetector, SimHashIndex, MIN_SIMHASH_TOKENS, SIMHASH_DISTANCE,
+                   simhash, hamming_distance)
+
+TITLE = ['nadal', 'win', 'french', 'open', 'final', 'pari']
+LONG_TITLE = TITLE + ['straight', 'set', 'record', 'titl', 'clay', 'court', 'sunday', 'crowd']
+
+def check_title(detector, article_id, tokens):
+    return detector.check_title(article_id, simhash(tokens), len(set(tokens)))
+
+def text(seed, length=200):
+    rng = random.Random(seed)
+    return ['w%d' % rng.randrange(5000) for _ in range(length)]
+
+def test_simhash_needs_enough_tokens():
+    assert simhash(TITLE[:MIN_SIMHASH_TOKENS - 1]) is None
+    # Repeats don't count
+    assert simhash(TITLE[:MIN_SIMHASH_TOKENS - 1] * 2) is None
+    assert simhash(TITLE) == simhash(list(reversed(TITLE)) + TITLE)
+
+def test_same_title_is_a_duplicate():
+    detector = DuplicateDetector()
+    assert check_title(detector, 1, TITLE) is None
+    assert check_title(detector, 2, list(reversed(TITLE))) == (1, 1.0)
+
+def test_short_titles_differing_in_one_token_are_kept():
+    detector = DuplicateDetector()
+    other = ['federer'] + TITLE[1:]
+    # Close enough to pass as a copy at the distance allowed for longer titles
+    assert 3 < hamming_distance(simhash(TITLE), simhash(other)) <= SIMHASH_DISTANCE
+    assert check_title(detector, 1, TITLE) is None
+    assert check_title(detector, 2, other) is None
+
+def test_long_titles_with_one_extra_token_are_duplicates():
+    detector = DuplicateDetector()
+    longer = LONG_TITLE + ['champion']
+    assert 3 < hamming_distance(simhash(LONG_TITLE), simhash(longer)) <= SIMHASH_DISTANCE
+    assert check_title(detector, 1, LONG_TITLE) is None
+    assert check_title(detector, 2, longer)[0] == 1
+
+def test_simhash_index_matches_exhaustive_search():
+    rng = random.Random(3)
+    fingerprints = {i: rng.getrandbits(64) for i in range(2000)}
+    index = SimHashIndex()
+    for i, fingerprint in fingerprints.items():
+        index.add(i, fingerprint)
+    for _ in range(200):
+        query = rng.choice(list(fingerprints.values()))
+        for _ in range(rng.randrange(8)):
+            query ^= 1 << rng.randrange(64)
+        distances = {i: hamming_distance(query, f) for i, f in fingerprints.items()}
+        closest = min(distances.values())
+        match = index.query(query)
+        if closest <= SIMHASH_DISTANCE:
+            assert match[1] == closest and distances[match[0]] == closest
+        else:
+            assert match is None
+
+def test_near_copy_of_text_is_a_duplicate():
+    detector = DuplicateDetector()
+    original = text(1)
+    copy = list(original)
+    copy[100] = 'changed'
+    assert detector.check_text(1, detector.signature(original)) is None
+    canonical, similarity = detector.check_text(2, detector.signature(copy))
+    assert canonical == 1 and similarity >= 0.8
+
+def test_different_texts_are_kept():
+    detector = DuplicateDetector()
+    assert detector.check_text(1, detector.signature(text(1))) is None
+    assert detector.check_text(2, detector.signature(text(2))) is None
+    # Half the text shared is still a different article
+    assert detector.check_text(3, detector.signature(text(1)[:100] + text(3)[:100])) is None
+
+def test_text_duplicate_stops_being_canonical_for_titles():
+    detector = DuplicateDetector()
+    detector.check_text(1, detector.signature(text(1)))
+    detector.add_title(2, simhash(TITLE))
+    assert detector.check_text(2, detector.signature(text(1))) is not None
+    assert check_title(detector, 3, TITLE) is None
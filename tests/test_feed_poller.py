@@ -0,0 +1,78 @@
+""" poll_feeds against the local fixture server (see benchmarks/fixture_server.py)."""
+import shelve
+import threading
+import pytest
+from benchmarks.corpus import SyntheticCorpus
+from benchmarks.fixture_server import FixtureServer
+from feed_poller import poll_feeds
+
+NUM_PUBLISHERS = 3
+
+@pytest.fixture(scope='module')
+def server():
+    with FixtureServer(SyntheticCorpus(num_docs=60, vocab_size=500, doc_length=40, num_publishers=NUM_PUBLISHERS)) as server:
+        yield server
+
+class Collector:
+    """on_feed callback recording the number of entries of every feed it is given"""
+
+    def __init__(self, fail=()):
+        self.entries = {}
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+
+    def __call__(self, url, feed):
+        if url in self.fail:
+            raise RuntimeError('cannot store %s' % url)
+        with self.lock:
+            self.entries[url] = len(feed.entries)
+
+def test_unchanged_feeds_are_not_modified(server, tmp_path):
+    state = str(tmp_path / 'feed_state')
+    urls = server.feed_urls()
+    collector = Collector()
+    stats = poll_feeds(urls, collector, state_file=state)
+    assert (stats.fetched, stats.not_modified, stats.failed) == (NUM_PUBLISHERS, 0, 0)
+    assert collector.entries == {url: 20 for url in urls}
+    collector = Collector()
+    stats = poll_feeds(urls, collector, state_file=state)
+    assert (stats.fetched, stats.not_modified, stats.failed) == (0, NUM_PUBLISHERS, 0)
+    assert collector.entries == {}
+
+def test_last_modified_alone_is_enough(server, tmp_path):
+    state = str(tmp_path / 'feed_state')
+    urls = server.feed_urls()
+    poll_feeds(urls, Collector(), state_file=state)
+    with shelve.open(state) as saved:
+        for url in urls:
+            assert saved[url]['etag'] and saved[url]['modified']
+            saved[url] = {'etag': None, 'modified': saved[url]['modified']}
+    stats = poll_feeds(urls, Collector(), state_file=state)
+    assert (stats.fetched, stats.not_modified) == (0, NUM_PUBLISHERS)
+
+def test_failing_feed_is_counted_and_retried(server, tmp_path):
+    state = str(tmp_path / 'feed_state')
+    urls = [server.url + '/error/500', server.url + '/error/404'] + server.feed_urls()
+    for _ in range(2):
+        stats = poll_feeds(urls, Collector(), state_file=state)
+        assert stats.failed == 2
+    # The good feeds were remembered, the failing ones never are
+    assert (stats.fetched, stats.not_modified) == (0, NUM_PUBLISHERS)
+    with shelve.open(state) as saved:
+        assert sorted(saved) == sorted(server.feed_urls())
+
+def test_feed_that_fails_to_store_is_fetched_again(server, tmp_path):
+    state = str(tmp_path / 'feed_state')
+    urls = server.feed_urls()
+    stats = poll_feeds(urls, Collector(fail=urls[:1]), state_file=state)
+    assert (stats.fetched, stats.failed) == (NUM_PUBLISHERS - 1, 1)
+    collector = Collector()
+    stats = poll_feeds(urls, collector, state_file=state)
+    assert (stats.fetched, stats.not_modified) == (1, NUM_PUBLISHERS - 1)
+    assert list(collector.entries) == urls[:1]
+
+def test_slow_feed_times_out(server, tmp_path):
+    urls = [server.url + '/slow/2/p0/feed.xml', server.feed_urls()[1]]
+    stats = poll_feeds(urls, Collector(), state_file=str(tmp_path / 'feed_state'), timeout=0.2)
+    assert (stats.fetched, stats.failed) == (1, 1)
+    assert stats.wall_time < 1.5
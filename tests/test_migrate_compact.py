@@ -0,0 +1,66 @@
+""" migrate_compact.py on a SQLite database laid out as before the compact encoding."""
+from datetime import datetime
+import sqlite3
+import pytest
+import db_manager
+import migrate_compact
+from article import Article
+
+TEXTS = [['market', 'rally', 'stock', 'market'], [], ['vote', 'count', 'rain'] * 50] + \
+        [['term%d' % (i % 37), 'common', 'term%d' % i] for i in range(40)]
+
+@pytest.fixture
+def old_layout(tmp_path, monkeypatch):
+    """Article ids mapped to their filtered text, stored as JSON arrays as the old schema did"""
+    db_manager.configure('sqlite:///' + str(tmp_path / 'old.db'))
+    monkeypatch.setattr(db_manager, 'detect_duplicates', False)
+    monkeypatch.setattr(migrate_compact, 'MIGRATION_BATCH_SIZE', 10)
+    links = ['http://example.com/%d' % i for i in range(len(TEXTS))]
+    db_manager.add_articles(Article(('Title', 'Description', link, datetime(2024, 1, 1))) for link in links)
+    ids = db_manager.get_article_ids(links)
+    with db_manager.transaction() as curr:
+        db_manager.execute(curr, "DROP TABLE filtered_articles;")
+        db_manager.execute(curr, "CREATE TABLE filtered_articles (article_id INTEGER PRIMARY KEY "
+                                 "REFERENCES articles (article_id), filtered_text JSONARRAY);")
+        db_manager.execute(curr, "CREATE TABLE term_frequencies (article_id INTEGER PRIMARY KEY, "
+                                 "term_ids BLOB, tf_values BLOB);")
+        for link, text in zip(links, TEXTS):
+            db_manager.execute(curr, "INSERT INTO filtered_articles (article_id, filtered_text) VALUES (%s, %s);",
+                               (ids[link], text))
+            db_manager.execute(curr, "INSERT INTO term_frequencies (article_id, term_ids, tf_values) VALUES (%s, %s, %s);",
+                               (ids[link], b'\0' * 8, b'\0' * 8))
+    db_manager.clear_caches()
+    yield {ids[link]: text for link, text in zip(links, TEXTS)}
+    db_manager.backend.close()
+
+def test_round_trip(old_layout):
+    before, after = migrate_compact.migrate_filtered_text()
+    assert 0 < after < before
+    assert db_manager.get_filtered_texts(list(old_layout)) == old_layout
+    assert migrate_compact.migrate_filtered_text() is None
+
+def test_tokens_are_not_null(old_layout):
+    migrate_compact.migrate_filtered_text()
+    article_id = next(iter(old_layout))
+    with pytest.raises(sqlite3.IntegrityError):
+        with db_manager.cursor() as curr:
+            db_manager.execute(curr, "UPDATE filtered_articles SET filtered_tokens = NULL WHERE article_id = %s;", (article_id,))
+
+def test_interrupted_migration_carries_on(old_layout, monkeypatch):
+    batches = []
+    def stop_after_two(*args):
+        batches.append(args)
+        if len(batches) == 2:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(migrate_compact, 'print_progress', stop_after_two)
+    with pytest.raises(KeyboardInterrupt):
+        migrate_compact.migrate_filtered_text()
+    monkeypatch.setattr(migrate_compact, 'print_progress', lambda *args: None)
+    migrate_compact.migrate_filtered_text()
+    assert db_manager.get_filtered_texts(list(old_layout)) == old_layout
+
+def test_term_frequencies_are_dropped(old_layout):
+    before, after = migrate_compact.drop_term_frequencies()
+    assert before > 0 and after == 0
+    assert not migrate_compact.has_column('term_frequencies', 'article_id')
+    assert migrate_compact.drop_term_frequencies() is None
@@ -0,0 +1,75 @@
+""" Top-k search with MaxScore pruning must return what scoring every article would."""
+import random
+import numpy
+import pytest
+from constants import SCORINGS
+from search_index import SearchIndex
+
+def corpus(num_docs, seed=5):
+    rng = random.Random(seed)
+    # Zipf-like term weights, so some terms are common and their bounds low
+    vocabulary = ['t%d' % i for i in range(400)]
+    weights = [1.0 / (i + 1) for i in range(len(vocabulary))]
+    documents = [rng.choices(vocabulary, weights, k=rng.randrange(5, 80)) for _ in range(num_docs)]
+    published = [1600000000 + 86400 * i for i in range(num_docs)]
+    links = ['http://%s.example.com/%d' % (['www.a', 'b', 'c'][i % 3], i) for i in range(num_docs)]
+    return vocabulary, documents, published, links
+
+def exhaustive(index, terms, scoring, allowed=None):
+    """Score every article for every query term"""
+    weights = index.query_weights(terms, scoring)
+    index.average_length = index.lengths.mean() or 1.0
+    scores = numpy.zeros(len(index))
+    for col, weight in weights:
+        rows, counts = index.term_postings(col)
+        scores[rows] += index.contributions(rows, counts, weight, scoring)
+    if allowed is not None:
+        scores[~allowed] = 0
+    return {a: s for a, s in zip(index.article_ids, scores.tolist()) if s > 0}
+
+def build(num_docs=600, appended=40):
+    vocabulary, documents, published, links = corpus(num_docs + appended)
+    index = SearchIndex()
+    index.add(range(num_docs), documents[:num_docs], published[:num_docs], links[:num_docs])
+    index.compact()
+    # Left in the uncompacted delta
+    index.add(range(num_docs, num_docs + appended), documents[num_docs:], published[num_docs:], links[num_docs:])
+    return index, vocabulary
+
+def assert_top(results, scores, n):
+    """results hold n best scores, each the article's full score; ties may pick either article"""
+    assert [s for _, s in results] == pytest.approx(sorted(scores.values(), reverse=True)[:n])
+    for article_id, score in results:
+        assert score == pytest.approx(scores[article_id])
+
+@pytest.mark.parametrize('scoring', SCORINGS)
+def test_top_k_matches_exhaustive_scoring(scoring):
+    index, vocabulary = build()
+    rng = random.Random(7)
+    for _ in range(100):
+        terms = rng.sample(vocabulary[:200], rng.randrange(1, 6))
+        n = rng.choice([1, 5, 10, 50])
+        assert_top(index.search(terms, n, scoring=scoring), exhaustive(index, terms, scoring), n)
+
+@pytest.mark.parametrize('scoring', SCORINGS)
+def test_filtered_top_k_matches_exhaustive_scoring(scoring):
+    index, vocabulary = build()
+    rng = random.Random(8)
+    for _ in range(50):
+        terms = rng.sample(vocabulary[:200], rng.randrange(1, 6))
+        start, end = 1600000000 + 86400 * 100, 1600000000 + 86400 * 500
+        allowed = index.allowed(start, end, ['a.example.com'])
+        scores = exhaustive(index, terms, scoring, allowed)
+        assert_top(index.search(terms, 10, start, end, ['a.example.com'], scoring), scores, 10)
+
+def test_saved_index_searches_the_same(tmp_path):
+    index, vocabulary = build()
+    path = str(tmp_path / 'search_index.npz')
+    index.save(path)
+    loaded = SearchIndex.load(path)
+    terms = vocabulary[10:13]
+    assert loaded.search(terms, 10) == index.search(terms, 10)
+    # Publishers are stored without a leading www.
+    assert loaded.publisher_names == ['a.example.com', 'b.example.com', 'c.example.com']
+    assert loaded.search(terms, 10, publishers=['http://www.a.example.com/']) == \
+        index.search(terms, 10, publishers=['a.example.com'])
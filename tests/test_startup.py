@@ -0,0 +1,10 @@
+""" The quick command line lookups must start without importing feedparser,
+    newspaper, nltk, numpy or scipy (see benchmarks/startup.py)."""
+import pytest
+from benchmarks.startup import COMMANDS, command_env, loaded_modules
+
+@pytest.mark.parametrize('name', list(COMMANDS))
+def test_command_skips_heavy_imports(name, tmp_path):
+    env = command_env('sqlite:///' + str(tmp_path / 'startup.db'))
+    # Runs the command in a fresh interpreter against an empty database
+    assert loaded_modules(COMMANDS[name], env) == []
@@ -0,0 +1,114 @@
+""" Every storage backend runs the same tests. SQLite runs everywhere; set
+    ARTICLE_TEST_POSTGRES to a Postgres DSN or URL to include Postgres."""
+import os
+import threading
+import pytest
+from storage import PostgresBackend, SQLiteBackend
+
+POSTGRES_DSN = os.environ.get('ARTICLE_TEST_POSTGRES')
+TABLE = 'storage_test_rows'
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def backend(request, tmp_path):
+    if request.param == 'sqlite':
+        backend = SQLiteBackend(str(tmp_path / 'test.db'))
+    elif POSTGRES_DSN:
+        backend = PostgresBackend(POSTGRES_DSN, max_connections=4)
+    else:
+        pytest.skip('ARTICLE_TEST_POSTGRES is not set')
+    with backend.cursor() as curr:
+        backend.execute(curr, "DROP TABLE IF EXISTS %s;" % TABLE)
+        backend.execute(curr, "CREATE TABLE %s (id INTEGER PRIMARY KEY, name TEXT NOT NULL);" % TABLE)
+    yield backend
+    with backend.cursor() as curr:
+        backend.execute(curr, "DROP TABLE IF EXISTS %s;" % TABLE)
+    backend.close()
+
+def insert(backend, rows):
+    with backend.cursor() as curr:
+        return backend.execute_values(curr, "INSERT INTO %s (id, name) VALUES %%s;" % TABLE, rows)
+
+def fetch(backend, query, args=None):
+    with backend.cursor() as curr:
+        backend.execute(curr, query, args)
+        return curr.fetchall()
+
+def test_translate():
+    sqlite = SQLiteBackend(':memory:')
+    assert sqlite.translate("SELECT 1 FROM t WHERE a = %s AND b = ANY(%s);") == \
+        "SELECT 1 FROM t WHERE a = ? AND b IN (SELECT value FROM json_each(?));"
+    assert sqlite.translate("SELECT id FROM t ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED") == \
+        "SELECT id FROM t ORDER BY id LIMIT ?"
+    query = "SELECT 1 FROM t WHERE b = ANY(%s) FOR UPDATE SKIP LOCKED;"
+    assert PostgresBackend().translate(query) == query
+
+def test_execute_values_counts_every_page(backend):
+    rows = [(i, 'row %d' % i) for i in range(2500)]
+    with backend.cursor() as curr:
+        count = backend.execute_values(curr, "INSERT INTO %s (id, name) VALUES %%s;" % TABLE, rows, page_size=1000)
+    assert count == len(rows)
+    assert fetch(backend, "SELECT count(*) FROM %s;" % TABLE) == [(len(rows),)]
+
+def test_execute_values_fetch(backend):
+    insert(backend, [(1, 'a')])
+    query = ("INSERT INTO %s (id, name) VALUES %%s ON CONFLICT (id) DO NOTHING RETURNING id;" % TABLE)
+    with backend.cursor() as curr:
+        returned = backend.execute_values(curr, query, [(i, 'n%d' % i) for i in range(5)], page_size=2, fetch=True)
+    # The conflicting row is left out
+    assert sorted(r[0] for r in returned) == [0, 2, 3, 4]
+    with backend.cursor() as curr:
+        assert backend.execute_values(curr, query, [], fetch=True) == []
+
+def test_any_parameter(backend):
+    insert(backend, [(i, 'n%d' % i) for i in range(10)])
+    rows = fetch(backend, "SELECT id FROM %s WHERE id = ANY(%%s) ORDER BY id;" % TABLE, ([2, 5, 7, 42],))
+    assert rows == [(2,), (5,), (7,)]
+    rows = fetch(backend, "SELECT id FROM %s WHERE name = ANY(%%s) AND id > %%s;" % TABLE, (['n1', 'n8'], 3))
+    assert rows == [(8,)]
+    assert fetch(backend, "SELECT id FROM %s WHERE id = ANY(%%s);" % TABLE, ([],)) == []
+
+def test_stream(backend):
+    insert(backend, [(i, 'n%d' % i) for i in range(250)])
+    with backend.stream(100) as curr:
+        backend.execute(curr, "SELECT id FROM %s ORDER BY id;" % TABLE)
+        # Other queries on the same thread still work while the stream is open
+        assert fetch(backend, "SELECT count(*) FROM %s;" % TABLE) == [(250,)]
+        ids = [row[0] for row in curr]
+    assert ids == list(range(250))
+
+def test_transaction_commits(backend):
+    with backend.transaction() as curr:
+        backend.execute(curr, "INSERT INTO %s (id, name) VALUES (%%s, %%s);" % TABLE, (1, 'a'))
+        backend.execute(curr, "UPDATE %s SET name = %%s WHERE id = %%s;" % TABLE, ('b', 1))
+    assert fetch(backend, "SELECT id, name FROM %s;" % TABLE) == [(1, 'b')]
+
+def test_transaction_rolls_back(backend):
+    insert(backend, [(1, 'a')])
+    with pytest.raises(RuntimeError):
+        with backend.transaction() as curr:
+            backend.execute(curr, "INSERT INTO %s (id, name) VALUES (%%s, %%s);" % TABLE, (2, 'b'))
+            backend.execute(curr, "DELETE FROM %s WHERE id = %%s;" % TABLE, (1,))
+            raise RuntimeError('abort')
+    assert fetch(backend, "SELECT id, name FROM %s;" % TABLE) == [(1, 'a')]
+    # The connection is usable again afterwards
+    insert(backend, [(3, 'c')])
+    assert fetch(backend, "SELECT count(*) FROM %s;" % TABLE) == [(2,)]
+
+def test_thread_connections(backend):
+    """Every thread gets its own connection, and finished threads give theirs back"""
+    errors = []
+    def work(i):
+        try:
+            insert(backend, [(i, 'thread %d' % i)])
+        except Exception as e:
+            errors.append(e)
+    # Ten times as many short-lived threads as the Postgres pool has connections
+    for start in range(0, 40, 4):
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(start, start + 4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        del threads, t
+    assert errors == []
+    assert fetch(backend, "SELECT count(*) FROM %s;" % TABLE) == [(40,)]
@@ -0,0 +1,90 @@
+""" Job leases in the shared work queue, on a fresh SQLite database per test."""
+from datetime import datetime
+import pytest
+import db_manager
+import work_queue
+from article import Article
+from db_manager import MAX_JOB_ATTEMPTS, claim_jobs, renew_leases, complete_jobs, release_jobs, get_job_counts
+
+NUM_JOBS = 10
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch):
+    """The article ids of NUM_JOBS queued jobs"""
+    db_manager.configure('sqlite:///' + str(tmp_path / 'jobs.db'))
+    # Title fingerprints need nltk's stop words, and aren't under test
+    monkeypatch.setattr(db_manager, 'detect_duplicates', False)
+    db_manager.add_articles(Article(('Title %d' % i, 'Description', 'http://example.com/%d' % i, datetime(2024, 1, 1)))
+                            for i in range(NUM_JOBS))
+    ids = sorted(db_manager.get_article_ids('http://example.com/%d' % i for i in range(NUM_JOBS)).values())
+    assert db_manager.enqueue_jobs(ids) == NUM_JOBS
+    yield ids
+    db_manager.backend.close()
+
+def attempts(article_ids):
+    with db_manager.cursor() as curr:
+        db_manager.execute(curr, "SELECT article_id, attempts FROM article_jobs WHERE article_id = ANY(%s);",
+                           ([int(i) for i in article_ids],))
+        return dict(curr.fetchall())
+
+def test_claims_are_exclusive(jobs):
+    first = claim_jobs('a', 4, 60)
+    second = claim_jobs('b', NUM_JOBS, 60)
+    assert first == jobs[:4] and second == jobs[4:]
+    assert claim_jobs('c', NUM_JOBS, 60) == []
+    assert get_job_counts() == {'leased': NUM_JOBS}
+
+def test_only_the_holder_renews_and_completes(jobs):
+    claimed = claim_jobs('a', 4, 60)
+    assert renew_leases('a', claimed, 60) == 4
+    assert renew_leases('b', claimed, 60) == 0
+    assert complete_jobs('b', claimed) == 0
+    assert complete_jobs('a', claimed) == 4
+    assert renew_leases('a', claimed, 60) == 0
+    assert get_job_counts() == {'done': 4, 'pending': NUM_JOBS - 4}
+
+def test_expired_leases_are_reclaimed(jobs):
+    # Already expired by the time anyone looks
+    lost = claim_jobs('a', 4, -1)
+    assert claim_jobs('b', NUM_JOBS, 60) == jobs
+    assert renew_leases('a', lost, 60) == 0
+    assert complete_jobs('a', lost) == 0
+    assert attempts(lost) == {id: 2 for id in lost}
+
+def test_jobs_fail_after_max_attempts(jobs):
+    for _ in range(MAX_JOB_ATTEMPTS):
+        assert claim_jobs('a', 1, -1) == jobs[:1]
+    assert claim_jobs('a', 1, 60) == []
+    assert get_job_counts() == {'failed': 1, 'pending': NUM_JOBS - 1}
+
+def test_release_refunds_the_attempt(jobs):
+    claimed = claim_jobs('a', 4, 60)
+    assert release_jobs('a', claimed[:2], refund=True) == 2
+    assert release_jobs('a', claimed[2:], refund=False) == 2
+    assert release_jobs('a', claimed, refund=True) == 0
+    assert attempts(claimed) == {claimed[0]: 0, claimed[1]: 0, claimed[2]: 1, claimed[3]: 1}
+    assert get_job_counts() == {'pending': NUM_JOBS}
+
+def test_failing_article_is_isolated_and_charged(jobs, monkeypatch):
+    bad = jobs[3]
+    def process_articles(articles, workers, verbose=True):
+        if any(a.article_id == bad for a in articles):
+            raise RuntimeError('cannot process %s' % bad)
+        return articles
+    monkeypatch.setattr(work_queue, 'process_articles', process_articles)
+    claimed = claim_jobs('a', NUM_JOBS, 60)
+    assert work_queue.process_jobs('a', claimed, lease_seconds=60) == (NUM_JOBS - 1, NUM_JOBS - 1)
+    assert get_job_counts() == {'done': NUM_JOBS - 1, 'pending': 1}
+    assert attempts(jobs) == {id: 1 for id in jobs}
+    # Charged, so it is retried at most MAX_JOB_ATTEMPTS times in all
+    assert claim_jobs('a', NUM_JOBS, 60) == [bad]
+
+def test_interrupted_batch_is_refunded(jobs, monkeypatch):
+    def process_articles(articles, workers, verbose=True):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(work_queue, 'process_articles', process_articles)
+    claimed = claim_jobs('a', 4, 60)
+    with pytest.raises(KeyboardInterrupt):
+        work_queue.process_jobs('a', claimed, lease_seconds=60)
+    assert get_job_counts() == {'pending': NUM_JOBS}
+    assert attempts(claimed) == {id: 0 for id in claimed}
@@ -0,0 +1,111 @@
+import re
+import string
+import time
+import random
+import argparse
+from functools import lru_cache
+
+# Distinct stems remembered; common words make up most tokens, so hits dominate well below this
+STEM_CACHE_SIZE = 100000
+# Below this many texts a process pool costs more to start than it saves
+MIN_POOL_TEXTS = 64
+
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+TAG_PATTERN = re.compile('<[^<]+?>')
+
+_stop_words = None
+_stemmer = None
+
+def stop_words():
+    """NLTK's English stop words as a frozenset, loaded on first use"""
+    global _stop_words
+    if _stop_words is None:
+        from nltk.corpus import stopwords
+        _stop_words = frozenset(stopwords.words('english'))
+    return _stop_words
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word):
+    """Snowball stem of a word, cached"""
+    global _stemmer
+    if _stemmer is None:
+        from nltk.stem.snowball import SnowballStemmer
+        _stemmer = SnowballStemmer('english')
+    return _stemmer.stem(word)
+
+def strip_tags(text):
+    """Strip HTML formatting from a raw RSS entry"""
+    return TAG_PATTERN.sub('', text)
+
+def tokenize(raw_text):
+    """Strip punctuation from raw article text and split it into lowercase words"""
+    return raw_text.translate(PUNCTUATION_TABLE).lower().split()
+
+def filter_tokens(tokens):
+    """Remove stop words from a list of tokens and stem the rest"""
+    excluded = stop_words()
+    return [stem(w) for w in tokens if w not in excluded]
+
+def normalize(raw_text):
+    """Filtered, stemmed tokens of raw article text"""
+    return filter_tokens(tokenize(raw_text))
+
+def normalize_many(texts, processes=None, chunksize=16):
+    """ Normalize many raw texts, in order, across a pool of processes
+        (one per CPU by default). Small batches are normalized in-process."""
+    texts = list(texts)
+    if processes == 1 or len(texts) < MIN_POOL_TEXTS:
+        return [normalize(t) for t in texts]
+    from multiprocessing import Pool
+    with Pool(processes) as pool:
+        return pool.map(normalize, texts, chunksize)
+
+def reference_normalize(raw_text, stop_word_list, stemmer):
+    """The original per-character, stop word list and uncached stemmer implementation"""
+    text = ''.join([c for c in raw_text if c not in string.punctuation])
+    return [stemmer.stem(w) for w in [w.lower() for w in text.split()] if w not in stop_word_list]
+
+def sample_texts(num_texts, words_per_text, seed=0):
+    """Random texts drawn from a small vocabulary with punctuation and stop words mixed in"""
+    rng = random.Random(seed)
+    vocabulary = ['Market', 'markets', 'election', 'voting', 'voters', 'running', 'runner', 'weather', 'storms',
+                  'the', 'and', 'of', 'to', 'was', 'it', "didn't", 'U.S.', 'e-mail', '(report)', 'said,', 'growth;']
+    return [' '.join(rng.choice(vocabulary) for _ in range(words_per_text)) for _ in range(num_texts)]
+
+def benchmark(texts, processes=None):
+    """Print tokens/sec for the original implementation, normalize and normalize_many"""
+    num_tokens = sum(len(t.split()) for t in texts)
+    from nltk.corpus import stopwords
+    from nltk.stem.snowball import SnowballStemmer
+    stop_word_list = stopwords.words('english')
+    stemmer = SnowballStemmer('english')
+    timings = []
+    start = time.perf_counter()
+    expected = [reference_normalize(t, stop_word_list, stemmer) for t in texts]
+    timings.append(('original', time.perf_counter() - start))
+    stem.cache_clear()
+    start = time.perf_counter()
+    single = [normalize(t) for t in texts]
+    timings.append(('normalize', time.perf_counter() - start))
+    start = time.perf_counter()
+    many = normalize_many(texts, processes)
+    timings.append(('normalize_many', time.perf_counter() - start))
+    for name, elapsed in timings:
+        print("{0:>15}: {1:.2f}s  ({2:,.0f} tokens/sec)".format(name, elapsed, num_tokens / elapsed))
+    print("Output identical to original: %s" % (single == expected and many == expected))
+    print("Stem cache: %s" % (stem.cache_info(),))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Text normalization micro-benchmark')
+    parser.add_argument("-f", "--file", help="benchmark on the paragraphs of a text file instead of generated text")
+    parser.add_argument("-n", "--num-texts", type=int, default=2000, help="number of generated texts")
+    parser.add_argument("-w", "--words", type=int, default=500, help="words per generated text")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="processes for normalize_many (default: one per CPU)")
+
+    args = parser.parse_args()
+    if args.file:
+        with open(args.file) as f:
+            texts = [t for t in f.read().split('\n\n') if t.strip()]
+    else:
+        texts = sample_texts(args.num_texts, args.words)
+    benchmark(texts, args.processes)
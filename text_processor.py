@@ -3,6 +3,10 @@ from random import randint
 import sys
 from functools import reduce
 from operator import or_
+import itertools
+from cache import LRUCache, cached
+
+IDF_CACHE_SIZE = 100000
 
 def max_frequency(document):
     """Calculated largest term frequency of terms in a document"""
@@ -22,15 +26,26 @@ def augmented_term_frequency(term, document, max_frequency=1):
     """
     return 0.5 + (0.5 * document.count(term)) / max_frequency
 
-def memoize(f):
-    memo = {}
-    def helper(t, *args):
-        if t not in memo:
-            memo[t] = f(t, *args)
-        return memo[t]
-    return helper 
+# Each entry pins its corpus in memory, so only the latest few are versioned
+corpus_versions = LRUCache('corpus_versions', 4)
+versions = itertools.count()
+
+def corpus_version(document_list):
+    """ Version of a corpus for cache keys. A different list, or the same one
+        after its length changed, gets a new version; call invalidate_corpus()
+        after editing documents in place."""
+    entry = corpus_versions.get(id(document_list), count=False)
+    if entry is None or entry[1] != len(document_list):
+        entry = (document_list, len(document_list), next(versions))
+        corpus_versions.set(id(document_list), entry)
+    return entry[2]
+
+def invalidate_corpus(document_list):
+    corpus_versions.invalidate(id(document_list))
+
+idf_cache = LRUCache('inv_document_frequency', IDF_CACHE_SIZE)
 
-@memoize
+@cached(idf_cache, key=lambda term, document_list: (term, corpus_version(document_list)))
 def inv_document_frequency(term, document_list):
     """Logarithmically sclaed fraction of documents that contain the term"""
     num_docs_with_t = len([d for d in document_list if term in d])
@@ -77,9 +92,9 @@ def distance(vec1, vec2):
 def reservoir_sample(arr, k):
     """Return k random samples of elements in arr"""
     reservoir = arr[:k]
-    for i in range(k+1, len(arr)):
-        j = randint(1, i)
-        if j <= k:
+    for i in range(k, len(arr)):
+        j = randint(0, i)
+        if j < k:
             reservoir[j] = arr[i]
     return reservoir
 
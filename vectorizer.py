@@ -0,0 +1,165 @@
+from array import array
+from collections import Counter
+import numpy
+from scipy import sparse
+import metrics
+
+class Vectorizer:
+    """ Sparse tf-idf vectorizer over filtered article text.
+
+        Each document is counted exactly once. Document frequencies are
+        accumulated in the same pass, and terms are assigned matrix columns in
+        the order they are first seen, so the term -> column vocabulary stays
+        stable as more documents are counted. With use_corpus(), the document
+        frequencies come from outside instead."""
+
+    def __init__(self, vocabulary=None, doc_frequencies=None, num_docs=0):
+        self.vocabulary = dict(vocabulary) if vocabulary else {}
+        self.doc_frequencies = array('q', doc_frequencies or [0] * len(self.vocabulary))
+        self.num_docs = num_docs
+        self.corpus = None
+
+    def use_corpus(self, doc_frequencies, num_docs):
+        """ Weight terms by outside document frequencies (a term -> count
+            mapping) and corpus size, e.g. the counters db_manager keeps for
+            every filtered article, instead of counting them. Counting
+            documents then only grows the vocabulary and forgetting them
+            changes nothing, since the outside counts already cover them."""
+        self.corpus = dict(doc_frequencies)
+        self.doc_frequencies = array('q', (self.corpus.get(t, 0) for t in self.terms()))
+        self.num_docs = num_docs
+
+    def update_corpus(self, doc_frequencies, num_docs):
+        """Refresh the outside document frequencies of some terms and the corpus size"""
+        self.corpus.update(doc_frequencies)
+        for term, n in doc_frequencies.items():
+            col = self.vocabulary.get(term)
+            if col is not None:
+                self.doc_frequencies[col] = n
+        self.num_docs = num_docs
+
+    def terms(self):
+        """Terms ordered by their column in the document matrix"""
+        terms = [None] * len(self.vocabulary)
+        for term, col in self.vocabulary.items():
+            terms[col] = term
+        return terms
+
+    @metrics.timed('vectorize_seconds')
+    def count(self, document_list, grow=True, raw=False):
+        """ Get a sparse (docs x terms) matrix of augmented term frequencies
+
+            tf(t,d) = 0.5 + (0.5 * f(t,d)) / max{ f(t,d) : t in d }
+
+            for every term t present in document d, or of the raw counts
+            f(t,d) if raw is set. With grow set, unseen terms are added to the
+            vocabulary and every document counts towards the document
+            frequencies (unless they come from use_corpus()); otherwise unseen
+            terms are ignored."""
+        vocabulary = self.vocabulary
+        doc_frequencies = self.doc_frequencies
+        corpus = self.corpus
+        counting = grow and corpus is None
+        indptr, indices, data = array('q', [0]), array('q'), array('d')
+        num_docs = 0
+        for document in document_list:
+            num_docs += 1
+            counts = Counter(document)
+            if not counts:
+                indptr.append(len(indices))
+                continue
+            max_f = max(counts.values())
+            for term, f in counts.items():
+                col = vocabulary.get(term)
+                if col is None:
+                    if not grow:
+                        continue
+                    col = len(vocabulary)
+                    vocabulary[term] = col
+                    doc_frequencies.append(0 if corpus is None else corpus.get(term, 0))
+                if counting:
+                    doc_frequencies[col] += 1
+                indices.append(col)
+                data.append(f if raw else 0.5 + (0.5 * f) / max_f)
+            indptr.append(len(indices))
+        if counting:
+            self.num_docs += num_docs
+        if grow:
+            metrics.set_gauge('vocabulary_terms', len(vocabulary))
+        shape = (num_docs, len(vocabulary))
+        return sparse.csr_matrix((numpy.frombuffer(data, dtype=numpy.float64),
+                                  numpy.frombuffer(indices, dtype=numpy.int64),
+                                  numpy.frombuffer(indptr, dtype=numpy.int64)), shape=shape)
+
+    def forget(self, matrix):
+        """Take documents out of the document frequencies, given any sparse (docs x terms) matrix of them"""
+        if self.corpus is not None:
+            return
+        matrix = sparse.csr_matrix(matrix)
+        num_terms = len(self.doc_frequencies)
+        counts = numpy.bincount(matrix.indices, minlength=num_terms)[:num_terms]
+        self.doc_frequencies = array('q', (numpy.frombuffer(self.doc_frequencies, dtype=numpy.int64) - counts).tolist())
+        self.num_docs -= matrix.shape[0]
+
+    def prune(self, live=None):
+        """ Drop the terms no longer in use, renumbering the columns of the rest
+            in order. live is a mask of the columns still in use (see
+            used_terms), by default those counted in some document. Returns the
+            mask of the columns kept, or None if every term is still in use."""
+        doc_frequencies = numpy.frombuffer(self.doc_frequencies, dtype=numpy.int64)
+        if live is None:
+            live = doc_frequencies > 0
+        if live.all():
+            return None
+        terms = [t for t, keep in zip(self.terms(), live.tolist()) if keep]
+        self.vocabulary = {t: i for i, t in enumerate(terms)}
+        self.doc_frequencies = array('q', doc_frequencies[live].tolist())
+        return live
+
+    def idfs(self):
+        """ Logarithmically scaled inverse document frequency of every term, by column
+
+            idf(t) = log10(N / (1 + n_t))
+        """
+        doc_frequencies = numpy.frombuffer(self.doc_frequencies, dtype=numpy.int64).copy()
+        return numpy.log10(self.num_docs / (1.0 + doc_frequencies))
+
+    @metrics.timed('vectorize_seconds')
+    def tf_idf(self, term_frequencies, normalize=True):
+        """Scale a term frequency matrix by the corpus idfs, optionally normalizing each row"""
+        idfs = self.idfs()
+        num_terms = term_frequencies.shape[1]
+        if num_terms > len(idfs):
+            raise ValueError("Term frequency matrix has more columns than the vocabulary")
+        elif num_terms < len(idfs):
+            # Counted before the vocabulary grew; widen to the current vocabulary
+            term_frequencies = widen(term_frequencies, len(idfs))
+        matrix = sparse.csr_matrix(term_frequencies.multiply(idfs))
+        if normalize:
+            matrix = normalize_rows(matrix)
+        return matrix
+
+    def fit_transform(self, document_list, normalize=True):
+        """Count a corpus and return its sparse (docs x terms) tf-idf matrix"""
+        return self.tf_idf(self.count(document_list), normalize)
+
+    def transform(self, document_list, normalize=True):
+        """Vectorize documents against the current vocabulary and idfs without updating them"""
+        return self.tf_idf(self.count(document_list, grow=False), normalize)
+
+def widen(matrix, num_terms):
+    """Give a CSR matrix extra (empty) term columns after the vocabulary has grown"""
+    if matrix.shape[1] == num_terms:
+        return matrix
+    return sparse.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], num_terms))
+
+def used_terms(matrix, num_terms):
+    """Mask of the term columns with an entry in some row of a sparse (docs x terms) matrix"""
+    matrix = sparse.csr_matrix(matrix)
+    return numpy.bincount(matrix.indices, minlength=num_terms)[:num_terms] > 0
+
+def normalize_rows(matrix):
+    """Scale every row of a sparse matrix to unit length, leaving empty rows as they are"""
+    lengths = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    lengths[lengths == 0] = 1.0
+    return sparse.csr_matrix(sparse.diags(1.0 / lengths) @ matrix)
@@ -0,0 +1,181 @@
+import os
+import time
+import socket
+import argparse
+import threading
+from multiprocessing import Process, Queue
+from db_manager import *
+from article_extractor import DEFAULT_WORKERS
+from article_processor import process_articles
+import metrics
+import content_cache
+
+DEFAULT_BATCH_SIZE = 50
+# Seconds a claimed batch stays leased without a heartbeat; renewed every third of it
+DEFAULT_LEASE = 120
+# Seconds an idle worker waits before looking for new jobs again
+DEFAULT_POLL_INTERVAL = 5
+
+def worker_name():
+    """Identifies this process's leases across every node sharing the database"""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def enqueue_unprocessed(window=None):
+    """Queue a job for every article that is not yet filtered, failed, a duplicate or expired"""
+    start = window_start(window) if window else None
+    return enqueue_jobs(a.article_id for a in iter_articles(fields=(), filtered=False, start=start))
+
+class Batch:
+    """The jobs of a claimed batch this worker still holds, shared with its heartbeat thread"""
+    def __init__(self, worker, article_ids):
+        self.worker = worker
+        self.leased = set(article_ids)
+        self.lock = threading.Lock()
+
+    def renew(self, lease_seconds):
+        with self.lock:
+            held = renew_leases(self.worker, list(self.leased), lease_seconds)
+            if held < len(self.leased):
+                print('%s: lost the lease on %s jobs' % (self.worker, len(self.leased) - held))
+
+    def complete(self, article_ids):
+        with self.lock:
+            self.leased.difference_update(article_ids)
+            return complete_jobs(self.worker, article_ids)
+
+    def release(self, article_ids=None, refund=True):
+        with self.lock:
+            article_ids = list(self.leased if article_ids is None else article_ids)
+            self.leased.difference_update(article_ids)
+            return release_jobs(self.worker, article_ids, refund)
+
+def keep_leases(batch, lease_seconds, stop):
+    """Renew the leases on a batch every third of the lease period until stop is set"""
+    while not stop.wait(lease_seconds / 3):
+        batch.renew(lease_seconds)
+
+def process_part(batch, article_ids, workers):
+    """ Process part of a batch. If it fails, each half is retried on its own
+        until the failing articles are isolated, so only those are charged an
+        attempt and handed back. Returns (jobs done, articles filtered)."""
+    try:
+        articles = list(get_articles_by_id(article_ids).values())
+        filtered = process_articles(articles, workers, verbose=False)
+    except Exception as e:
+        if len(article_ids) == 1:
+            print('%s: failed to process job %s: %s' % (batch.worker, article_ids[0], e))
+            batch.release(article_ids, refund=False)
+            return 0, 0
+        middle = len(article_ids) // 2
+        done, filtered = zip(*(process_part(batch, part, workers) for part in (article_ids[:middle], article_ids[middle:])))
+        return sum(done), sum(filtered)
+    return batch.complete(article_ids), len(filtered)
+
+def process_jobs(worker, article_ids, workers=DEFAULT_WORKERS, lease_seconds=DEFAULT_LEASE):
+    """ Download and filter a claimed batch while a heartbeat thread keeps it
+        leased, then mark the jobs done. Every step skips what is already
+        stored, so a batch reclaimed from a worker that died halfway, or a part
+        retried after an error (see process_part), is finished without redoing
+        or double counting anything. On an interrupt the jobs left are handed
+        back without counting as an attempt. Returns (jobs done, articles
+        filtered)."""
+    batch = Batch(worker, article_ids)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=keep_leases, args=(batch, lease_seconds, stop), daemon=True)
+    heartbeat.start()
+    try:
+        return process_part(batch, sorted(article_ids), workers)
+    except BaseException:
+        batch.release()
+        raise
+    finally:
+        stop.set()
+        heartbeat.join()
+
+def run_worker(workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, lease_seconds=DEFAULT_LEASE,
+               drain=False, poll_interval=DEFAULT_POLL_INTERVAL):
+    """ Claim and process batches of jobs until interrupted, or with drain
+        until no job is left pending or leased. A batch that fails is logged
+        and skipped; its jobs are already back in the queue. Returns the
+        number of jobs done."""
+    worker = worker_name()
+    done = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            article_ids = claim_jobs(worker, batch_size, lease_seconds)
+            if not article_ids:
+                # Leases held elsewhere may still expire and need finishing
+                if drain and not get_job_counts().get('leased'):
+                    break
+                time.sleep(min(poll_interval, 1) if drain else poll_interval)
+                continue
+            try:
+                completed, filtered = process_jobs(worker, article_ids, workers, lease_seconds)
+            except Exception as e:
+                print('%s: failed to process %s jobs: %s' % (worker, len(article_ids), e))
+                metrics.inc('job_batches_failed')
+                continue
+            done += completed
+            print('%s: %s jobs done, %s articles filtered' % (worker, completed, filtered))
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.perf_counter() - start
+    print('{0}: processed {1} jobs in {2:.2f}s ({3:.2f} jobs/sec)'.format(worker, done, elapsed, done / elapsed))
+    return done
+
+def run_child(results, **kwargs):
+    results.put(run_worker(**kwargs))
+
+def run_workers(processes, **kwargs):
+    """ Run run_worker in this many processes, each with its own database
+        connections, and wait for them. More can join from other nodes by
+        running this module against the same Postgres database. Returns the
+        number of jobs done by the processes that exited cleanly."""
+    if processes == 1:
+        return run_worker(**kwargs)
+    results = Queue()
+    children = [Process(target=run_child, args=(results,), kwargs=kwargs) for _ in range(processes)]
+    for child in children:
+        child.start()
+    try:
+        for child in children:
+            child.join()
+    except KeyboardInterrupt:
+        # Every worker got the interrupt too and is releasing its batch
+        for child in children:
+            child.join()
+    return sum(results.get() for child in children if child.exitcode == 0)
+
+def format_job_counts():
+    counts = get_job_counts()
+    return ', '.join('%s %s' % (counts.get(state, 0), state) for state in ('pending', 'leased', 'done', 'failed'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process articles from the shared work queue, on any number of processes and nodes')
+    parser.add_argument("--enqueue", action="store_true", help="first queue a job for every unprocessed article")
+    parser.add_argument("--window", type=float, metavar="DAYS", help="with --enqueue, only queue articles published in the last DAYS days")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="worker processes to run on this node (0 to only enqueue)")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="download threads per worker process")
+    parser.add_argument("-b", "--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="jobs claimed at a time")
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE, help="seconds a claimed batch stays leased without a heartbeat")
+    parser.add_argument("--drain", action="store_true", help="exit once the queue is empty instead of waiting for new jobs")
+    parser.add_argument("--status", action="store_true", help="print the number of jobs in each state and exit")
+    content_cache.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics.from_arguments(args)
+    content_cache.from_arguments(args)
+    if args.status:
+        print(format_job_counts())
+    else:
+        if args.enqueue:
+            print("Queued %s jobs" % enqueue_unprocessed(args.window))
+        if args.processes > 0:
+            start = time.perf_counter()
+            run_workers(args.processes, workers=args.workers, batch_size=args.batch_size,
+                        lease_seconds=args.lease, drain=args.drain)
+            print('Jobs: %s' % format_job_counts())
+            print('Wall time: {0:.2f}s'.format(time.perf_counter() - start))
+    metrics.write_from_arguments(args)